@@ -0,0 +1,185 @@
+"""
+Benchmark of ConfigurationClient operations. Reports latency percentiles
+and the number of round trips to the backend for each operation.
+
+python benchmarks/bench_configuration_client.py           #in memory backend
+python benchmarks/bench_configuration_client.py --redis   #server in EPOC_REDIS_HOST
+
+Against Redis the configuration in the selected db (default 1) is cleared and
+overwritten!
+With --check the exit code is 1 if an operation needs more round trips
+than in MAX_ROUND_TRIPS, use it to catch regressions in hot paths.
+"""
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import redis
+
+from epoc import ConfigurationClient, auth_token, redis_host
+from epoc.ConfigurationClient import redis_port
+from epoc.backends import MemoryBackend, MemoryPipeline
+
+CONFIG = Path(__file__).parent.parent / 'etc' / 'epoc-config.yaml'
+
+# Upper limit of round trips per operation, checked with --check
+MAX_ROUND_TRIPS = {
+    'read PI_name': 1,
+    'write PI_name': 1,
+    'read beam_center': 1,
+    'data_dir': 4,
+    'fname': 3,
+    'fpath': 7,
+    'fpath in snapshot': 1,
+    'repr': 1,
+    'after_write': 1,
+    'reserve_file_ids(10)': 1,
+    'session next_path': 0.01, #one reservation per 100 paths
+    'from_yaml': 1,
+    'to_yaml': 1,
+    'dump': 1,
+    'write 500 overlays': 1,
+    'read 500 overlays': 1,
+}
+
+
+class CountingConnection(redis.Connection):
+    """Counts every request sent to the server, a pipeline is sent as one"""
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        super().send_packed_command(command, check_health)
+
+
+class CountingPipeline(MemoryPipeline):
+    def execute(self):
+        backend = self._backend
+        if backend._depth == 0:
+            backend.round_trips += 1
+        backend._depth += 1
+        try:
+            return super().execute()
+        finally:
+            backend._depth -= 1
+
+
+class CountingMemoryBackend(MemoryBackend):
+    """MemoryBackend that counts the commands that would be a round trip to Redis"""
+    def __init__(self):
+        super().__init__()
+        self.round_trips = 0
+        self._depth = 0
+
+    def pipeline(self, transaction = True):
+        return CountingPipeline(self)
+
+def _counted(method):
+    def wrapper(self, *args, **kwargs):
+        #Nested calls, for example incr -> incrby or commands in a pipeline, are not counted
+        if self._depth == 0:
+            self.round_trips += 1
+        self._depth += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._depth -= 1
+    return wrapper
+
+for _name in ['ping', 'get', 'mget', 'set', 'incr', 'incrby', 'delete', 'lrange', 'rpush', 'flushdb',
+              'hget', 'hmget', 'hset', 'hgetall', 'hincrby', 'xadd', 'xrange', 'xrevrange',
+              #Stands in for a server side script, which is one round trip
+              'call']:
+    setattr(CountingMemoryBackend, _name, _counted(getattr(MemoryBackend, _name)))
+
+
+def operations(cfg, tmpdir):
+    """name: function to benchmark"""
+    overlays = [{'type': 'circle', 'xy': [i, i], 'radius': 5, 'ec': 'r', 'fill': False, 'lw': 2} for i in range(500)]
+
+    def write_PI_name():
+        cfg.PI_name = 'Erik'
+
+    def fpath_in_snapshot():
+        with cfg.snapshot():
+            return cfg.fpath
+
+    def write_overlays():
+        cfg.overlays = overlays
+
+    #Directories of the session are created in tmpdir, a new block of file_ids every 100 paths
+    cfg.base_data_dir = tmpdir
+    session = cfg.session(100)
+
+    return {
+        'read PI_name': lambda: cfg.PI_name,
+        'write PI_name': write_PI_name,
+        'read beam_center': lambda: cfg.beam_center,
+        'data_dir': lambda: cfg.data_dir,
+        'fname': lambda: cfg.fname,
+        'fpath': lambda: cfg.fpath,
+        'fpath in snapshot': fpath_in_snapshot,
+        'repr': lambda: repr(cfg),
+        'after_write': cfg.after_write,
+        'reserve_file_ids(10)': lambda: cfg.reserve_file_ids(10),
+        'session next_path': session.next_path,
+        'from_yaml': lambda: cfg.from_yaml(CONFIG),
+        'to_yaml': lambda: cfg.to_yaml(tmpdir / 'config.yaml'),
+        'dump': cfg.dump,
+        'write 500 overlays': write_overlays,
+        'read 500 overlays': lambda: cfg.overlays,
+    }
+
+
+def run(func, n, round_trips):
+    func() #warm up, opens connections and loads scripts
+    times = []
+    start = round_trips()
+    for _ in range(n):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return times, (round_trips() - start) / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=1000, help='Number of repetitions per operation')
+    parser.add_argument('--redis', action='store_true', help='Use the server in EPOC_REDIS_HOST')
+    parser.add_argument('--db', type=int, default=1, help='Redis db to use, its configuration will be overwritten!')
+    parser.add_argument('--instrument', default=None, help='Use the namespaced configuration of this instrument')
+    parser.add_argument('--check', action='store_true', help='Fail if round trips exceed MAX_ROUND_TRIPS')
+    args = parser.parse_args()
+
+    if args.redis:
+        pool = redis.ConnectionPool(host=redis_host(), port=redis_port(), password=auth_token(),
+                                    db=args.db, connection_class=CountingConnection)
+        backend = redis.Redis(connection_pool=pool)
+        round_trips = lambda: CountingConnection.round_trips
+    else:
+        backend = CountingMemoryBackend()
+        round_trips = lambda: backend.round_trips
+
+    cfg = ConfigurationClient(backend = backend, instrument = args.instrument)
+    cfg.from_yaml(CONFIG, flush_db = True)
+
+    print(f'{"operation":<24}{"p50 [us]":>10}{"p90 [us]":>10}{"p99 [us]":>10}{"round trips":>13}')
+    failed = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, func in operations(cfg, Path(tmpdir)).items():
+            times, trips = run(func, args.n, round_trips)
+            p50, p90, p99 = [statistics.quantiles(times, n=100)[i] * 1e6 for i in (49, 89, 98)]
+            print(f'{name:<24}{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}{trips:>13.1f}')
+            if trips > MAX_ROUND_TRIPS[name]:
+                failed.append(name)
+
+    if args.check and failed:
+        print(f'More round trips than expected for: {failed}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
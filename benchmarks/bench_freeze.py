@@ -0,0 +1,64 @@
+"""
+Micro benchmark of attribute assignment on classes decorated with
+epoc.utils.freeze, compared to the previous check with key in dir(self)
+and to a class without freeze.
+
+python benchmarks/bench_freeze.py
+"""
+import argparse
+import timeit
+
+from epoc import ConfigurationClient
+from epoc.backends import MemoryBackend
+from epoc.utils import freeze
+
+
+class Plain:
+    def __init__(self):
+        self.exptime = 1
+
+@freeze
+class Frozen:
+    def __init__(self):
+        self.exptime = 1
+
+@freeze
+class Slotted:
+    __slots__ = ('exptime',)
+    def __init__(self):
+        self.exptime = 1
+
+def dir_setattr(self, key, value):
+    """The check used before, builds and sorts dir(self) on every assignment"""
+    if self._frozen and not key in dir(self):
+        raise AttributeError(f'Cannot set {key}')
+    object.__setattr__(self, key, value)
+
+class DirFrozen(Frozen):
+    __setattr__ = dir_setattr
+
+class DirClient(ConfigurationClient):
+    __setattr__ = dir_setattr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=100000, help='Number of assignments per case')
+    args = parser.parse_args()
+
+    cases = {
+        'plain class': (Plain(), 'exptime'),
+        'freeze': (Frozen(), 'exptime'),
+        'freeze, __slots__': (Slotted(), 'exptime'),
+        'key in dir(self)': (DirFrozen(), 'exptime'),
+        'ConfigurationClient': (ConfigurationClient(backend = MemoryBackend()), '_snapshot'),
+        'ConfigurationClient, dir': (DirClient(backend = MemoryBackend()), '_snapshot'),
+    }
+    print(f'{"case":<28}{"ns per assignment":>18}')
+    for name, (obj, key) in cases.items():
+        t = min(timeit.repeat(lambda: setattr(obj, key, None), number = args.n, repeat = 5))
+        print(f'{name:<28}{t / args.n * 1e9:>18.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Latency that JungfraujochWrapper adds on top of the broker, measured
+against the local MockBroker. For each operation the median and p90 time,
+the time added compared to the simulated broker and the number of status
+requests are reported. The fixed sleep and 0.1 s polling used before are
+shown for comparison. Last the dead time between datasets queued in an
+AcquisitionScheduler, from idle until the next one is running, is reported.
+
+python benchmarks/bench_jungfraujoch.py -n 20 --arm-time 0.05 --cancel-time 0.02
+"""
+import argparse
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from epoc import ConfigurationClient, JungfraujochWrapper
+from epoc.backends import MemoryBackend
+from epoc.mock_broker import MockBroker
+from epoc.scheduler import AcquisitionScheduler
+
+CONFIG = Path(__file__).parent.parent / 'etc' / 'epoc-config.yaml'
+
+
+def fixed_wait(j):
+    """Wait as before: sleep after the request, then poll every 0.1 s"""
+    while j.status().state != 'Idle':
+        time.sleep(0.1)
+
+
+def operations(j, broker, images):
+    """name: (setup, function to time, expected time on the broker)"""
+    measurement = images * j.image_time_us * 1e-6 * broker.time_scale
+
+    def idle():
+        j.cancel()
+        j.wait_until_idle(quiet = True)
+
+    def running():
+        idle()
+        j.start(j._lots_of_images)
+        j.wait_until_started()
+
+    def start_to_running():
+        j.start(j._lots_of_images)
+        assert j.wait_until_started().state == 'Measuring'
+
+    def cancel_to_idle():
+        j.cancel()
+        j.wait_until_idle(quiet = True)
+
+    def start_wait():
+        #Same as start(wait = True) without printing the status
+        j.start(images)
+        j.wait_until_started()
+        j.wait_until_idle(quiet = True)
+
+    def cancel_fixed():
+        j.cancel()
+        fixed_wait(j)
+
+    def start_wait_fixed():
+        j.start(images)
+        time.sleep(0.3)
+        fixed_wait(j)
+
+    return {
+        'start to running': (idle, start_to_running, broker.arm_time),
+        'cancel to idle': (running, cancel_to_idle, broker.cancel_time),
+        f'start {images}, wait': (idle, start_wait, broker.arm_time + measurement),
+        'cancel to idle, fixed': (running, cancel_fixed, broker.cancel_time),
+        f'start {images}, wait, fixed': (idle, start_wait_fixed, broker.arm_time + measurement),
+    }
+
+
+def run(broker, setup, func, n):
+    times = []
+    requests = 0
+    for _ in range(n):
+        setup()
+        before = broker.requests['/status']
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+        requests += broker.requests['/status'] - before
+    return times, requests / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=20, help='Number of repetitions per operation')
+    parser.add_argument('--arm-time', type=float, default=0.05, help='Seconds until the broker is measuring')
+    parser.add_argument('--cancel-time', type=float, default=0.02, help='Seconds from cancel until idle')
+    parser.add_argument('--images', type=int, default=5, help='Images in the measurements with wait')
+    args = parser.parse_args()
+
+    with MockBroker(arm_time = args.arm_time, cancel_time = args.cancel_time) as broker:
+        j = JungfraujochWrapper(broker.url)
+        print(f'{"operation":<28}{"p50 [ms]":>10}{"p90 [ms]":>10}{"added [ms]":>12}{"status requests":>17}')
+        for name, (setup, func, expected) in operations(j, broker, args.images).items():
+            times, requests = run(broker, setup, func, args.n)
+            p50 = statistics.median(times) * 1e3
+            p90 = statistics.quantiles(times, n = 10)[8] * 1e3 if len(times) > 1 else p50
+            print(f'{name:<28}{p50:>10.1f}{p90:>10.1f}{p50 - expected * 1e3:>12.1f}{requests:>17.1f}')
+
+        cfg = ConfigurationClient(backend = MemoryBackend())
+        cfg.from_yaml(CONFIG)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg.base_data_dir = tmpdir
+            scheduler = AcquisitionScheduler(j, cfg, live = False)
+            for _ in range(args.n):
+                scheduler.add(args.images, measurement_tag = 'bench')
+            scheduler.run()
+        dead = [t * 1e3 for t in scheduler.dead_times()]
+        print(f'\nscheduler, {args.n} datasets: dead time p50 {statistics.median(dead):.2f} ms, max {max(dead):.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+import redis
+import redis.asyncio
+import socket
+import yaml
+from pathlib import Path
+from datetime import datetime
+
+from .schema import schema, string_keys, list_keys, derived_keys, encode_all, decode_all, encoding
+from .layout import layout
+from .ConfigurationClient import (ConfigurationClient, auth_token, redis_db, redis_host, redis_port,
+                                  _history_maxlen, _history_checkpoint)
+from . import paths, scripts
+
+# Keys needed to build data_dir, work_dir and fname
+_path_keys = ['base_data_dir', 'experiment_class', 'PI_name', 'project_id', 'measurement_tag', 'file_id']
+
+
+def _require(values, key):
+    if key not in values:
+        raise ValueError(f'{key} not set')
+    return values[key]
+
+def _derived(name, values, now):
+    """Compute the generated value name from decoded values, same as ConfigurationClient"""
+    if name == 'today':
+        return paths.today(now)
+    if name == 'year':
+        return paths.year(now)
+    if name == 'timestamp':
+        return paths.timestamp(now)
+    if name == 'work_dir':
+        return paths.work_dir(_require(values, 'base_data_dir'), _require(values, 'experiment_class'),
+                              _require(values, 'PI_name'), paths.year(now), _require(values, 'project_id'))
+    if name == 'data_dir':
+        return _derived('work_dir', values, now) / paths.today(now)
+    if name == 'fname':
+        if 'measurement_tag' not in values:
+            raise ValueError('fname not set')
+        file_id = values.get('file_id', schema['file_id'].default)
+        return paths.fname(file_id, _require(values, 'project_id'), values['measurement_tag'], paths.timestamp(now))
+    if name == 'fpath':
+        return _derived('data_dir', values, now) / _derived('fname', values, now)
+    if name == 'log_fpath':
+        return _derived('fpath', values, now).with_suffix('.log')
+    raise ValueError(f'Unknown key: {name}')
+
+
+class AsyncConfigurationClient:
+    """
+    asyncio version of ConfigurationClient based on redis.asyncio. Values
+    are read by awaiting the properties and written with set() or update().
+    Connects lazily on the first command, use ping() to check the
+    connection. Unset rotation_speed_idx and file_id return their defaults
+    without writing them to the server. instrument selects a namespaced
+    configuration and history the recording of changes, same as for
+    ConfigurationClient. backend is used instead of connecting to host,
+    for example fakeredis.FakeAsyncRedis() in tests.
+
+    cfg = AsyncConfigurationClient()
+    await cfg.set('PI_name', 'Erik')
+    name = await cfg.PI_name
+    path = await cfg.fpath
+    """
+    def __init__(self, host = None, port = None, token = None, db = None, instrument = None,
+                 history = True, backend = None):
+        self._layout = layout(instrument)
+        if backend is not None:
+            self.client = backend
+        else:
+            #Defaults from the environment, resolved at call time
+            if host is None:
+                host = redis_host()
+            if port is None:
+                port = redis_port()
+            if token is None:
+                token = auth_token()
+            if db is None:
+                db = redis_db()
+            #Connection pools of redis.asyncio are bound to an event loop and can
+            #not be shared process wide like for ConfigurationClient
+            self.client = redis.asyncio.Redis(host=host, port=port, password=token, db=db)
+        self._history = history
+        self._host = socket.gethostname()
+        self._write_script = self.client.register_script(scripts.write_lua)
+        self._reserve_script = self.client.register_script(scripts.reserve_file_ids_lua)
+        #Loaded with SCRIPT LOAD before the first update, see ConfigurationClient._queue_script
+        self._scripts_loaded = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def ping(self):
+        try:
+            await self.client.ping()
+        except redis.exceptions.ConnectionError:
+            kwargs = self.client.connection_pool.connection_kwargs
+            raise ValueError(f"Could not connect to server: {kwargs['host']}:{kwargs['port']}")
+
+    async def _fetch(self, keys):
+        """Raw values of keys in one round trip"""
+        keys = list(keys)
+        values = [key for key in keys if key not in list_keys]
+        lists = [key for key in keys if key in list_keys]
+        pipe = self.client.pipeline(transaction=True)
+        if values:
+            self._layout.mget(pipe, values)
+        for key in lists:
+            pipe.lrange(self._layout.redis_key(key), 0, -1)
+        res = await pipe.execute()
+        if values:
+            raw = dict(zip(values, res[0]))
+            res = res[1:]
+        else:
+            raw = {}
+        raw.update(zip(lists, res))
+        return raw
+
+    async def _values(self, keys):
+        """Decoded values of keys that are set or have a default"""
+        return decode_all(await self._fetch(keys), skip_unset = True)
+
+    async def get(self, key):
+        if key in derived_keys:
+            return _derived(key, await self._values(_path_keys), datetime.now())
+        if key not in schema:
+            raise ValueError(f'Unknown key: {key}')
+        if key in list_keys:
+            raw = await self.client.lrange(self._layout.redis_key(key), 0, -1)
+        else:
+            raw = await self._layout.get(self.client, key)
+        return schema[key].from_raw(raw)
+
+    async def get_many(self, keys) -> dict:
+        """
+        Read several keys in one round trip. Raises ValueError if one of
+        them is not set, same as get()
+        """
+        for key in keys:
+            if key not in schema:
+                raise ValueError(f'Unknown key: {key}')
+        return decode_all(await self._fetch(keys))
+
+    async def set(self, key, value):
+        await self.update({key: value})
+
+    async def update(self, values : dict, flush_db = False):
+        """
+        Validate all values and write them in one MULTI/EXEC round trip.
+        Nothing is written if one of the values is invalid.
+        """
+        await self._update(encode_all(values), flush_db)
+
+    async def _update(self, encoded, flush_db):
+        """Write values already checked by encode_all"""
+        pipe = self.client.pipeline(transaction=True)
+        if flush_db:
+            await self._write(pipe, 'clear', '')
+        for key, value in encoded.items():
+            if key in list_keys:
+                await self._write(pipe, 'list', key, *value)
+            else:
+                await self._write(pipe, 'set', key, value)
+        commands = list(pipe.command_stack)
+        try:
+            await pipe.execute()
+        except redis.exceptions.NoScriptError:
+            #The server lost the scripts, none of the writes was applied
+            await self._load_scripts()
+            for args, options in commands:
+                pipe.execute_command(*args, **options)
+            await pipe.execute()
+
+    async def _load_scripts(self):
+        for script in (self._write_script, self._reserve_script):
+            await self.client.script_load(script.script)
+        self._scripts_loaded = True
+
+    def _script_args(self):
+        """Arguments that start the ARGV of every script, see epoc.scripts"""
+        return [self._layout.hash or '', self._layout.history_key() if self._history else '',
+                self._host, _history_maxlen, _history_checkpoint]
+
+    async def _write(self, client, op, key, *values):
+        """Write with op of scripts.write_lua, queued if client is a pipeline"""
+        keys = [self._layout.redis_key(key)] if key else self._layout.redis_keys()
+        args = self._script_args() + [op, key, *values]
+        if client is not self.client:
+            #Plain EVALSHA, a Script would add a SCRIPT EXISTS round trip to execute()
+            if not self._scripts_loaded:
+                await self._load_scripts()
+            return client.evalsha(self._write_script.sha, len(keys), *keys, *args)
+        try:
+            return await self._write_script(keys = keys, args = args, client = client)
+        except redis.exceptions.ResponseError as e:
+            raise ValueError(str(e))
+
+    async def from_yaml(self, path: Path, flush_db = False):
+        """
+        Return to a know state, or populate a new database
+        args: path to the yaml file flush: if True, clear the configuration before loading
+        """
+        with open(path, 'r') as file:
+            res = yaml.safe_load(file)
+
+        #Validate everything before touching the server
+        try:
+            values = encode_all(res)
+        except ValueError as e:
+            raise ValueError(f'{path}: {e}')
+        await self._update(values, flush_db)
+
+    async def dump(self, derived = True) -> dict:
+        """
+        Return the configuration as a plain dict, read in one round trip.
+        Keys that are not set are left out, unless they have a default, and
+        paths are converted to str.
+        """
+        values = await self._values(string_keys + list_keys)
+        res = dict(values)
+        if derived:
+            now = datetime.now()
+            for key in derived_keys:
+                try:
+                    res[key] = _derived(key, values, now)
+                except ValueError:
+                    pass
+        return {key: value.as_posix() if isinstance(value, Path) else value for key, value in res.items()}
+
+    async def to_yaml(self, path: Path):
+        """
+        Save the current configuration to a yaml file
+        """
+        ConfigurationClient._write_yaml(path, await self.dump())
+
+    async def after_write(self) -> Path:
+        """
+        Call after finished an acquisition to update the configuration.
+        Records last_dataset and increments file_id atomically
+        """
+        res = await self._reserve_file_ids(1, record_last = True)
+        return res[0]
+
+    async def reserve_file_ids(self, n : int) -> list[Path]:
+        """
+        Atomically reserve the next n file_ids and return the dataset paths
+        """
+        n = int(n)
+        if n < 1:
+            raise ValueError(f'Number of file_ids to reserve must be positive. Got: {n}')
+        return await self._reserve_file_ids(n, record_last = False)
+
+    async def _reserve_file_ids(self, n, record_last):
+        try:
+            res = await self._reserve_script(keys = self._layout.script_keys(scripts.reserve_file_ids_keys),
+                                             args = self._script_args() + scripts.reserve_file_ids_args(n, record_last))
+        except redis.exceptions.ResponseError as e:
+            raise ValueError(str(e))
+        return [Path(p.decode(encoding)) for p in res[1:]]
+
+    async def add_overlay(self, value):
+        if not isinstance(value, str):
+            value = schema['overlays'].encode(value)
+        await self._write(self.client, 'append', 'overlays', value)
+
+
+def _awaitable_property(key):
+    def getter(self):
+        return self.get(key)
+    return property(getter, doc=f'Awaitable value of {key}')
+
+for _key in list(schema) + derived_keys:
+    setattr(AsyncConfigurationClient, _key, _awaitable_property(_key))
@@ -0,0 +1,129 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from rich import print
+
+from .JungfraujochWrapper import JungfraujochWrapper, _started, _idle, _printer, _run_key, _calibration_key
+from . import polling, progress
+
+
+class AsyncJungfraujochWrapper:
+    """
+    asyncio version of JungfraujochWrapper. The blocking jfjoch_client calls
+    run on a pool of max_workers threads, so detector and statistics requests
+    can overlap without blocking the event loop. Waiting polls from the event
+    loop and sleeps with asyncio.sleep.
+
+    async with AsyncJungfraujochWrapper('http://localhost:5232') as j:
+        await j.start(1000, fname = 'test', wait = True)
+        status, stats = await asyncio.gather(j.status(), j.statistics_data_collection())
+    """
+    def __init__(self, host, max_workers = 4, store = None):
+        if max_workers < 1:
+            raise ValueError(f'max_workers must be positive. Got: {max_workers}')
+        self.wrapper = JungfraujochWrapper(host, store = store)
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix = 'jfjoch')
+
+    def __repr__(self):
+        return f'AsyncJungfraujochWrapper({self.wrapper.configuration.host})'
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Stop the worker threads once the running requests are done"""
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    @property
+    def image_time_us(self) -> int:
+        """Total image time in microseconds"""
+        return self.wrapper.image_time_us
+
+    @image_time_us.setter
+    def image_time_us(self, value : int):
+        self.wrapper.image_time_us = value
+
+    async def cancel(self) -> None:
+        """Cancel the current data collection"""
+        await self._call(self.wrapper.cancel)
+
+    async def init(self) -> None:
+        """Initialize Jungfraujoch. Run once after startup or when restarting the broker"""
+        await self._call(self.wrapper.init)
+
+    async def status(self):
+        return await self._call(self.wrapper.status)
+
+    async def statistics_calibration(self):
+        return await self._call(self.wrapper.api_instance.statistics_calibration_get)
+
+    async def statistics_data_collection(self):
+        return await self._call(self.wrapper.api_instance.statistics_data_collection_get)
+
+    async def start(self, n_images : int, fname = "", wait = False, timeout = None, **kwargs) -> None:
+        """
+        Start a measurement, same arguments as JungfraujochWrapper.start.
+        If wait is True, return when the measurement is finished
+        """
+        before = await self.last_run() if wait else None
+        await self._call(self.wrapper.start, n_images, fname = fname, **kwargs)
+        if wait:
+            await self.wait_until_started(before = before)
+            await self.wait_until_idle(timeout = timeout)
+
+    async def collect_pedestal(self, wait = False, timeout = None):
+        """Start pedestal collection, if wait is True print and record the statistics when finished"""
+        before = await self.last_run(pedestal = True) if wait else None
+        await self._call(self.wrapper.api_instance.pedestal_post)
+        if wait:
+            await self.wait_until_started(before = before, pedestal = True)
+            await self.wait_until_idle(timeout = timeout)
+            stat = await self.statistics_calibration()
+            print(stat)
+            if self.wrapper.store is not None:
+                await self._call(self.wrapper.store.record_calibration, stat)
+
+    async def last_run(self, pedestal = False):
+        """Identifies the last run that is over, see JungfraujochWrapper.last_run"""
+        if pedestal:
+            return _calibration_key(await self.statistics_calibration())
+        return _run_key(await self.statistics_data_collection())
+
+    async def wait_until_started(self, timeout = None, before = None, pedestal = False):
+        """Wait until the broker has left Idle, see JungfraujochWrapper.wait_until_started"""
+        timeout = self.wrapper._start_timeout if timeout is None else timeout
+        over = []
+        async def poll():
+            s = await self.status()
+            if before is not None and s.state == 'Idle' and await self.last_run(pedestal) != before:
+                over.append(s)
+            return s
+        try:
+            return await polling.async_wait(poll, lambda s: bool(over) or _started(s), timeout = timeout)
+        except TimeoutError:
+            return await self.status()
+
+    async def wait_until_idle(self, progress = False, timeout = None, quiet = False):
+        """Wait until the Jungfraujoch is idle, see JungfraujochWrapper.wait_until_idle"""
+        s = await polling.async_wait(self.status, _idle, timeout = timeout,
+                                     on_status = _printer(progress, quiet))
+        if progress:
+            print(f'Progress: {100:.0f}%')
+        return s
+
+    def progress_samples(self, interval = 0.2, until_idle = True, **kwargs):
+        """Async iterator of ProgressSample, see JungfraujochWrapper.progress_samples"""
+        return progress.async_samples(self.status, self.statistics_data_collection,
+                                      interval, until_idle, **kwargs)
+
+    async def live(self) -> None:
+        """Start live mode, many images that are not saved"""
+        await self.start(self.wrapper._lots_of_images)
@@ -1,13 +1,26 @@
 import os
 import inspect
 import redis
+import socket
+import threading
 import yaml
 import json
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 
 from .utils import freeze
-from .string_op import sanitize_label
+from .schema import schema, string_keys, list_keys, derived_keys, encode_all, decode_all
+from .schema import encoding, experiment_classes, default_rotation_speed_idx
+from .cache import PropertyCache
+from .watch import Watcher
+from .stats import ClientStats, InstrumentedBackend, code_names, stored_property
+from .layout import layout, FlatLayout
+from .offline import LocalSnapshot
+from .session import AcquisitionSession
+from . import history as _history
+from . import paths
+from . import scripts
 
 def auth_token():
     """
@@ -40,252 +53,620 @@ def redis_db():
     return int(db)
 
 
+_pools = {}
+_pools_lock = threading.Lock()
+
+def connection_pool(host, port, token, db) -> redis.ConnectionPool:
+    """
+    Process wide connection pool shared by all clients talking to the
+    same server and db. Connections are only opened when first used.
+    """
+    key = (host, port, token, db)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = redis.ConnectionPool(host=host, port=port, password=token, db=db)
+        return _pools[key]
+
+
+# Approximate number of entries kept in the history stream and how often a
+# checkpoint with all values is written, see epoc.history
+_history_maxlen = 10000
+_history_checkpoint = 100
+
+# Seconds between attempts to reach the server while offline
+_reconnect_interval = 5
+
+
 @freeze
 class ConfigurationClient:
     """
     Provides synchronization between PCs and persistent storage of values
-    Currently based on Redis but could be extended to other backends
+    Based on Redis, see epoc.backends for in-process and file based stand-ins
+    Properties of the stored keys are generated from epoc.schema
     """
-    _experiment_classes = ['UniVie', 'External', 'IP']
-    _encoding = 'utf-8'
-    _default_rotation_speed_idx = 2
-    def __init__(self, host = None, port=redis_port(), token=auth_token(), db = redis_db()):
-
-        #Avoid placing in constructor due to import error
-        if host is None:
-            host = redis_host()
-        
-
-        self.client = redis.Redis(host=host, port=port, password=token, db=db)
+    _experiment_classes = experiment_classes
+    _encoding = encoding
+    _default_rotation_speed_idx = default_rotation_speed_idx
+
+    # Keys stored as plain strings, fetched together by snapshot()
+    _keys = string_keys
+    # Keys stored as lists
+    _list_keys = list_keys
+
+    def __init__(self, host = None, port = None, token = None, db = None,
+                 cache = False, cache_size = 128, ping = True, backend = None, stats = False,
+                 instrument = None, history = True, local_cache = None):
+        """
+        host, port, token, db: if None, read from the EPOC_REDIS_* environment
+        variables when the client is created
+        backend: use instead of a Redis server, for example MemoryBackend() or
+        FileBackend(path) from epoc.backends
+        cache: if True, keep a local copy of values read from the server. Entries
+        are invalidated by keyspace notifications so remote changes show up
+        within milliseconds. See ConfigurationClient.cache for hit/miss counters.
+        If the client starts offline the cache is started once the server answers
+        ping: if False, do not check the connection here but on first use
+        stats: if True, count and time every request to the backend per key and
+        per property, see ConfigurationClient.stats. Off by default since it
+        inspects the call stack on every request
+        instrument: if given, use the configuration of this instrument, stored in
+        the hash epoc:<instrument>. Otherwise one configuration per db in plain keys
+        history: if True, record every write in the stream epoc:history, or
+        epoc:<instrument>:history, in the same round trip as the write. The
+        stream is capped at about 10000 entries. False turns recording off for
+        this client. See history(), as_of() and as_of_file_id()
+        local_cache: path of a json file with the last known good configuration,
+        refreshed by snapshots and writes. If the server can not be reached the
+        client starts from it, or switches to it, in read only mode and goes back
+        online once the server answers again. See ConfigurationClient.offline
+        """
+        #Raises ValueError for invalid names before connecting
+        self._layout = layout(instrument)
+
+        #Raw values from local_cache, None if there is no copy yet
+        self._local_cache = LocalSnapshot(local_cache, instrument) if local_cache is not None else None
+        self._local = self._local_cache.load() if self._local_cache is not None else None
+        self._offline = False
+        self._closed = threading.Event()
+
+        if backend is not None:
+            self.client = backend
+        else:
+            #Avoid placing in constructor due to import error
+            if host is None:
+                host = redis_host()
+            if port is None:
+                port = redis_port()
+            if token is None:
+                token = auth_token()
+            if db is None:
+                db = redis_db()
+            self.client = redis.Redis(connection_pool=connection_pool(host, port, token, db))
+            if ping:
+                try:
+                    self.client.ping()
+                except redis.exceptions.ConnectionError:
+                    if not self._go_offline():
+                        raise ValueError(f'Could not connect to server: {host}:{port}')
+
+        #Local copy of all keys while inside snapshot(), otherwise None
+        self._snapshot = None
+        #Pipeline and local updates queued inside transaction(), otherwise None
+        self._pipe = None
+        self._pending = None
+
+        #Notifications and scripting are only available with a Redis server
+        self._is_redis = isinstance(self.client, redis.Redis)
+        if cache and not self._is_redis:
+            raise ValueError('The client side cache requires a Redis server')
+        #Without a server the cache is created once it answers again, see _reconnect
+        self.cache = None
+        self._cache_args = (self.client, cache_size) if cache else None
+        if cache and not self._offline:
+            try:
+                self.cache = PropertyCache(self.client, cache_size)
+            except redis.exceptions.ConnectionError:
+                if not self._go_offline():
+                    raise
+
+        self.stats = None
+        if stats:
+            self.stats = ClientStats()
+            self.client = InstrumentedBackend(self.client, self.stats, _code_names)
+
+        #All writes go through the scripts in epoc.scripts, which also record the history
+        self._history_key = self._layout.history_key() if history else None
+        self._host = socket.gethostname()
+        self._write_script = None
+        self._reserve_script = None
+        #Loaded with SCRIPT LOAD before the first transaction, see _queue_script
+        self._scripts_loaded = False
+        if self._is_redis:
+            self._write_script = self.client.register_script(scripts.write_lua)
+            self._reserve_script = self.client.register_script(scripts.reserve_file_ids_lua)
+
+    @property
+    def instrument(self) -> str | None:
+        """Name of the namespaced configuration, None for plain keys"""
+        return self._layout.instrument
+
+    @property
+    def offline(self) -> bool:
+        """True while values are read from local_cache since the server can not be reached"""
+        return self._offline
+
+    def close(self):
+        """Stop background threads used by the client side cache and while offline"""
+        self._closed.set()
+        if self.cache is not None:
+            self.cache.close()
+
+    def _go_offline(self) -> bool:
+        """
+        Serve reads from the local copy until the server answers again.
+        Returns False if there is no local copy
+        """
+        if self._local is None:
+            return False
+        if not self._offline:
+            self._offline = True
+            threading.Thread(target=self._reconnect, daemon=True).start()
+        return True
+
+    def _reconnect(self):
+        while not self._closed.wait(_reconnect_interval):
+            try:
+                raw = self._fetch(self._layout)[0]
+                if self._cache_args is not None and self.cache is None:
+                    self.cache = PropertyCache(*self._cache_args)
+            #Also timeouts and error replies, ValueError if the
+            #cache subscription is not confirmed
+            except (redis.exceptions.RedisError, ValueError):
+                continue
+            #Values changed while offline are taken from the server
+            self._save_local(raw)
+            self._offline = False
+            return
+
+    def _save_local(self, raw):
+        #Only written when something changed, snapshots are frequent
+        if self._local_cache is not None and raw != self._local:
+            self._local = dict(raw)
+            self._local_cache.save(self._local)
+
+    def _first_local(self):
+        """Written before any snapshot, start the local copy with all values"""
         try:
-            self.client.ping()
+            self._save_local(self._fetch(self._layout)[0])
         except redis.exceptions.ConnectionError:
-            raise ValueError(f'Could not connect to server: {host}:{port}')
+            pass
+
+    def _load(self) -> dict:
+        """Raw values of all keys in one round trip, from local_cache while offline"""
+        if not self._offline:
+            try:
+                raw = self._fetch(self._layout)[0]
+            except redis.exceptions.ConnectionError:
+                if not self._go_offline():
+                    raise
+            else:
+                self._save_local(raw)
+                return raw
+        return dict(self._local)
+
+    def _get(self, key):
+        if self._snapshot is not None:
+            return self._snapshot[key]
+        if self._offline:
+            return self._local[key]
+        try:
+            if self.cache is not None:
+                return self._layout.get_cached(self.cache, self.client, key)
+            return self._layout.get(self.client, key)
+        except redis.exceptions.ConnectionError:
+            if not self._go_offline():
+                raise
+            return self._local[key]
+
+    def _get_list(self, key):
+        if self._snapshot is not None:
+            return self._snapshot[key]
+        if self._offline:
+            return self._local[key]
+        name = self._layout.redis_key(key)
+        try:
+            if self.cache is not None:
+                return self.cache.fetch(name, self._lrange)
+            return self._lrange(name)
+        except redis.exceptions.ConnectionError:
+            if not self._go_offline():
+                raise
+            return self._local[key]
 
+    def _lrange(self, name):
+        return self.client.lrange(name, 0, -1)
 
-    def from_yaml(self, path: Path, flush_db = False):
+    def _writer(self):
+        return self._pipe if self._pipe is not None else self.client
+
+    def _script_args(self, target):
+        """Arguments that start the ARGV of every script, see epoc.scripts"""
+        return [target.hash or '', target.history_key() if self._history_key else '',
+                self._host, _history_maxlen, _history_checkpoint]
+
+    def _run(self, script, func, keys, args, client = None):
         """
-        Return to a know state, or populate a new database
-        args: path to the yaml file flush: if True, clear the database before loading
+        Run a script from epoc.scripts, or its Python version on backends
+        without scripting. Queued if client is a pipeline
         """
-        if flush_db:
-            self.client.flushdb()
-        with open(path, 'r') as file:
-            res = yaml.safe_load(file)
-        for key, value in res.items():
-            setattr(self, key, value)
+        if self._offline:
+            raise ValueError('The server can not be reached, the configuration is read only')
+        if client is None:
+            client = self.client
+        if args[1]:
+            keys = keys + [args[1]]
+        if script is None:
+            return client.call(func, keys, args)
+        if client is not self.client:
+            return self._queue_script(client, script, keys, args)
+        try:
+            return script(keys = keys, args = args, client = client)
+        except redis.exceptions.ResponseError as e:
+            raise ValueError(str(e))
 
-    def to_yaml(self, path: Path):
+    def _load_scripts(self):
+        for script in (self._write_script, self._reserve_script):
+            self.client.script_load(script.script)
+        self._scripts_loaded = True
+
+    def _queue_script(self, pipe, script, keys, args):
         """
-        Save the current configuration to a yaml file
+        Queue a plain EVALSHA. Passing the pipeline to a Script would make
+        execute() check the script cache with SCRIPT EXISTS, one more round trip
         """
-        res = {}
-        non_writable = {}
-        #Find the keys
-        for key, item in vars(ConfigurationClient).items():
-            if isinstance(item, property):
-                # It could be that some values are not set
-                # and in this case we ignore them
-                try:
-                    value = getattr(self, key)
-                    if isinstance(value, Path):
-                        value = value.as_posix()
-                    if item.fset is None:
-                        non_writable[key] = value
-                    else:
-                        res[key] = value
-                except ValueError:
-                    pass
-                
-        with open(path, 'w') as file:
-            file.write('# Configuration file for EPOC\n')
-            file.write(f'# Saved: {datetime.now()}\n\n')
-            file.write('# Generated value at time of saving\n')
-            for key, value in non_writable.items():
-                file.write(f'# {key}: {value}\n')
-            file.write('\n')
-            yaml.safe_dump(res, file, sort_keys=False)
+        if not self._scripts_loaded:
+            self._load_scripts()
+        return pipe.evalsha(script.sha, len(keys), *keys, *args)
+
+    def _execute(self, pipe):
+        """Execute a transaction, send it again if the server lost the scripts"""
+        #Backends without scripting have no EVALSHA to send again
+        commands = [c for c in getattr(pipe, 'command_stack', []) if c[0][0] == 'EVALSHA']
+        try:
+            return pipe.execute()
+        except redis.exceptions.NoScriptError:
+            #After a restart or SCRIPT FLUSH every EVALSHA failed, and only
+            #those, so nothing of the configuration was written yet
+            self._load_scripts()
+            for args, options in commands:
+                pipe.execute_command(*args, **options)
+            return pipe.execute()
+
+    def _write(self, op, key, *values, target = None, client = None):
+        """Write with op of scripts.write_lua, inside a transaction it is queued"""
+        target = target or self._layout
+        keys = [target.redis_key(key)] if key else target.redis_keys()
+        args = self._script_args(target) + [op, key, *values]
+        return self._run(self._write_script, scripts.write, keys, args, client or self._writer())
+
+    def _set(self, key, value):
+        self._write('set', key, value)
+        self._written(key, self.client.get_encoder().encode(value))
+
+    def _set_list(self, key, items):
+        #Replace the whole list in one round trip
+        self._write('list', key, *items)
+        encoder = self.client.get_encoder()
+        self._written(key, [encoder.encode(item) for item in items])
+
+    def _store(self, key, value):
+        """Write an encoded value from schema.Key.to_raw"""
+        if schema[key].is_list:
+            self._set_list(key, value)
+        else:
+            self._set(key, value)
+
+    def _written(self, key, raw, save = True):
+        """
+        Update local copies after raw was written to key. Inside a
+        transaction this is deferred until the transaction is executed
+        """
+        if self._pending is not None:
+            self._pending.append((key, raw))
+            return
+        # Don't wait for the notification of our own writes
+        if self.cache is not None:
+            self.cache.invalidate(self._layout.redis_key(key))
+        if self._snapshot is not None:
+            self._snapshot[key] = raw
+        if self._local is None and self._local_cache is not None and save:
+            self._first_local()
+        #For lists None means that the new value is not known here
+        elif self._local is not None and (raw is not None or not schema[key].is_list):
+            self._local[key] = raw
+            if save:
+                self._local_cache.save(self._local)
+
+    def watch(self, keys, callback = None, initial = False) -> Watcher:
+        """
+        Get notified when keys change, instead of polling. callback(key, value)
+        is called from a background thread with the decoded value, None if
+        the key was deleted. Without callback, iterate over the returned
+        Watcher to get (key, value) pairs. Call stop() when done.
 
-    @property
-    def PI_name(self) -> str:
-        res = self.client.get('PI_name')
-        if res is None:
-            raise ValueError('PI_name not set')
-        return res.decode(ConfigurationClient._encoding)
-    
-    @PI_name.setter
-    def PI_name(self, value : str):
-        value = sanitize_label(value)
-        self.client.set('PI_name', value)
+        w = cfg.watch(['overlays', 'beam_center'], lambda key, value: print(key, value))
 
-    @property
-    def project_id(self) -> str:
-        res = self.client.get('project_id')
-        if res is None:
-            raise ValueError('project_id not set')
-        return res.decode(ConfigurationClient._encoding)
+        with cfg.watch('last_dataset') as w:
+            for key, path in w:
+                process(path)
+        """
+        if not self._is_redis:
+            raise ValueError('Watching keys requires a Redis server')
+        if isinstance(keys, str):
+            keys = [keys]
+        for key in keys:
+            if key not in ConfigurationClient._keys + ConfigurationClient._list_keys:
+                raise ValueError(f'Cannot watch {key}. Possible keys are: {ConfigurationClient._keys + ConfigurationClient._list_keys}')
+
+        #Separate client so that reads are not affected by snapshots or transactions
+        kwargs = self.client.connection_pool.connection_kwargs
+        reader = ConfigurationClient(kwargs['host'], kwargs['port'], kwargs.get('password'), kwargs['db'],
+                                     ping = False, instrument = self.instrument)
+        return Watcher(reader, keys, callback, initial)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Queue all writes made by setters inside the block and apply them
+        in one MULTI/EXEC round trip when it exits. If a setter raises,
+        nothing is written. Reads still go to the server.
 
-    @project_id.setter
-    def project_id(self, value : str):
-        value = sanitize_label(value)
-        self.client.set('project_id', value)
+        with cfg.transaction():
+            cfg.PI_name = 'Erik'
+            cfg.project_id = 'epoc'
+        """
+        if self._pipe is not None:
+            #Already inside a transaction, join it
+            yield self._pipe
+            return
+
+        pipe = self.client.pipeline(transaction=True)
+        self._pipe = pipe
+        self._pending = []
+        try:
+            yield pipe
+            self._execute(pipe)
+        finally:
+            pending = self._pending
+            self._pipe = None
+            self._pending = None
+        for key, raw in pending:
+            self._written(key, raw, save = False)
+        if self._local_cache is not None and pending:
+            if self._local is None:
+                self._first_local()
+            else:
+                self._local_cache.save(self._local)
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Load all keys in a single round trip and serve every property from
+        that consistent copy until the block exits. Setters still write
+        through to the server and update the local copy.
 
-    @property
-    def last_dataset(self) -> Path | None:
+        with cfg.snapshot():
+            path = cfg.fpath
         """
-        Path to the last dataset that was recorded.
-        Can be used to trigger processing
+        if self._snapshot is not None:
+            #Already inside a snapshot, reuse it
+            yield self
+            return
+
+        self._snapshot = self._load()
+        try:
+            yield self
+        finally:
+            self._snapshot = None
+
+    def _fetch(self, *layouts) -> list[dict]:
+        """Raw values of all keys in each of layouts, read in one round trip"""
+        pipe = self.client.pipeline(transaction=True)
+        for item in layouts:
+            item.queue_fetch(pipe)
+            for key in list_keys:
+                pipe.lrange(item.redis_key(key), 0, -1)
+        res = pipe.execute()
+
+        n = 1 + len(list_keys)
+        values = []
+        for i, item in enumerate(layouts):
+            raw = item.parse_fetch(res[i*n])
+            raw.update(zip(list_keys, res[i*n + 1:(i + 1)*n]))
+            values.append(raw)
+        return values
+
+    def _copy(self, source, target, delete_source = False) -> dict:
         """
-        res = self.client.get('last_dataset')
-        if res is None:
-            return None
-        return Path(res.decode(ConfigurationClient._encoding))
-    
-    @last_dataset.setter
-    def last_dataset(self, value : Path | str):
-        if isinstance(value, Path):
-            value = value.as_posix()
-        self.client.set('last_dataset', value)
+        Replace the configuration in target with the one in source. Reads
+        one snapshot and writes it in one transaction. Returns the raw values
+        """
+        if source.redis_keys() == target.redis_keys():
+            raise ValueError('Source and target of the copy are the same')
+        raw = self._fetch(source)[0]
+        pipe = self.client.pipeline(transaction=True)
+        self._write('clear', '', target = target, client = pipe)
+        for key, value in raw.items():
+            if schema[key].is_list:
+                if value:
+                    self._write('list', key, *value, target = target, client = pipe)
+            elif value is not None:
+                self._write('set', key, value, target = target, client = pipe)
+        if delete_source:
+            self._write('clear', '', target = source, client = pipe)
+        self._execute(pipe)
+        return raw
+
+    def copy_to(self, instrument : str | None):
+        """
+        Copy this configuration to instrument, replacing all its values.
+        None copies to the plain keys used without instrument
+        """
+        self._copy(self._layout, layout(instrument))
 
-    @property
-    def XDS_template(self) -> Path:
-        res = self.client.get('XDS_template')
-        if res is None:
-            raise ValueError('XDS_template not set')
-        return Path(res.decode(ConfigurationClient._encoding))
-    
-    @XDS_template.setter
-    def XDS_template(self, value : Path | str):
-        if isinstance(value, Path):
-            value = value.as_posix()
-        self.client.set('XDS_template', value)
-    
-    @property
-    def rotation_speed_idx(self) -> int:
-        res = self.client.get('rotation_speed_idx')
-        #If the value was not set then go to the default (2==1deg/s)
-        if res is None:
-            self.rotation_speed_idx = ConfigurationClient._default_rotation_speed_idx
-            res = self.client.get('rotation_speed_idx')
-        return int(res)
-    
-    @rotation_speed_idx.setter
-    def rotation_speed_idx(self, value : int):
-        value = int(value)
-        if value not in [0, 1, 2, 3]:
-            raise ValueError('Invalid rotation speed. Possible values are 0, 1, 2, 3')
-        self.client.set('rotation_speed_idx', value)
+    def migrate_flat_keys(self, delete = False):
+        """
+        Move a configuration from plain keys (PI_name, overlays...), the
+        layout used before instruments, into the hash of this instrument.
+        delete: also remove the plain keys, in the same transaction
+        """
+        if self.instrument is None:
+            raise ValueError('Migration needs a client with an instrument')
+        raw = self._copy(FlatLayout(), self._layout, delete_source = delete)
+        for key, value in raw.items():
+            self._written(key, value)
 
-    @property
-    def file_id(self):
+    def compare(self, instrument : str | None) -> dict:
         """
-        Unique identifier for the current dataset
+        Differences to the configuration of instrument, None for the plain
+        keys, read in one round trip. Returns {key: (this value, other value)}
+        with None for keys that are not set
         """
-        res = self.client.get('file_id')
+        mine, other = [decode_all(raw, skip_unset = True) for raw in self._fetch(self._layout, layout(instrument))]
+        res = {}
+        for key in schema:
+            if mine.get(key) != other.get(key):
+                res[key] = (mine.get(key), other.get(key))
+        return res
 
-        #if not set we set it to 0
-        if res is None:
-            self.client.set('file_id', 0)
-            return 0
-        return int(res)
-    
-    @file_id.setter
-    def file_id(self, value):
-        self.client.set('file_id', value)
+    def _history_stream(self):
+        if self._history_key is None:
+            raise ValueError('History is not recorded, create the client with history = True')
+        return self._history_key
 
-    @property
-    def nrows(self):
-        res = self.client.get('nrows')
-        if res is None:
-            raise ValueError('nrows not set')
-        return int(res)
-    
-    @property
-    def beam_center(self):
-        res = self.client.get('beam_center')
-        if res is None:
-            raise ValueError('beam_center not set')
-        return json.loads(res.decode(ConfigurationClient._encoding))
-    
-    @beam_center.setter
-    def beam_center(self, value):
-        self.client.set('beam_center', json.dumps(value))
+    def history(self, count = 100) -> list[dict]:
+        """
+        The last count changes, oldest first, as dicts with time, op, key,
+        old, new and host. Values are decoded, None if the key was not set
+        """
+        res = []
+        for entry in _history.latest(self.client, self._history_stream(), count):
+            key = schema[entry['key']]
+            old, new = [None if value is None else key.from_raw(_history.raw_value(key.name, value))
+                        for value in (entry.get('old'), entry.get('new'))]
+            res.append({'time': _history.entry_time(entry), 'op': entry['op'], 'key': key.name,
+                        'old': old, 'new': new, 'host': entry.get('host')})
+        return res
+
+    def _state(self, end, after) -> dict:
+        raw = _history.state(self.client, self._history_stream(), end, after,
+                             lambda: self._fetch(self._layout)[0])
+        return decode_all(raw, skip_unset = True)
+
+    def as_of(self, when : datetime) -> dict:
+        """
+        The configuration at the time when, rebuilt from the history.
+        Keys that were not set are left out
+        """
+        ms = _history.time_id(when)
+        return self._state(str(ms), str(ms + 1))
 
-    @property
-    def threshold(self) -> int:
-        """Threshold that is applied after conversion but before summing of images."""
-        res = self.client.get('threshold')
-        if res is None:
-            raise ValueError('threshold not set')
-        return int(res)
-    
-    @threshold.setter
-    def threshold(self, value) -> None:
-        self.client.set('threshold', value)
+    def as_of_file_id(self, file_id : int) -> dict:
+        """
+        The configuration when the dataset with file_id was recorded, just
+        before file_id was used by after_write or reserve_file_ids
+        """
+        entry_id = _history.find_file_id(self.client, self._history_stream(), int(file_id))
+        if entry_id is None:
+            raise ValueError(f'file_id {file_id} not found in the history')
+        return self._state('(' + entry_id, entry_id)
 
-    @property
-    def viewer_interval(self):
-        res = self.client.get('viewer_interval')
-        if res is None:
-            raise ValueError('viewer_interval not set')
-        return float(res)
-    
-    @property
-    def viewer_cmin(self):
-        res = self.client.get('viewer_cmin')
-        if res is None:
-            raise ValueError('viewer_cmin not set')
-        return float(res)
-    
-    @viewer_cmin.setter
-    def viewer_cmin(self, value):
-        self.client.set('viewer_cmin', value)
+    def from_yaml(self, path: Path, flush_db = False):
+        """
+        Return to a know state, or populate a new database
+        args: path to the yaml file flush: if True, clear the configuration before
+        loading. Other keys in the database and the history are kept
+        """
+        with open(path, 'r') as file:
+            res = yaml.safe_load(file)
 
-    @property
-    def viewer_cmax(self):
-        res = self.client.get('viewer_cmax')
-        if res is None:
-            raise ValueError('viewer_cmax not set')
-        return float(res)
-    
-    @viewer_cmax.setter
-    def viewer_cmax(self, value):
-        self.client.set('viewer_cmax', value)
+        #Validate everything before touching the server
+        try:
+            values = encode_all(res)
+        except ValueError as e:
+            raise ValueError(f'{path}: {e}')
+
+        #The whole file is applied atomically
+        with self.transaction():
+            if flush_db:
+                self._write('clear', '')
+                #Only the configuration keys are removed, the history is kept
+                for key in ConfigurationClient._keys:
+                    self._written(key, None)
+                for key in ConfigurationClient._list_keys:
+                    self._written(key, [])
+            for key, value in values.items():
+                self._store(key, value)
+
+    def dump(self, derived = True) -> dict:
+        """
+        Return the configuration as a plain dict, read from a single snapshot.
+        Keys that are not set are left out, unless they have a default, and
+        paths are converted to str.
+        derived: if True, also include generated values like data_dir and fpath
+        """
+        with self.snapshot():
+            res = decode_all(self._snapshot, skip_unset = True)
+            if derived:
+                for key in derived_keys:
+                    try:
+                        res[key] = getattr(self, key)
+                    except ValueError:
+                        #Derived value that depends on a key that is not set
+                        pass
+        return {key: value.as_posix() if isinstance(value, Path) else value for key, value in res.items()}
+
+    def get_many(self, keys) -> dict:
+        """
+        Read several keys, including derived ones like fpath, in one round
+        trip. Raises ValueError if one of them is not set, same as the properties
+        """
+        for key in keys:
+            if key not in schema and key not in derived_keys:
+                raise ValueError(f'Unknown key: {key}')
+        with self.snapshot():
+            values = decode_all({key: self._snapshot[key] for key in keys if key in schema})
+            return {key: values[key] if key in values else getattr(self, key) for key in keys}
 
-    @viewer_interval.setter
-    def viewer_interval(self, value):
-        self.client.set('viewer_interval', value)
-    
-    @nrows.setter
-    def nrows(self, value):
-        self.client.set('nrows', value)
+    def to_yaml(self, path: Path):
+        """
+        Save the current configuration to a yaml file
+        """
+        ConfigurationClient._write_yaml(path, self.dump())
 
-    @property
-    def ncols(self):
-        res = self.client.get('ncols')
-        if res is None:
-            raise ValueError('ncols not set')
-        return int(res)
-    
-    @ncols.setter
-    def ncols(self, value):
-        self.client.set('ncols', value)
+    @staticmethod
+    def _write_yaml(path: Path, values: dict):
+        res = {}
+        non_writable = {}
+        for key, value in values.items():
+            if key not in schema or schema[key].read_only:
+                non_writable[key] = value
+            else:
+                res[key] = value
+
+        with open(path, 'w') as file:
+            file.write('# Configuration file for EPOC\n')
+            file.write(f'# Saved: {datetime.now()}\n\n')
+            file.write('# Generated value at time of saving\n')
+            for key, value in non_writable.items():
+                file.write(f'# {key}: {value}\n')
+            file.write('\n')
+            yaml.safe_dump(res, file, sort_keys=False)
 
     def _incr_file_id(self):
-        self.client.incr('file_id')
+        res = self._write('incrby', 'file_id', 1, client = self.client)
+        self._written('file_id', self.client.get_encoder().encode(res))
 
-    @property
-    def base_data_dir(self) -> Path:
-        res = self.client.get('base_data_dir')
-        if res is None:
-            raise ValueError('base_data_dir not set')
-        return Path(res.decode(ConfigurationClient._encoding))
-    
-    @base_data_dir.setter
-    def base_data_dir(self, value: Path|str):
-        value = Path(value)
-        self.client.set('base_data_dir', value.as_posix())
-    
     @property
     def data_dir(self) -> Path:
         """
@@ -293,8 +674,7 @@ class ConfigurationClient:
         Computed from the configured experiment
         TODO! Do we need the support for a custom directory
         """
-        path = Path(self.base_data_dir) / self.experiment_class / self.PI_name / self.year / self.project_id / self.today
-        return path
+        return self.work_dir / self.today
     
 
     @property
@@ -302,8 +682,7 @@ class ConfigurationClient:
         """
         Directory where output of data analysis will be stored
         """
-        path = Path(self.base_data_dir) / self.experiment_class / self.PI_name / self.year / self.project_id
-        return path
+        return paths.work_dir(self.base_data_dir, self.experiment_class, self.PI_name, self.year, self.project_id)
 
     @property
     def fname(self) -> str:
@@ -311,11 +690,10 @@ class ConfigurationClient:
         Filename for the current dataset
         generated from the configured experiment and the current date
         """
-        res = self.client.get('measurement_tag')
+        res = self._get('measurement_tag')
         if res is None:
             raise ValueError('fname not set')
-        s = f'{self.file_id:03d}_{self.project_id}_{res.decode(ConfigurationClient._encoding)}_{self.timestamp}_master.h5'
-        return s
+        return paths.fname(self.file_id, self.project_id, res.decode(ConfigurationClient._encoding), self.timestamp)
     
     @property
     def fpath(self) -> Path:
@@ -324,35 +702,6 @@ class ConfigurationClient:
     @property
     def log_fpath(self) -> Path:
         return (self.data_dir / self.fname).with_suffix('.log')
-    
-    @property
-    def measurement_tag(self) -> str:
-        """
-        Tag to identify the current measurement. will be part of the filename
-        """
-        res = self.client.get('measurement_tag')
-        if res is None:
-            raise ValueError('measurement_tag not set')
-        return res.decode(ConfigurationClient._encoding)
-    
-    @measurement_tag.setter
-    def measurement_tag(self, value : str):
-        value = sanitize_label(value)
-        self.client.set('measurement_tag', value)
-
-
-    @property
-    def experiment_class(self) -> str:
-        res = self.client.get('experiment_class')
-        if res is None:
-            raise ValueError('experiment_class not set')
-        return res.decode(ConfigurationClient._encoding)
-    
-    @experiment_class.setter
-    def experiment_class(self, value : str):
-        if value not in ConfigurationClient._experiment_classes:
-            raise ValueError(f'Invalid experiment class. Possible values are: {ConfigurationClient._experiment_classes}. Got: {value}')
-        self.client.set('experiment_class', value)
 
     @property
     def today(self) -> str:
@@ -360,14 +709,14 @@ class ConfigurationClient:
         Returns the current date in the format YYYY-MM-DD
         #TODO! should we set this manually instead for experiments crossing over midnight?
         """
-        return datetime.now().strftime('%Y-%m-%d')
+        return paths.today()
     
     @property
     def year(self) -> str:
         """
         Returns the current year in the format YYYY
         """
-        return datetime.now().strftime('%Y')
+        return paths.year()
 
     @property
     def timestamp(self) -> str:
@@ -375,123 +724,105 @@ class ConfigurationClient:
         Returns the current date in the format YYYY-MM-DD
         #TODO! should we set this manually instead for experiments crossing over midnight?
         """
-        return datetime.now().strftime('%Y-%m-%d_%H%M')
+        return paths.timestamp()
 
-    def after_write(self):
+    def after_write(self) -> Path:
         """
-        Call after finished an acquisition to update the configuration
+        Call after finished an acquisition to update the configuration.
+        Records last_dataset and increments file_id atomically in one
+        round trip. Returns the path of the recorded dataset
         TODO! Find a better name
         """
-        self.last_dataset = self.data_dir / self.fname
-        self._incr_file_id()
+        return self._reserve_file_ids(1, record_last = True)[1][0]
 
-    @property
-    def overlays(self):
-        return [json.loads(item.decode(ConfigurationClient._encoding)) for item in self.client.lrange('overlays', 0, -1)]
-    
-    @overlays.setter
-    def overlays(self, value):
-        self.client.delete('overlays')
-        for item in value:
-            self.client.rpush('overlays', json.dumps(item))
-    
-    def add_overlay(self, value):
-        self.client.rpush('overlays', value)
+    def reserve_file_ids(self, n : int) -> list[Path]:
+        """
+        Atomically reserve the next n file_ids and return the dataset paths
+        for them. Use for rapid back-to-back acquisitions where fname would
+        otherwise collide. last_dataset is not changed, set it when each
+        dataset has been written.
+        """
+        n = int(n)
+        if n < 1:
+            raise ValueError(f'Number of file_ids to reserve must be positive. Got: {n}')
+        return self._reserve_file_ids(n, record_last = False)[1]
 
-    @property
-    def mag_value_diff(self):
-        res = self.client.get('mag_value_diff')
-        if res is None:
-            raise ValueError('mag_value_diff not set')
-        return float(res)
+    def session(self, n = 10) -> AcquisitionSession:
+        """
+        Start a series of acquisitions with paths that are resolved once, see
+        AcquisitionSession. n file_ids are reserved at a time, unused ones
+        are skipped. The data and work directories are created in the background
+        """
+        return AcquisitionSession(self, n)
 
-    @mag_value_diff.setter
-    def mag_value_diff(self, value):
-        self.client.set('mag_value_diff', value)
+    def _reserve_file_ids(self, n, record_last, paths = True) -> tuple[int, list[Path]]:
+        #Without paths only the next free file_id is returned
+        keys = self._layout.script_keys(scripts.reserve_file_ids_keys)
+        args = self._script_args(self._layout) + scripts.reserve_file_ids_args(n, record_last, paths)
+        res = self._run(self._reserve_script, scripts.reserve_file_ids, keys, args)
 
-    @property
-    def mag_value_img(self):
-        res = self.client.get('mag_value_img')
-        if res is None:
-            raise ValueError('mag_value_img not set')
-        return float(res)
-    
-    @mag_value_img.setter
-    def mag_value_img(self, value):
-        self.client.set('mag_value_img', value)
+        next_id, paths = res[0], res[1:]
+        self._written('file_id', self.client.get_encoder().encode(next_id))
+        if record_last:
+            self._written('last_dataset', paths[-1])
+        return next_id, [Path(p.decode(ConfigurationClient._encoding)) for p in paths]
 
-    @property
-    def receiver_endpoint(self):
-        res = self.client.get('receiver_endpoint')
-        if res is None:
-            raise ValueError('receiver_endpoint not set')
-        return res.decode(ConfigurationClient._encoding)
-    
-    @receiver_endpoint.setter
-    def receiver_endpoint(self, value):
-        self.client.set('receiver_endpoint', value)
+    def add_overlay(self, value):
+        #Accept both already encoded json and objects
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        self._write('append', 'overlays', value)
+        raw = None
+        current = self._snapshot if self._snapshot is not None else self._local
+        if current is not None:
+            raw = current['overlays'] + [self.client.get_encoder().encode(value)]
+        self._written('overlays', raw)
 
-    @property
-    def cal_dir(self):
-        res = self.client.get('cal_dir')
-        if res is None:
-            raise ValueError('cal_dir not set')
-        return Path(res.decode(ConfigurationClient._encoding))
-    
-    @cal_dir.setter
-    def cal_dir(self, value):
-        self.client.set('cal_dir', value)
+    def __repr__(self) -> str:
+        with self.snapshot():
+            s = f"""
+            Configuration:
+            \tPI_name: {self.PI_name}
+            \tproject_id: {self.project_id}
+            \texperiment_class: {self.experiment_class}
+            \tdata_dir: {self.data_dir}
+            \twork_dir: {self.work_dir}
+            \tfname: {self.fname}
+
+            \tlast_dataset: {self.last_dataset}
+            """
+        return inspect.cleandoc(s)
 
-    @property
-    def frames_to_sum(self):
-        res = self.client.get('frames_to_sum')
-        if res is None:
-            raise ValueError('frames_to_sum not set')
-        return int(res)
-    
-    @frames_to_sum.setter
-    def frames_to_sum(self, value):
-        self.client.set('frames_to_sum', value)
 
-    @property
-    def temserver(self):
-        """
-        ZMQ Endpoint for the TEM server
-        For example: tcp://TEM-pc:5555
-        """
-        res = self.client.get('temserver')
-        if res is None:
-            raise ValueError('temserver not set')
-        return res.decode(ConfigurationClient._encoding)
-    
-    @temserver.setter
-    def temserver(self, value):
-        self.client.set('temserver', value)
 
-    @property
-    def jfjoch_host(self):
-        res = self.client.get('jfjoch_host')
-        if res is None:
-            raise ValueError('jfjoch_host not set')
-        return res.decode(ConfigurationClient._encoding)
-    
-    @jfjoch_host.setter
-    def jfjoch_host(self, value):
-        self.client.set('jfjoch_host', value)
 
+def _stored_property(key):
+    def read(self):
+        raw = self._get_list(key.name) if key.is_list else self._get(key.name)
+        return key.from_raw(raw)
 
-    def __repr__(self) -> str:
-        s = f"""
-        Configuration:
-        \tPI_name: {self.PI_name}
-        \tproject_id: {self.project_id}
-        \texperiment_class: {self.experiment_class}
-        \tdata_dir: {self.data_dir}
-        \twork_dir: {self.work_dir}
-        \tfname: {self.fname}
+    def write(self, value):
+        self._store(key.name, key.to_raw(value))
 
-        \tlast_dataset: {self.last_dataset}
-        """
-        return inspect.cleandoc(s)
+    #All generated properties share the code of getter and setter, so
+    #ClientStats is told the name instead of finding it on the call stack
+    def getter(self):
+        if self.stats is None:
+            return read(self)
+        with stored_property(key.name):
+            return read(self)
+
+    def setter(self, value):
+        if self.stats is None:
+            write(self, value)
+            return
+        with stored_property(f'{key.name}='):
+            write(self, value)
+
+    return property(getter, None if key.read_only else setter, doc=key.doc)
 
+for _key in schema.values():
+    setattr(ConfigurationClient, _key.name, _stored_property(_key))
 
+# Used to attribute requests to properties when stats are enabled
+_code_names = code_names(ConfigurationClient, skip = schema)
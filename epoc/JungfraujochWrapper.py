@@ -1,14 +1,49 @@
-import time
 from rich import print
 import jfjoch_client
 
+from . import polling, progress
+
+
+def _check(status):
+    """Raise RuntimeError if the broker can not become idle by itself"""
+    if status.state == 'Error':
+        raise RuntimeError(f'Jungfraujoch error: {status.message}')
+    if status.state == 'Inactive':
+        raise RuntimeError('Jungfraujoch is not initialized, run init()')
+    return status
+
+def _started(status):
+    return _check(status).state != 'Idle'
+
+def _idle(status):
+    return _check(status).state == 'Idle'
+
+def _run_key(stats):
+    """Changes with every data collection that is over, from statistics_data_collection_get()"""
+    return (stats.run_number, stats.file_prefix, stats.images_expected, stats.images_collected,
+            stats.cancelled)
+
+def _calibration_key(stats):
+    """Changes with every pedestal that is over, from statistics_calibration_get()"""
+    return [s.to_dict() for s in stats]
+
+def _printer(progress, quiet):
+    """on_status for polling.wait, prints the status when the state changes"""
+    def show(s, changed):
+        if changed and not quiet:
+            print(s)
+        if progress and s.state != 'Idle' and s.progress is not None:
+            print(f'Progress: {100*s.progress:.0f}%', end = '\r')
+    return show
 
 
 class JungfraujochWrapper:
     """
     Wrapper for the Jungfraujoch python client (jfjoch_client).
+    With store, a DetectorStatsStore, the statistics of collect() and
+    collect_pedestal(wait = True) are recorded.
     """
-    def __init__(self, host):
+    def __init__(self, host, store = None):
         # Defining the host is optional and defaults to http://localhost:5232
         # See configuration.py for a list of all supported configuration parameters.
         self.configuration = jfjoch_client.Configuration(
@@ -19,6 +54,8 @@ class JungfraujochWrapper:
         self.api_instance = jfjoch_client.DefaultApi(self.api_client)
         self._image_time_us = 50000 #100x500us
         self._lots_of_images = 72000 #1h at 20Hz
+        self._start_timeout = 1.0 #Max seconds for the broker to leave Idle after a start
+        self.store = store
 
     def cancel(self) -> None:
         """
@@ -49,7 +86,8 @@ class JungfraujochWrapper:
               beam_y_pxl = 1,
               detector_distance_mm = 100,
               incident_energy_ke_v = 200,
-              wait = False) -> None:
+              wait = False,
+              timeout = None) -> None:
         """Start a measurement.
         
         Parameters
@@ -78,7 +116,9 @@ class JungfraujochWrapper:
 
         wait : bool
             If True, wait for the measurement to finish before returning.
-        
+
+        timeout : float, optional
+            Seconds to wait at most if wait is True, raises TimeoutError when exceeded
         
         """
         ds = jfjoch_client.DatasetSettings(
@@ -93,14 +133,15 @@ class JungfraujochWrapper:
             space_group_number=1
             )
         
+        before = self.last_run() if wait else None
         self.api_instance.start_post(dataset_settings=ds)
         if wait:
-            time.sleep(0.3)
-            self.wait_until_idle()
+            self.wait_until_started(before = before)
+            self.wait_until_idle(timeout = timeout)
 
     
 
-    def collect_pedestal(self, wait = False):
+    def collect_pedestal(self, wait = False, timeout = None):
         """Start pedestal collection
         
         Parameters
@@ -108,33 +149,81 @@ class JungfraujochWrapper:
         wait : bool
             If True, wait for the measurement to finish before returning
 
+        timeout : float, optional
+            Seconds to wait at most if wait is True, raises TimeoutError when exceeded
+
         """
+        before = self.last_run(pedestal = True) if wait else None
         self.api_instance.pedestal_post()
         if wait:
-            time.sleep(0.3)
-            self.wait_until_idle()
+            self.wait_until_started(before = before, pedestal = True)
+            self.wait_until_idle(timeout = timeout)
             stat = self.api_instance.statistics_calibration_get()
             print(stat)
+            if self.store is not None:
+                self.store.record_calibration(stat)
 
-    def wait_until_idle(self, progress=False) -> None:
-        """Wait in a loop until the Jungfraujoch is idle
+    def last_run(self, pedestal = False, stats = None):
+        """
+        Identifies the last data collection, or pedestal, that is over.
+        Taken before a start and passed to wait_until_started, it tells a
+        short run that is already over from one that did not start yet.
+        stats: the statistics if they were already read, saves the request
+        """
+        if pedestal:
+            return _calibration_key(self.api_instance.statistics_calibration_get() if stats is None else stats)
+        return _run_key(self.api_instance.statistics_data_collection_get() if stats is None else stats)
+
+    def wait_until_started(self, timeout = None, before = None, pedestal = False):
+        """Wait until the broker has left Idle after a start or pedestal request.
+        Returns the status, also if the broker is still Idle after timeout
+        (default 1 s) since then the measurement was already over. With before,
+        from last_run(pedestal) before the request, an Idle broker whose last
+        run changed is returned at once.
+        """
+        timeout = self._start_timeout if timeout is None else timeout
+        over = []
+        def poll():
+            s = self.status()
+            if before is not None and s.state == 'Idle' and self.last_run(pedestal) != before:
+                over.append(s)
+            return s
+        try:
+            return polling.wait(poll, lambda s: bool(over) or _started(s), timeout = timeout)
+        except TimeoutError:
+            return self.status()
+
+    def wait_until_idle(self, progress=False, timeout=None, quiet=False):
+        """Wait until the Jungfraujoch is idle and return the last status.
+        Polls often after a change of state and near the end of a measurement,
+        less often during long runs.
         
         Parameters
         ----------
         progress : bool
             If True, print progress of the measurement
+
+        timeout : float, optional
+            Seconds to wait at most, raises TimeoutError when exceeded
+
+        quiet : bool
+            If True, do not print the status when the state changes
         
         """
-        while True:
-            s = self.api_instance.status_get()
-            print(s)
-            if s.state == 'Idle':
-                if progress:
-                    print(f'Progress: {100:.0f}%')
-                break
-            if progress:
-                print(f'Progress: {100*s.progress:.0f}%', end = '\r')
-            time.sleep(0.1)
+        s = polling.wait(self.status, _idle, timeout = timeout, on_status = _printer(progress, quiet))
+        if progress:
+            print(f'Progress: {100:.0f}%')
+        return s
+
+    def progress_samples(self, interval = 0.2, until_idle = True, **kwargs):
+        """Generator of ProgressSample with state, progress, images/s and ETA,
+        see epoc.progress.samples
+
+        for sample in j.progress_samples():
+            print(f'{sample.images} images, {sample.rate} images/s, {sample.eta} s left')
+        """
+        return progress.samples(self.status, self.api_instance.statistics_data_collection_get,
+                                interval, until_idle, **kwargs)
 
     def live(self) -> None:
         """
@@ -160,4 +249,6 @@ class JungfraujochWrapper:
         print("Measurement stopped")
         s = self.api_instance.statistics_data_collection_get()
         print(s)
+        if self.store is not None:
+            self.store.record_run(s, fpath = fname)
         self.live()
@@ -0,0 +1,172 @@
+import json
+import queue
+import threading
+import time
+import warnings
+
+import jfjoch_client
+
+
+class StatusCache:
+    """
+    Latest detector status with the time it was taken. Base class of
+    StatusPoller, which polls the broker, and StatusSubscriber, which
+    receives the status from a StatusPoller in another process.
+    """
+    def __init__(self):
+        self._status = None
+        self._time = None
+        self._updated = threading.Condition()
+        self._callbacks = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def time(self) -> float | None:
+        """time.time() when the cached status was taken"""
+        return self._time
+
+    @property
+    def age(self) -> float | None:
+        """Seconds since the cached status was taken"""
+        return None if self._time is None else time.time() - self._time
+
+    def status(self, max_age = None, timeout = None):
+        """
+        Cached status, without a request to the broker. If it is older than
+        max_age seconds, or there is none yet, wait for the next update.
+        Raises TimeoutError if none arrives within timeout seconds
+        """
+        with self._updated:
+            ok = lambda: self._time is not None and (max_age is None or time.time() - self._time <= max_age)
+            if not self._updated.wait_for(ok, timeout):
+                raise TimeoutError(f'No detector status within {timeout} s')
+            return self._status
+
+    def subscribe(self, callback):
+        """
+        Call callback(status, time) from the background thread on every
+        update. Returns callback
+        """
+        self._callbacks.append(callback)
+        return callback
+
+    def queue(self, maxsize = 0) -> queue.Queue:
+        """Queue that gets (status, time) on every update, drops them when full"""
+        q = queue.Queue(maxsize)
+        def put(status, t):
+            try:
+                q.put_nowait((status, t))
+            except queue.Full:
+                pass
+        self.subscribe(put)
+        return q
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def _update(self, status, t):
+        with self._updated:
+            self._status = status
+            self._time = t
+            self._updated.notify_all()
+        for callback in list(self._callbacks):
+            #A failing subscriber must not stop the updates for the others
+            try:
+                callback(status, t)
+            except Exception as e:
+                warnings.warn(f'Exception in status callback {callback}: {e!r}')
+
+
+class StatusPoller(StatusCache):
+    """
+    Polls status_get() of the broker every interval seconds in a background
+    thread, independent of how many readers there are. With publish, for
+    example 'tcp://*:5234', every status is also sent as json over a zmq PUB
+    socket for StatusSubscriber in other processes.
+
+    with StatusPoller(JungfraujochWrapper(host), interval = 0.2) as poller:
+        s = poller.status(max_age = 0.5)
+        poller.subscribe(lambda s, t: print(s.state))
+    """
+    def __init__(self, wrapper, interval = 0.2, publish = None):
+        super().__init__()
+        if interval <= 0:
+            raise ValueError(f'interval must be positive. Got: {interval}')
+        self.interval = interval
+        #Last exception raised by status_get(), None after a successful poll
+        self.error = None
+        self._poll = wrapper.status
+        self._socket = None
+        if publish is not None:
+            import zmq
+            self._socket = zmq.Context.instance().socket(zmq.PUB)
+            self._socket.bind(publish)
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f'StatusPoller(interval={self.interval}, age={self.age})'
+
+    def close(self):
+        super().close()
+        if self._socket is not None:
+            self._socket.close(linger = 0)
+
+    def _run(self):
+        #Fixed rate, a slow request delays the next one but not the ones after
+        next_poll = time.monotonic()
+        while not self._stop.is_set():
+            t = time.time()
+            try:
+                status = self._poll()
+            except Exception as e:
+                self.error = e
+            else:
+                self.error = None
+                self._update(status, t)
+                if self._socket is not None:
+                    self._socket.send_string(json.dumps({'time': t, 'status': status.to_dict()}))
+            next_poll = max(next_poll + self.interval, time.monotonic())
+            self._stop.wait(next_poll - time.monotonic())
+
+
+class StatusSubscriber(StatusCache):
+    """
+    Detector status published by a StatusPoller in another process, for
+    example endpoint = 'tcp://localhost:5234'. Only the latest message is kept.
+    """
+    def __init__(self, endpoint):
+        super().__init__()
+        import zmq
+        self.endpoint = endpoint
+        self._socket = zmq.Context.instance().socket(zmq.SUB)
+        self._socket.setsockopt(zmq.CONFLATE, 1)
+        self._socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self._socket.connect(endpoint)
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f'StatusSubscriber({self.endpoint}, age={self.age})'
+
+    def _run(self):
+        #The socket is only used by this thread, also for closing
+        try:
+            while not self._stop.is_set():
+                if self._socket.poll(100):
+                    msg = json.loads(self._socket.recv_string())
+                    self._update(jfjoch_client.BrokerStatus.from_dict(msg['status']), msg['time'])
+        finally:
+            self._socket.close(linger = 0)
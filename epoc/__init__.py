@@ -1,7 +1,11 @@
 from .ConfigurationClient import ConfigurationClient
 from .ConfigurationClient import auth_token, redis_host
+from .AsyncConfigurationClient import AsyncConfigurationClient
+from .backends import MemoryBackend, FileBackend
 
 try: 
     from .JungfraujochWrapper import JungfraujochWrapper
+    from .AsyncJungfraujochWrapper import AsyncJungfraujochWrapper
+    from .StatusPoller import StatusPoller, StatusSubscriber
 except ImportError:
     print("No JungfrauWrapper found")
\ No newline at end of file
@@ -0,0 +1,378 @@
+import copy
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import redis
+from redis.connection import Encoder
+
+
+class MemoryBackend:
+    """
+    In-process stand-in for redis.Redis implementing the commands used by
+    ConfigurationClient (get/set/mget/incr/delete/lrange/rpush/flushdb,
+    hget/hmget/hset/hgetall/hincrby, xadd/xrange/xrevrange, pipelines and
+    transactions). Values are stored as bytes and encoded like redis-py
+    does, so the client behaves the same as with a server. Server side
+    scripts are replaced by Python functions run with call().
+
+    cfg = ConfigurationClient(backend = MemoryBackend())
+    """
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+        self._encoder = Encoder(encoding='utf-8', encoding_errors='strict', decode_responses=False)
+
+    def get_encoder(self) -> Encoder:
+        return self._encoder
+
+    def pipeline(self, transaction = True) -> 'MemoryPipeline':
+        return MemoryPipeline(self)
+
+    def transaction(self, func, *watches, value_from_callable = False, **kwargs):
+        """
+        Same as redis.Redis.transaction, func(pipe) can read directly from
+        pipe until it calls pipe.multi(). No retries are needed since the
+        whole call holds the lock
+        """
+        with self._lock:
+            pipe = self.pipeline()
+            pipe._immediate = True
+            res = func(pipe)
+            exec_value = pipe.execute()
+        return res if value_from_callable else exec_value
+
+    def call(self, func, keys, args):
+        """
+        Run func(backend, keys, args) atomically, stands in for a server
+        side script. All changes are rolled back if func raises
+        """
+        with self._lock:
+            saved = copy.copy(self._data)
+            try:
+                return func(self, keys, args)
+            except Exception:
+                self._data = saved
+                raise
+
+    def _changed(self):
+        """Called after every write, used by subclasses to persist the data"""
+        pass
+
+    def _typed(self, key, kind, default):
+        value = self._data.get(key, default)
+        if not isinstance(value, kind):
+            raise redis.exceptions.ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _list(self, key):
+        return self._typed(key, list, [])
+
+    def _hash(self, key):
+        return self._typed(key, dict, {})
+
+    def _string(self, key):
+        return self._typed(key, (bytes, type(None)), None)
+
+    def _stream(self, key):
+        return self._typed(key, Stream, Stream())
+
+    def ping(self):
+        return True
+
+    def get(self, key):
+        with self._lock:
+            return self._string(key)
+
+    def mget(self, keys, *args):
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        with self._lock:
+            values = [self._data.get(key) for key in keys + list(args)]
+        #Like Redis, MGET returns None for keys that do not hold a string
+        return [value if isinstance(value, bytes) else None for value in values]
+
+    def set(self, key, value):
+        value = self._encoder.encode(value)
+        with self._lock:
+            self._data[key] = value
+            self._changed()
+        return True
+
+    def incrby(self, key, amount = 1):
+        with self._lock:
+            value = self._string(key)
+            try:
+                value = int(value or 0) + int(amount)
+            except ValueError:
+                raise redis.exceptions.ResponseError('value is not an integer or out of range')
+            self._data[key] = self._encoder.encode(value)
+            self._changed()
+        return value
+
+    def incr(self, key, amount = 1):
+        return self.incrby(key, amount)
+
+    def delete(self, *keys):
+        with self._lock:
+            n = sum(self._data.pop(key, None) is not None for key in keys)
+            self._changed()
+        return n
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            items = self._list(key)
+            #Redis includes the end index
+            end = len(items) if end == -1 else end + 1
+            return list(items[start:end])
+
+    def rpush(self, key, *values):
+        values = [self._encoder.encode(value) for value in values]
+        with self._lock:
+            items = self._list(key)
+            self._data[key] = items + values
+            self._changed()
+            return len(self._data[key])
+
+    def hget(self, name, key):
+        with self._lock:
+            return self._hash(name).get(self._encoder.encode(key))
+
+    def hmget(self, name, keys, *args):
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        with self._lock:
+            values = self._hash(name)
+            return [values.get(self._encoder.encode(key)) for key in keys + list(args)]
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._hash(name))
+
+    def hset(self, name, key = None, value = None, mapping = None):
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        items = {self._encoder.encode(k): self._encoder.encode(v) for k, v in items.items()}
+        with self._lock:
+            values = dict(self._hash(name))
+            n = sum(k not in values for k in items)
+            values.update(items)
+            self._data[name] = values
+            self._changed()
+        return n
+
+    def hincrby(self, name, key, amount = 1):
+        key = self._encoder.encode(key)
+        with self._lock:
+            values = dict(self._hash(name))
+            try:
+                value = int(values.get(key) or 0) + int(amount)
+            except ValueError:
+                raise redis.exceptions.ResponseError('hash value is not an integer')
+            values[key] = self._encoder.encode(value)
+            self._data[name] = values
+            self._changed()
+        return value
+
+    def xadd(self, name, fields, id = '*', maxlen = None, approximate = True):
+        fields = {self._encoder.encode(k): self._encoder.encode(v) for k, v in fields.items()}
+        with self._lock:
+            stream = self._stream(name)
+            entry_id = stream.next_id()
+            entries = stream.entries + [(entry_id, fields)]
+            if maxlen is not None:
+                entries = entries[-maxlen:]
+            self._data[name] = Stream(entries, entry_id)
+            self._changed()
+        return entry_id
+
+    def xrange(self, name, min = '-', max = '+', count = None):
+        with self._lock:
+            return self._stream(name).range(min, max, count, reverse = False)
+
+    def xrevrange(self, name, max = '+', min = '-', count = None):
+        with self._lock:
+            return self._stream(name).range(min, max, count, reverse = True)
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+            self._changed()
+        return True
+
+
+class Stream:
+    """
+    Entries of a stream, [(id, {field: value})]. Replaced on every change
+    so that MemoryPipeline can roll back by copying the data dict
+    """
+    def __init__(self, entries = None, last_id = b'0-0'):
+        self.entries = entries or []
+        self.last_id = last_id
+
+    @staticmethod
+    def parse_id(value, last):
+        """(ms, seq) of an entry id, an id without seq is the first or last entry of that ms"""
+        if isinstance(value, bytes):
+            value = value.decode()
+        ms, _, seq = str(value).partition('-')
+        return int(ms), int(seq) if seq else (2**64 if last else 0)
+
+    def next_id(self) -> bytes:
+        ms = int(time.time() * 1000)
+        last_ms, last_seq = Stream.parse_id(self.last_id, False)
+        if ms <= last_ms:
+            ms, seq = last_ms, last_seq + 1
+        else:
+            seq = 0
+        return f'{ms}-{seq}'.encode()
+
+    def range(self, min, max, count, reverse):
+        """Entries between min and max, like XRANGE. ( excludes the bound"""
+        if isinstance(min, bytes):
+            min = min.decode()
+        if isinstance(max, bytes):
+            max = max.decode()
+        lo = (-1, 0) if min == '-' else Stream.parse_id(min.lstrip('('), False)
+        hi = (2**64, 0) if max == '+' else Stream.parse_id(max.lstrip('('), True)
+        res = []
+        for entry_id, fields in self.entries:
+            key = Stream.parse_id(entry_id, False)
+            if key < lo or key > hi:
+                continue
+            if min.startswith('(') and key == lo or max.startswith('(') and key == hi:
+                continue
+            res.append((entry_id, dict(fields)))
+        if reverse:
+            res.reverse()
+        return res[:count] if count is not None else res
+
+
+class MemoryPipeline:
+    """
+    Queues commands and runs them atomically on execute(). If one of the
+    commands fails, all changes are rolled back.
+    """
+    def __init__(self, backend):
+        self._backend = backend
+        self._commands = []
+        #Inside MemoryBackend.transaction commands run directly until multi()
+        self._immediate = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.reset()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __getattr__(self, name):
+        method = getattr(self._backend, name)
+        def command(*args, **kwargs):
+            if self._immediate:
+                return method(*args, **kwargs)
+            self._commands.append((method, args, kwargs))
+            return self
+        return command
+
+    def multi(self):
+        self._immediate = False
+
+    def watch(self, *keys):
+        pass
+
+    def reset(self):
+        self._commands = []
+
+    def execute(self):
+        backend = self._backend
+        with backend._lock:
+            saved = copy.copy(backend._data)
+            try:
+                res = [method(*args, **kwargs) for method, args, kwargs in self._commands]
+            except Exception:
+                backend._data = saved
+                raise
+            finally:
+                self._commands = []
+        return res
+
+
+class FileBackend(MemoryBackend):
+    """
+    MemoryBackend that is loaded from and saved to a json file on every
+    write. For offline machines without access to the Redis server.
+
+    cfg = ConfigurationClient(backend = FileBackend('epoc-config.json'))
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = Path(path)
+        #Pipelines save once when all commands have run
+        self._batch = False
+        if self.path.exists():
+            with open(self.path, 'r') as file:
+                res = json.load(file)
+            for key, value in res.items():
+                if isinstance(value, list):
+                    self._data[key] = [item.encode() for item in value]
+                elif isinstance(value, dict) and 'stream' in value:
+                    entries = [(entry_id.encode(), {k.encode(): v.encode() for k, v in fields.items()})
+                               for entry_id, fields in value['stream']]
+                    self._data[key] = Stream(entries, value['last_id'].encode())
+                elif isinstance(value, dict):
+                    self._data[key] = {k.encode(): v.encode() for k, v in value.items()}
+                else:
+                    self._data[key] = value.encode()
+
+    def pipeline(self, transaction = True) -> 'MemoryPipeline':
+        return FilePipeline(self)
+
+    def call(self, func, keys, args):
+        with self._lock:
+            #Can run inside a pipeline that saves when it is done
+            batch, self._batch = self._batch, True
+            try:
+                res = super().call(func, keys, args)
+            finally:
+                self._batch = batch
+            self._changed()
+        return res
+
+    def _changed(self):
+        if self._batch:
+            return
+        res = {}
+        for key, value in self._data.items():
+            if isinstance(value, list):
+                res[key] = [item.decode() for item in value]
+            elif isinstance(value, Stream):
+                #No hash has a field named stream, see epoc.schema
+                res[key] = {'stream': [[entry_id.decode(), {k.decode(): v.decode() for k, v in fields.items()}]
+                                       for entry_id, fields in value.entries],
+                            'last_id': value.last_id.decode()}
+            elif isinstance(value, dict):
+                res[key] = {k.decode(): v.decode() for k, v in value.items()}
+            else:
+                res[key] = value.decode()
+        #Write to a temporary file first so a crash never leaves a broken file
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'w') as file:
+            json.dump(res, file, indent=2)
+        os.replace(tmp, self.path)
+
+
+class FilePipeline(MemoryPipeline):
+    def execute(self):
+        backend = self._backend
+        with backend._lock:
+            backend._batch = True
+            try:
+                res = super().execute()
+            finally:
+                backend._batch = False
+            backend._changed()
+        return res
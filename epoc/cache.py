@@ -0,0 +1,150 @@
+import threading
+import time
+import warnings
+from collections import OrderedDict
+
+import redis
+
+# Keyspace events needed for invalidation: K keyspace channel, $ string,
+# l list, h hash (see epoc.layout) and g generic (DEL, EXPIRE, RENAME...)
+# commands, x expired keys
+_keyspace_flags = 'K$lhgx'
+
+
+def keyspace_channel(client):
+    """Prefix of the keyspace notification channels for the db of client"""
+    db = client.connection_pool.connection_kwargs.get('db', 0)
+    return f'__keyspace@{db}__:'
+
+
+def enable_keyspace_events(client):
+    """
+    Make sure that the server publishes keyspace notifications. Existing
+    flags are kept and only the missing ones are added.
+    """
+    try:
+        flags = client.config_get('notify-keyspace-events')['notify-keyspace-events']
+        if isinstance(flags, bytes):
+            flags = flags.decode()
+    except redis.exceptions.ResponseError:
+        flags = ''
+
+    #A is an alias for all event classes
+    needed = 'K' if 'A' in flags else _keyspace_flags
+    missing = ''.join(f for f in needed if f not in flags)
+    if not missing:
+        return
+
+    try:
+        client.config_set('notify-keyspace-events', flags + missing)
+    except redis.exceptions.ResponseError:
+        warnings.warn('Could not enable keyspace notifications on the server. '
+                      f'Make sure notify-keyspace-events contains "{_keyspace_flags}"')
+
+
+def subscribe(client, handlers, timeout=1.0):
+    """
+    Subscribe to the patterns in handlers {pattern: handler} and wait for the
+    server to confirm so that no notification is missed after returning.
+    Returns the PubSub object
+    """
+    pubsub = client.pubsub()
+    pubsub.psubscribe(**handlers)
+    confirmed = 0
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        msg = pubsub.get_message(timeout=deadline - time.monotonic())
+        if msg is not None and msg['type'] == 'psubscribe':
+            confirmed += 1
+            if confirmed == len(handlers):
+                return pubsub
+    pubsub.close()
+    raise ValueError(f'Could not subscribe to: {list(handlers)}')
+
+
+class PropertyCache:
+    """
+    Bounded LRU cache of raw values read from Redis. Entries are dropped
+    when a keyspace notification for the key arrives, so changes from
+    other clients are visible within milliseconds.
+    """
+    def __init__(self, client, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        #Incremented on every invalidation, used to avoid caching values
+        #that were changed while the request was in flight
+        self._generation = 0
+        #Cleared if the notification thread dies, then every read goes to the server
+        self.active = True
+
+        enable_keyspace_events(client)
+        self._prefix = keyspace_channel(client)
+        self._pubsub = subscribe(client, {self._prefix + '*': self._on_notification})
+        self._thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True,
+                                                  exception_handler=self._on_error)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f'PropertyCache(size={len(self)}, maxsize={self.maxsize}, hits={self.hits}, misses={self.misses})'
+
+    def fetch(self, key, loader):
+        """
+        Return the cached value for key or call loader(key) and cache the result
+        """
+        if not self.active:
+            return loader(key)
+
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            generation = self._generation
+
+        value = loader(key)
+
+        with self._lock:
+            if generation == self._generation:
+                self._data[key] = value
+                if len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def close(self):
+        """Stop listening for notifications and drop all entries"""
+        self.active = False
+        #The worker closes the pubsub connection when it exits
+        self._thread.stop()
+        self.clear()
+
+    def _on_notification(self, message):
+        channel = message['channel']
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        self.invalidate(channel[len(self._prefix):])
+
+    def _on_error(self, exc, pubsub, thread):
+        thread.stop()
+        if not self.active:
+            #Connection closed after close(), nothing to report
+            return
+        #Without notifications we can no longer trust the cached values
+        self.active = False
+        self.clear()
+        warnings.warn(f'Lost keyspace notifications, disabling cache: {exc}')
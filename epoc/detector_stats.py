@@ -0,0 +1,269 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Statistics of every data collection and pedestal reported by the broker,
+# kept in an append-only column store. Each column is a file of raw values
+# that grows by one item per row, strings are stored one per line. Reading a
+# column is a single np.fromfile, so trends over months of runs need no
+# parsing. A row that was only partly written in a crash is dropped, all
+# columns are cut back to the shortest one before the next append.
+
+# name: dtype, missing values are -1 for integers and nan for floats
+run_columns = {
+    'time': 'f8',
+    'file_id': 'i8',
+    'images_expected': 'i8',
+    'images_collected': 'i8',
+    'images_written': 'i8',
+    'collection_efficiency': 'f8',
+    'compression_ratio': 'f8',
+    'cancelled': 'i1',
+    'max_receiver_delay': 'i8',
+    'indexing_rate': 'f8',
+    'bkg_estimate': 'f8',
+    'error_pixels': 'f8',
+    'saturated_pixels': 'f8',
+    'fpath': 'str',
+}
+
+# One row per module and storage cell of a pedestal
+calibration_columns = {
+    'time': 'f8',
+    'file_id': 'i8',
+    'module_number': 'i8',
+    'storage_cell_number': 'i8',
+    'pedestal_g0_mean': 'f8',
+    'pedestal_g1_mean': 'f8',
+    'pedestal_g2_mean': 'f8',
+    'gain_g0_mean': 'f8',
+    'gain_g1_mean': 'f8',
+    'gain_g2_mean': 'f8',
+    'masked_pixels': 'i8',
+}
+
+
+def _missing(dtype):
+    return np.nan if dtype == 'f8' else -1
+
+def _timestamp(when) -> float | None:
+    if when is None or isinstance(when, (int, float)):
+        return when
+    return when.timestamp()
+
+
+class _Table:
+    """Columns of one table in a directory"""
+    def __init__(self, path, columns):
+        self.path = Path(path)
+        self.columns = columns
+        self.path.mkdir(parents = True, exist_ok = True)
+        meta = self.path / 'columns.json'
+        if meta.exists():
+            with open(meta) as file:
+                stored = json.load(file)
+            if stored != columns:
+                raise ValueError(f'{self.path} has the columns {stored}, expected {columns}')
+        else:
+            with open(meta, 'w') as file:
+                json.dump(columns, file, indent = 2)
+
+    def _file(self, name):
+        suffix = '.txt' if self.columns[name] == 'str' else '.bin'
+        return self.path / (name + suffix)
+
+    def _truncate(self, n):
+        """Cut all columns to n rows, drops a partly written row"""
+        for name, dtype in self.columns.items():
+            f = self._file(name)
+            if not f.exists():
+                continue
+            if dtype == 'str':
+                with open(f, 'rb') as file:
+                    lines = file.read().split(b'\n')
+                if len(lines) - 1 > n:
+                    with open(f, 'wb') as file:
+                        file.write(b''.join(line + b'\n' for line in lines[:n]))
+            elif f.stat().st_size > n * np.dtype(dtype).itemsize:
+                os.truncate(f, n * np.dtype(dtype).itemsize)
+
+    def append(self, rows):
+        """Append rows, dicts with a value or None for each column"""
+        self._truncate(len(self))
+        for name, dtype in self.columns.items():
+            values = [row.get(name) for row in rows]
+            if dtype == 'str':
+                text = ''.join(('' if v is None else str(v)).replace('\n', ' ') + '\n' for v in values)
+                with open(self._file(name), 'a', encoding = 'utf-8') as file:
+                    file.write(text)
+            else:
+                values = [_missing(dtype) if v is None else v for v in values]
+                with open(self._file(name), 'ab') as file:
+                    file.write(np.array(values, dtype = dtype).tobytes())
+
+    def __len__(self):
+        n = None
+        for name, dtype in self.columns.items():
+            f = self._file(name)
+            if not f.exists():
+                return 0
+            if dtype == 'str':
+                with open(f, 'rb') as file:
+                    rows = file.read().count(b'\n')
+            else:
+                rows = f.stat().st_size // np.dtype(dtype).itemsize
+            n = rows if n is None else min(n, rows)
+        return n or 0
+
+    def read(self, columns = None) -> dict:
+        """{column: array}, all with the same length"""
+        n = len(self)
+        res = {}
+        for name in columns or self.columns:
+            dtype = self.columns[name]
+            if n == 0:
+                res[name] = np.array([], dtype = object if dtype == 'str' else dtype)
+            elif dtype == 'str':
+                with open(self._file(name), encoding = 'utf-8') as file:
+                    res[name] = np.array(file.read().split('\n')[:n], dtype = object)
+            else:
+                res[name] = np.fromfile(self._file(name), dtype = dtype, count = n)
+        return res
+
+
+class DetectorStatsStore:
+    """
+    Append-only store of the data collection and pedestal statistics of the
+    broker, one row per run, keyed by file_id and fpath. If cfg, a
+    ConfigurationClient, is given missing keys are taken from it.
+
+    store = DetectorStatsStore('/data/stats/jungfrau', cfg)
+    j = JungfraujochWrapper(host, store = store)
+    store.trend('compression_ratio', start = datetime(2025, 1, 1), every = 'W')
+    store.pedestal_drift('g0')
+    """
+    def __init__(self, path, cfg = None):
+        self.path = Path(path)
+        self.cfg = cfg
+        self._runs = _Table(self.path / 'runs', run_columns)
+        self._calibration = _Table(self.path / 'calibration', calibration_columns)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'DetectorStatsStore({self.path}, runs: {len(self._runs)}, calibration rows: {len(self._calibration)})'
+
+    def _key(self, file_id, fpath):
+        if self.cfg is not None and (file_id is None or fpath is None):
+            with self.cfg.snapshot():
+                file_id = self.cfg.file_id if file_id is None else file_id
+                fpath = self.cfg.fpath if fpath is None else fpath
+        return file_id, fpath
+
+    def record_run(self, stats, file_id = None, fpath = None, when = None):
+        """Add the result of statistics_data_collection_get()"""
+        file_id, fpath = self._key(file_id, fpath)
+        row = {name: getattr(stats, name, None) for name in run_columns}
+        row.update(time = _timestamp(when) or time.time(), file_id = file_id, fpath = fpath)
+        if row['cancelled'] is not None:
+            row['cancelled'] = int(row['cancelled'])
+        with self._lock:
+            self._runs.append([row])
+
+    def record_calibration(self, stats, file_id = None, when = None):
+        """Add the result of statistics_calibration_get(), a list with one item per module"""
+        file_id, _ = self._key(file_id, '')
+        t = _timestamp(when) or time.time()
+        rows = []
+        for item in stats:
+            row = {name: getattr(item, name, None) for name in calibration_columns}
+            row.update(time = t, file_id = file_id)
+            rows.append(row)
+        with self._lock:
+            self._calibration.append(rows)
+
+    @staticmethod
+    def _select(table, start, end, columns, mask = None):
+        res = table.read(None if columns is None else ['time'] + [c for c in columns if c != 'time'])
+        keep = np.ones(len(res['time']), dtype = bool) if mask is None else mask(res)
+        if start is not None:
+            keep &= res['time'] >= _timestamp(start)
+        if end is not None:
+            keep &= res['time'] < _timestamp(end)
+        return {name: values[keep] for name, values in res.items()}
+
+    def runs(self, start = None, end = None, columns = None) -> dict:
+        """{column: array} of the runs from start to end, datetimes or None for all"""
+        return self._select(self._runs, start, end, columns)
+
+    def calibration(self, start = None, end = None, module = None, columns = None) -> dict:
+        """{column: array} of the pedestal rows, optionally of one module"""
+        if module is not None and columns is not None and 'module_number' not in columns:
+            columns = list(columns) + ['module_number']
+        mask = None if module is None else (lambda res: res['module_number'] == module)
+        return self._select(self._calibration, start, end, columns, mask)
+
+    def find(self, file_id) -> dict | None:
+        """Last run recorded for file_id as {column: value}"""
+        res = self._runs.read()
+        index = np.flatnonzero(res['file_id'] == file_id)
+        if len(index) == 0:
+            return None
+        return {name: values[index[-1]] for name, values in res.items()}
+
+    def trend(self, column, start = None, end = None, every = 'D', module = None):
+        """
+        Mean of a column per period, every is a numpy datetime unit ('h', 'D', 'W', 'M').
+        Returns (periods as datetime64, means), nan values are skipped.
+        Columns of the pedestals are looked up there, optionally for one module
+        """
+        if column in run_columns:
+            dtype = run_columns[column]
+            res = self.runs(start, end, [column])
+        elif column in calibration_columns:
+            dtype = calibration_columns[column]
+            res = self.calibration(start, end, module, [column])
+        else:
+            raise ValueError(f'Unknown column: {column}')
+        if dtype == 'str':
+            raise ValueError(f'{column} is not a number')
+        periods = (res['time'] * 1e6).astype('datetime64[us]').astype(f'datetime64[{every}]')
+        values = res[column].astype('f8')
+        ok = ~np.isnan(values) if dtype == 'f8' else values != -1
+        keys, inverse = np.unique(periods[ok], return_inverse = True)
+        sums = np.bincount(inverse, weights = values[ok], minlength = len(keys))
+        counts = np.bincount(inverse, minlength = len(keys))
+        return keys, sums / np.maximum(counts, 1)
+
+    def pedestal_drift(self, gain = 'g0', start = None, end = None) -> dict:
+        """
+        {module: (times as datetime64, change of the mean pedestal since the
+        first pedestal in the range)} for gain g0, g1 or g2
+        """
+        column = f'pedestal_{gain}_mean'
+        if column not in calibration_columns:
+            raise ValueError(f'Unknown gain: {gain}')
+        res = self.calibration(start, end, columns = [column, 'module_number'])
+        drift = {}
+        for module in np.unique(res['module_number']):
+            mask = res['module_number'] == module
+            values = res[column][mask]
+            times = (res['time'][mask] * 1e6).astype('datetime64[us]')
+            drift[int(module)] = (times, values - values[0])
+        return drift
+
+    def to_hdf5(self, path):
+        """Write all tables to an HDF5 file, needs h5py"""
+        import h5py
+        with h5py.File(path, 'w') as file:
+            for group, table in (('runs', self._runs), ('calibration', self._calibration)):
+                g = file.create_group(group)
+                for name, values in table.read().items():
+                    if values.dtype == object:
+                        g.create_dataset(name, data = values.astype(str).astype(object),
+                                         dtype = h5py.string_dtype())
+                    else:
+                        g.create_dataset(name, data = values)
@@ -0,0 +1,126 @@
+import json
+from datetime import datetime
+
+from .schema import schema, string_keys, list_keys
+
+# Reading the history stream written by the scripts in epoc.scripts. Each
+# write is an entry with op, key, old, new and host, and every few writes
+# (and on clear) a checkpoint entry holds all values as json. The state at
+# any point is rebuilt from the closest earlier checkpoint, so only the
+# writes since then have to be read.
+
+# Entries read per request when walking the stream
+_batch = 200
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+def _entry(entry_id, fields) -> dict:
+    res = {_text(k): _text(v) for k, v in fields.items()}
+    res['id'] = _text(entry_id)
+    return res
+
+def entry_time(entry) -> datetime:
+    """Time of an entry, from the milliseconds in its id"""
+    return datetime.fromtimestamp(int(entry['id'].split('-')[0]) / 1000)
+
+def time_id(when : datetime) -> int:
+    """Milliseconds used in the ids of the entries written at when"""
+    return int(when.timestamp() * 1000)
+
+def raw_value(key, value):
+    """Value as the server returns it, from the string in an entry"""
+    if schema[key].is_list:
+        if value is None:
+            return []
+        items = json.loads(value)
+        #cjson encodes an empty list as {}
+        return [item.encode() for item in items] if isinstance(items, list) else []
+    return None if value is None else value.encode()
+
+def _checkpoint(entry) -> dict:
+    state = json.loads(entry['state'])
+    res = {}
+    for key in string_keys:
+        res[key] = raw_value(key, state.get(key))
+    for key in list_keys:
+        items = state.get(key)
+        res[key] = [item.encode() for item in items] if isinstance(items, list) else []
+    return res
+
+
+def scan(client, stream, min = '-', max = '+', reverse = False):
+    """Decoded entries between min and max, newest first if reverse"""
+    while True:
+        if reverse:
+            res = client.xrevrange(stream, max, min, count = _batch)
+        else:
+            res = client.xrange(stream, min, max, count = _batch)
+        for entry_id, fields in res:
+            yield _entry(entry_id, fields)
+        if len(res) < _batch:
+            return
+        last = '(' + _text(res[-1][0])
+        if reverse:
+            max = last
+        else:
+            min = last
+
+def latest(client, stream, count) -> list[dict]:
+    """The last count writes, oldest first. Checkpoints are skipped"""
+    res = []
+    for entry in scan(client, stream, reverse = True):
+        if entry['op'] == 'checkpoint':
+            continue
+        res.append(entry)
+        if len(res) == count:
+            break
+    return res[::-1]
+
+def find_file_id(client, stream, file_id) -> str | None:
+    """
+    Id of the entry that used file_id, None if it is not in the history.
+    Only reservations count, setting file_id by hand skips ids without using them
+    """
+    for entry in scan(client, stream, reverse = True):
+        if entry.get('key') == 'file_id' and entry['op'] in ('reserve', 'incrby'):
+            old = int(entry.get('old') or 0)
+            if old <= file_id < int(entry['new']):
+                return entry['id']
+    return None
+
+def state(client, stream, end, after, current) -> dict:
+    """
+    Raw values of all keys as they were at end, a bound for XREVRANGE.
+    after: the first id that is later than end, a bound for XRANGE
+    current: function returning the raw values now, used when there is no
+    earlier checkpoint and a key was not written since
+    """
+    writes = []
+    res = None
+    for entry in scan(client, stream, max = end, reverse = True):
+        if entry['op'] == 'checkpoint':
+            res = _checkpoint(entry)
+            break
+        writes.append(entry)
+
+    if res is None:
+        #Older entries were trimmed. A key that was written later had the old
+        #value of the first such write, others still have their current value
+        res = current()
+        unknown = set(schema)
+        for entry in scan(client, stream, min = after):
+            if entry['op'] == 'checkpoint':
+                values = _checkpoint(entry)
+                res.update({key: values[key] for key in unknown})
+                break
+            key = entry.get('key')
+            if key in unknown:
+                unknown.discard(key)
+                res[key] = raw_value(key, entry.get('old'))
+
+    for entry in reversed(writes):
+        if entry.get('key') in schema:
+            res[entry['key']] = raw_value(entry['key'], entry.get('new'))
+    return res
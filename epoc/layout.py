@@ -0,0 +1,122 @@
+from .schema import schema, string_keys, list_keys
+from .string_op import sanitize_label
+
+# Prefix of the keys used by namespaced configurations
+_prefix = 'epoc'
+
+
+class FlatLayout:
+    """
+    Every value is a separate key in the db, for example PI_name and
+    overlays. One configuration per db.
+
+    Commands are sent to client, which can be a Redis client, a pipeline
+    or an asyncio client, so the same layout is used by all of them.
+    """
+    instrument = None
+    #Hash with the string values, see HashLayout
+    hash = None
+
+    def __repr__(self):
+        return 'FlatLayout()'
+
+    def redis_key(self, key):
+        """Redis key holding key, used for notifications"""
+        return key
+
+    def redis_keys(self):
+        """All Redis keys of the configuration"""
+        return string_keys + list_keys
+
+    def history_key(self):
+        """Stream with the changes of the configuration, see epoc.history"""
+        return f'{_prefix}:history'
+
+    def script_keys(self, keys):
+        """Redis keys to declare for a script that accesses keys"""
+        return keys
+
+    def get(self, client, key):
+        return client.get(key)
+
+    def mget(self, client, keys):
+        return client.mget(keys)
+
+    def set(self, client, key, value):
+        return client.set(key, value)
+
+    def incrby(self, client, key, amount):
+        return client.incrby(key, amount)
+
+    def queue_fetch(self, pipe):
+        """Queue reading all string keys, parse the result with parse_fetch"""
+        pipe.mget(string_keys)
+
+    def parse_fetch(self, res) -> dict:
+        return dict(zip(string_keys, res))
+
+    def get_cached(self, cache, client, key):
+        return cache.fetch(key, client.get)
+
+
+class HashLayout(FlatLayout):
+    """
+    All string values of an instrument in one hash, epoc:<instrument>, so
+    HGETALL reads the whole configuration in one command. Lists are kept
+    in epoc:<instrument>:<key>
+    """
+    def __init__(self, instrument):
+        if not isinstance(instrument, str) or not instrument or sanitize_label(instrument) != instrument:
+            raise ValueError(f'Invalid instrument name, use letters, digits, - and _ only. Got: {instrument}')
+        #epoc:history is the history of the flat layout
+        if instrument == 'history':
+            raise ValueError('history can not be used as instrument name')
+        self.instrument = instrument
+        self.hash = f'{_prefix}:{instrument}'
+
+    def __repr__(self):
+        return f'HashLayout({self.instrument!r})'
+
+    def redis_key(self, key):
+        if schema[key].is_list:
+            return f'{self.hash}:{key}'
+        return self.hash
+
+    def redis_keys(self):
+        return [self.hash] + [self.redis_key(key) for key in list_keys]
+
+    def history_key(self):
+        return f'{self.hash}:history'
+
+    def script_keys(self, keys):
+        return [self.hash]
+
+    def get(self, client, key):
+        return client.hget(self.hash, key)
+
+    def mget(self, client, keys):
+        return client.hmget(self.hash, keys)
+
+    def set(self, client, key, value):
+        return client.hset(self.hash, key, value)
+
+    def incrby(self, client, key, amount):
+        return client.hincrby(self.hash, key, amount)
+
+    def queue_fetch(self, pipe):
+        pipe.hgetall(self.hash)
+
+    def parse_fetch(self, res) -> dict:
+        values = {field.decode() if isinstance(field, bytes) else field: value for field, value in res.items()}
+        return {key: values.get(key) for key in string_keys}
+
+    def get_cached(self, cache, client, key):
+        #The whole hash is one entry, invalidated by any change to it
+        return cache.fetch(self.hash, lambda name: self.parse_fetch(client.hgetall(name)))[key]
+
+
+def layout(instrument = None) -> FlatLayout:
+    """Layout for instrument, the flat layout if instrument is None"""
+    if instrument is None:
+        return FlatLayout()
+    return HashLayout(instrument)
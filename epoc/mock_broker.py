@@ -0,0 +1,228 @@
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stand in for the HTTP API of jfjoch_broker, for tests and benchmarks of
+# JungfraujochWrapper without a detector. Only the endpoints used by the
+# wrapper are served. States follow the broker:
+#
+#   Inactive --initialize--> Busy --init_time--> Idle
+#   Idle --start--> Busy --arm_time--> Measuring --images done--> Idle
+#   Measuring --cancel--> Busy --cancel_time--> Idle
+#   Idle --pedestal--> Pedestal --pedestal_time--> Idle
+#
+# Like the real broker without async_start, /start returns once the
+# detector is armed. Transitions are applied when a request comes in.
+
+
+class MockBroker:
+    """
+    Local HTTP server with a simulated broker state machine, times in seconds.
+    The measurement takes images * image_time_us like on the detector,
+    scaled by time_scale. requests counts the requests per path.
+
+    with MockBroker(arm_time = 0.05) as broker:
+        j = JungfraujochWrapper(broker.url)
+        j.start(100, wait = True)
+    """
+    def __init__(self, port = 0, arm_time = 0.05, cancel_time = 0.02, init_time = 0.1,
+                 pedestal_time = 0.2, time_scale = 1.0, initialized = True, modules = 2):
+        self.arm_time = arm_time
+        self.cancel_time = cancel_time
+        self.init_time = init_time
+        self.pedestal_time = pedestal_time
+        self.time_scale = time_scale
+        self.modules = modules
+        self.requests = Counter()
+
+        self._lock = threading.Lock()
+        self._state = 'Idle' if initialized else 'Inactive'
+        self._start = None
+        #When the current state ends and what happens then
+        self._end = None
+        self._then = None
+        self._run = None
+        #True from a start until the measurement is over or cancelled
+        self._active = False
+        self._calibration = []
+        #Counted like the run_number of the broker
+        self._runs = 0
+        self._pedestals = 0
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target = self._server.serve_forever, args = (0.05,), daemon = True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f'MockBroker({self.url}, state={self.state})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._advance()
+            return self._state
+
+    def _set(self, state, duration = None, then = None, at = None):
+        self._state = state
+        self._start = time.monotonic() if at is None else at
+        self._end = None if duration is None else self._start + duration
+        self._then = then
+
+    def _advance(self):
+        """Apply the transitions that are due"""
+        now = time.monotonic()
+        while self._end is not None and now >= self._end:
+            end, then = self._end, self._then
+            self._end = self._then = None
+            then(end)
+
+    def _progress(self):
+        if self._state != 'Measuring':
+            return None
+        if self._end == self._start:
+            return 1.0
+        return min((time.monotonic() - self._start) / (self._end - self._start), 1.0)
+
+    def _finish(self, cancelled):
+        self._active = False
+        run = self._run
+        images = run['images_expected']
+        if cancelled:
+            images = int(images * self._progress()) if self._state == 'Measuring' else 0
+        run['images_collected'] = images
+        run['images_sent'] = images
+        run['images_written'] = images if run['file_prefix'] else 0
+        run['max_image_number_sent'] = max(images - 1, 0)
+        run['collection_efficiency'] = 1.0
+        run['compression_ratio'] = 7.5
+        run['cancelled'] = cancelled
+
+    # Endpoints, return (http status, json body or None)
+
+    def status(self):
+        res = {'state': self._state}
+        progress = self._progress()
+        if progress is not None:
+            res['progress'] = progress
+        if self._state == 'Inactive':
+            res['message'] = 'Detector not initialized'
+        return 200, res
+
+    def initialize(self):
+        self._set('Busy', self.init_time, lambda at: self._set('Idle', at = at))
+        return 200, None
+
+    def start(self, settings):
+        if self._state != 'Idle':
+            return 500, {'msg': f'Cannot start in state {self._state}', 'reason': 'WrongDAQState'}
+        images = settings.get('images_per_trigger', 1) * settings.get('ntrigger', 1)
+        duration = images * settings.get('image_time_us', 1000) * 1e-6 * self.time_scale
+        self._runs += 1
+        self._run = {'run_number': self._runs, 'file_prefix': settings.get('file_prefix', ''),
+                     'images_expected': images, 'images_collected': 0, 'detector_width': 1030, 'detector_height': 514 * self.modules}
+
+        def done(at):
+            self._finish(False)
+            self._set('Idle', at = at)
+
+        self._active = True
+        self._set('Busy', self.arm_time, lambda at: self._set('Measuring', duration, done, at = at))
+        return 200, None
+
+    def cancel(self):
+        if self._active:
+            self._finish(True)
+            self._set('Busy', self.cancel_time, lambda at: self._set('Idle', at = at))
+        return 200, None
+
+    def pedestal(self):
+        if self._state != 'Idle':
+            return 500, {'msg': f'Cannot collect pedestal in state {self._state}', 'reason': 'WrongDAQState'}
+
+        def done(at):
+            #The pedestal drifts a little with every run
+            self._pedestals += 1
+            self._calibration = [{'module_number': m, 'storage_cell_number': 0,
+                                  'pedestal_g0_mean': 3000.0 + m + 0.1 * self._pedestals, 'pedestal_g1_mean': 14000.0 + m,
+                                  'pedestal_g2_mean': 15000.0 + m, 'gain_g0_mean': 40.0,
+                                  'gain_g1_mean': -1.5, 'gain_g2_mean': -0.1, 'masked_pixels': 10 * m}
+                                 for m in range(self.modules)]
+            self._set('Idle', at = at)
+
+        self._set('Pedestal', self.pedestal_time, done)
+        return 200, None
+
+    def statistics_calibration(self):
+        return 200, self._calibration
+
+    def statistics_data_collection(self):
+        return 200, self._run or {}
+
+    def _dispatch(self, method, path, body):
+        self.requests[path] += 1
+        routes = {
+            ('GET', '/status'): self.status,
+            ('GET', '/statistics/calibration'): self.statistics_calibration,
+            ('GET', '/statistics/data_collection'): self.statistics_data_collection,
+            ('POST', '/initialize'): self.initialize,
+            ('POST', '/start'): lambda: self.start(body or {}),
+            ('POST', '/cancel'): self.cancel,
+            ('POST', '/pedestal'): self.pedestal,
+        }
+        if (method, path) not in routes:
+            return 404, {'msg': f'{method} {path} not served by MockBroker'}
+        with self._lock:
+            self._advance()
+            res = routes[method, path]()
+        #Like the broker, /start returns once the detector is armed
+        if path == '/start' and res[0] == 200:
+            time.sleep(self.arm_time)
+        return res
+
+
+def _handler(broker):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        #Headers and body are written separately, avoid waiting for the ack
+        disable_nagle_algorithm = True
+
+        def _reply(self, method):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            code, res = broker._dispatch(method, self.path.split('?')[0], body)
+            data = b'' if res is None else json.dumps(res).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._reply('GET')
+
+        def do_POST(self):
+            self._reply('POST')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
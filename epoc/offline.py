@@ -0,0 +1,58 @@
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+from .schema import schema
+
+# Last known good configuration on local disk, used by ConfigurationClient
+# when the server can not be reached. Values are kept as they are stored on
+# the server, strings for string keys and lists of strings for list keys
+
+
+class LocalSnapshot:
+    """
+    Raw values of one configuration in a json file, written atomically so
+    that a crash never leaves a broken file.
+    """
+    def __init__(self, path, instrument = None):
+        self.path = Path(path)
+        self.instrument = instrument
+
+    def __repr__(self):
+        return f'LocalSnapshot({self.path}, instrument={self.instrument!r})'
+
+    def load(self) -> dict | None:
+        """{key: raw value} as returned by the server, None if there is no file"""
+        if not self.path.exists():
+            return None
+        with open(self.path, 'r') as file:
+            res = json.load(file)
+        if res.get('instrument') != self.instrument:
+            raise ValueError(f'{self.path} holds the configuration of {res.get("instrument")}, '
+                             f'not of {self.instrument}')
+        raw = {}
+        for key in schema:
+            value = res['values'].get(key)
+            if schema[key].is_list:
+                raw[key] = [item.encode() for item in value or []]
+            else:
+                raw[key] = None if value is None else value.encode()
+        return raw
+
+    def save(self, raw : dict):
+        values = {}
+        for key, value in raw.items():
+            if isinstance(value, list):
+                values[key] = [_text(item) for item in value]
+            else:
+                values[key] = None if value is None else _text(value)
+        res = {'instrument': self.instrument, 'saved': datetime.now().isoformat(), 'values': values}
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'w') as file:
+            json.dump(res, file, indent=2)
+        os.replace(tmp, self.path)
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
@@ -0,0 +1,31 @@
+from datetime import datetime
+from pathlib import Path
+
+# Where datasets are stored and how they are named:
+#   base_data_dir/experiment_class/PI_name/year/project_id   work_dir
+#   work_dir/today                                           data_dir
+#   {file_id:03d}_{project_id}_{measurement_tag}_{timestamp}_master.h5
+# Used by ConfigurationClient, AsyncConfigurationClient, AcquisitionSession
+# and the reserve_file_ids scripts, lua_fname is the same name for Lua
+
+suffix = '_master.h5'
+lua_fname = '%03d_%s_%s_%s' + suffix
+
+
+def year(now = None) -> str:
+    """YYYY of now, the current time if None"""
+    return (now or datetime.now()).strftime('%Y')
+
+def today(now = None) -> str:
+    """YYYY-MM-DD of now, the current time if None"""
+    return (now or datetime.now()).strftime('%Y-%m-%d')
+
+def timestamp(now = None) -> str:
+    """YYYY-MM-DD_HHMM of now, the current time if None"""
+    return (now or datetime.now()).strftime('%Y-%m-%d_%H%M')
+
+def work_dir(base_data_dir, experiment_class, PI_name, year, project_id) -> Path:
+    return Path(base_data_dir) / experiment_class / PI_name / year / project_id
+
+def fname(file_id, project_id, measurement_tag, timestamp) -> str:
+    return f'{file_id:03d}_{project_id}_{measurement_tag}_{timestamp}{suffix}'
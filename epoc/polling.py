@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+# Polling the state of the Jungfraujoch broker. The interval starts short
+# after every change of state and grows while nothing happens, but never gets
+# longer than a fraction of the time left, estimated from the progress. The
+# end of a measurement is seen quickly without polling fast during long runs.
+
+
+class Backoff:
+    """
+    Intervals between polls. Call reset() when the state changes and next()
+    after each poll.
+    """
+    def __init__(self, min_interval = 0.01, max_interval = 0.5, factor = 1.5):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError(f'Need 0 < min_interval <= max_interval. Got: {min_interval}, {max_interval}')
+        if factor < 1:
+            raise ValueError(f'factor must be at least 1. Got: {factor}')
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.reset()
+
+    def __repr__(self):
+        return f'Backoff({self.min_interval}, {self.max_interval}, factor={self.factor})'
+
+    def reset(self):
+        self._interval = self.min_interval
+        #Time and progress of the first sample since the reset, for the rate
+        self._first = None
+
+    def remaining(self, progress, now = None) -> float | None:
+        """Estimated seconds until progress reaches 1, None if unknown"""
+        if progress is None or self._first is None:
+            return None
+        t0, p0 = self._first
+        now = time.monotonic() if now is None else now
+        if progress <= p0 or now <= t0:
+            return None
+        return (1 - progress) * (now - t0) / (progress - p0)
+
+    def next(self, progress = None, now = None) -> float:
+        """Seconds to wait before the next poll"""
+        now = time.monotonic() if now is None else now
+        interval = self._interval
+        self._interval = min(self._interval * self.factor, self.max_interval)
+        if progress is not None:
+            if self._first is None or progress < self._first[1]:
+                self._first = (now, progress)
+            remaining = self.remaining(progress, now)
+            if remaining is not None:
+                #Poll at least twice in the time that is left
+                interval = min(interval, remaining / 2)
+        return max(interval, self.min_interval)
+
+
+class _Waiter:
+    """State of one wait, shared by wait and async_wait"""
+    def __init__(self, done, timeout, backoff, on_status):
+        self.done = done
+        self.timeout = timeout
+        self.backoff = Backoff() if backoff is None else backoff
+        self.on_status = on_status
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.state = None
+        self.first = True
+
+    def interval(self, status) -> float | None:
+        """Seconds to sleep before the next poll, None if done"""
+        changed = self.first or status.state != self.state
+        self.first = False
+        if changed:
+            self.state = status.state
+            self.backoff.reset()
+        if self.on_status is not None:
+            self.on_status(status, changed)
+        if self.done(status):
+            return None
+
+        interval = self.backoff.next(status.progress)
+        if self.deadline is not None:
+            left = self.deadline - time.monotonic()
+            if left <= 0:
+                raise TimeoutError(f'Still {self.state} after {self.timeout} s')
+            interval = min(interval, left)
+        return interval
+
+
+def wait(poll, done, timeout = None, backoff = None, on_status = None):
+    """
+    Call poll() until done(status) is true and return that status
+
+    poll: returns an object with state and progress, like status_get()
+    timeout: seconds, raises TimeoutError when exceeded, None to wait forever
+    on_status: called as on_status(status, changed) after every poll,
+    changed is True for the first status and when the state changed
+    """
+    waiter = _Waiter(done, timeout, backoff, on_status)
+    while True:
+        status = poll()
+        interval = waiter.interval(status)
+        if interval is None:
+            return status
+        time.sleep(interval)
+
+async def async_wait(poll, done, timeout = None, backoff = None, on_status = None):
+    """Same as wait for a coroutine function poll"""
+    waiter = _Waiter(done, timeout, backoff, on_status)
+    while True:
+        status = await poll()
+        interval = waiter.interval(status)
+        if interval is None:
+            return status
+        await asyncio.sleep(interval)
@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+# Progress of a measurement as a stream of samples, built from status_get()
+# and, for the number of images, statistics_data_collection_get(). Rates are
+# smoothed with an exponential moving average so that a GUI can show a
+# steady images/s and ETA, the unsmoothed rate is kept to spot drops.
+
+# States after which the measurement is over
+_final_states = ('Idle', 'Error', 'Inactive')
+
+
+class ProgressSample:
+    """
+    One sample of the detector progress
+    time: time.time() when the status was taken
+    progress: fraction of the images collected, None outside of a measurement
+    images: images collected, None if the number expected is unknown
+    rate, instant_rate: images/s smoothed and since the last sample, None if unknown
+    eta: seconds left at the smoothed rate
+    stalled: True if the progress did not move for stall_after seconds while measuring
+    """
+    __slots__ = ('time', 'state', 'progress', 'images', 'images_expected', 'rate', 'instant_rate',
+                 'eta', 'stalled')
+
+    def __init__(self, time, state, progress = None, images = None, images_expected = None,
+                 rate = None, instant_rate = None, eta = None, stalled = False):
+        self.time = time
+        self.state = state
+        self.progress = progress
+        self.images = images
+        self.images_expected = images_expected
+        self.rate = rate
+        self.instant_rate = instant_rate
+        self.eta = eta
+        self.stalled = stalled
+
+    def __repr__(self):
+        rate = 'None' if self.rate is None else f'{self.rate:.1f}'
+        eta = 'None' if self.eta is None else f'{self.eta:.1f}'
+        return (f'ProgressSample({self.state}, progress={self.progress}, images={self.images}, '
+                f'rate={rate}, eta={eta}, stalled={self.stalled})')
+
+
+class ProgressTracker:
+    """
+    Turns detector status into ProgressSample. Used by samples() and
+    async_samples(), call update() with every new status.
+    smoothing: weight of the newest rate in the moving average, 1 for none
+    """
+    def __init__(self, smoothing = 0.3, stall_after = 2.0):
+        if not 0 < smoothing <= 1:
+            raise ValueError(f'smoothing must be in (0, 1]. Got: {smoothing}')
+        self.smoothing = smoothing
+        self.stall_after = stall_after
+        #Set from the statistics when a measurement starts
+        self.images_expected = None
+        self._state = None
+        self._last = None
+        self._rate = None
+        self._moved = None
+
+    def needs_statistics(self, status) -> bool:
+        """True if images_expected should be read for this status"""
+        return status.state == 'Measuring' and self._state != 'Measuring'
+
+    def update(self, status, t = None, statistics = None) -> ProgressSample:
+        t = time.time() if t is None else t
+        if status.state != self._state:
+            self._last = self._rate = None
+            self._moved = t
+            if status.state == 'Measuring':
+                self.images_expected = None
+            self._state = status.state
+        if statistics is not None and statistics.images_expected:
+            self.images_expected = statistics.images_expected
+
+        progress = status.progress if status.state == 'Measuring' else None
+        instant = None
+        if progress is not None:
+            if self._last is not None:
+                t0, p0 = self._last
+                if t > t0:
+                    instant = (progress - p0) / (t - t0)
+                    self._rate = instant if self._rate is None else \
+                        self.smoothing * instant + (1 - self.smoothing) * self._rate
+                if progress > p0:
+                    self._moved = t
+            self._last = (t, progress)
+
+        sample = ProgressSample(t, status.state, progress, images_expected = self.images_expected)
+        sample.stalled = status.state == 'Measuring' and t - self._moved >= self.stall_after
+        if self._rate is not None and self._rate > 0:
+            sample.eta = (1 - progress) / self._rate
+        if self.images_expected is not None:
+            n = self.images_expected
+            if progress is not None:
+                sample.images = int(progress * n)
+            if self._rate is not None:
+                sample.rate = self._rate * n
+                sample.instant_rate = None if instant is None else instant * n
+        return sample
+
+
+def samples(status, statistics = None, interval = 0.2, until_idle = True, **kwargs):
+    """
+    Generator of ProgressSample, one every interval seconds
+    status: function returning the detector status, like status_get()
+    statistics: function returning statistics_data_collection_get(), for images
+    until_idle: stop at the first Idle, Error or Inactive status, otherwise run forever
+    kwargs: passed to ProgressTracker
+    """
+    tracker = ProgressTracker(**kwargs)
+    next_sample = time.monotonic()
+    while True:
+        s = status()
+        stats = statistics() if statistics is not None and tracker.needs_statistics(s) else None
+        sample = tracker.update(s, statistics = stats)
+        yield sample
+        if until_idle and sample.state in _final_states:
+            return
+        next_sample = max(next_sample + interval, time.monotonic())
+        time.sleep(next_sample - time.monotonic())
+
+async def async_samples(status, statistics = None, interval = 0.2, until_idle = True, **kwargs):
+    """Same as samples for coroutine functions status and statistics"""
+    tracker = ProgressTracker(**kwargs)
+    next_sample = time.monotonic()
+    while True:
+        s = await status()
+        stats = await statistics() if statistics is not None and tracker.needs_statistics(s) else None
+        sample = tracker.update(s, statistics = stats)
+        yield sample
+        if until_idle and sample.state in _final_states:
+            return
+        next_sample = max(next_sample + interval, time.monotonic())
+        await asyncio.sleep(next_sample - time.monotonic())
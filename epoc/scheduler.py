@@ -0,0 +1,198 @@
+import time
+import warnings
+from collections import deque
+
+from . import paths
+
+#Seconds to wait at most for the detector to become idle after a failed job
+_cleanup_timeout = 10
+
+
+class AcquisitionJob:
+    """
+    One dataset in the queue of an AcquisitionScheduler. Extra keyword
+    arguments, for example beam_x_pxl, are passed to JungfraujochWrapper.start.
+    path, file_id, times (time.monotonic() of start, running and idle),
+    statistics and error, if the job failed, are filled in by the scheduler.
+    """
+    def __init__(self, n_images, threshold = 0, measurement_tag = None,
+                 pedestal_before = False, pedestal_after = False, **settings):
+        n_images = int(n_images)
+        if n_images < 1:
+            raise ValueError(f'Number of images must be positive. Got: {n_images}')
+        self.n_images = n_images
+        self.threshold = threshold
+        self.measurement_tag = measurement_tag
+        self.pedestal_before = pedestal_before
+        self.pedestal_after = pedestal_after
+        self.settings = settings
+        self.path = None
+        self.file_id = None
+        self.times = {}
+        self.statistics = None
+        self.error = None
+
+    def __repr__(self):
+        return f'AcquisitionJob({self.n_images}, threshold={self.threshold}, path={self.path})'
+
+    @property
+    def file_prefix(self) -> str:
+        """Passed to the broker, which appends _master.h5"""
+        return str(self.path).removesuffix(paths.suffix)
+
+    @property
+    def duration(self) -> float | None:
+        """Seconds from the start request until the detector was idle again"""
+        if 'idle' not in self.times:
+            return None
+        return self.times['idle'] - self.times['start']
+
+
+class AcquisitionScheduler:
+    """
+    Runs a queue of AcquisitionJob back to back. Live mode is stopped before
+    the first job and resumed after the last one. The path of the next job is
+    prepared and last_dataset of the previous one is recorded while the
+    detector measures, so only the start request is between two datasets.
+    If a job fails it is put back at the front of the queue with its error,
+    the detector is cancelled and live mode is resumed if the detector can
+    still be reached. The error of the job is raised, problems while cleaning
+    up are only warned about.
+    The statistics of each dataset are read when it is done, one more request
+    per dataset, so that a short dataset that is over before the first status
+    request is not waited for. If the detector has a DetectorStatsStore they
+    are recorded while the next one runs.
+
+    scheduler = AcquisitionScheduler(JungfraujochWrapper(host), cfg)
+    scheduler.add(1000, threshold = 5, measurement_tag = 'Lysozyme', pedestal_before = True)
+    scheduler.add(1000, measurement_tag = 'Lysozyme_2')
+    jobs = scheduler.run()
+    scheduler.dead_times()
+    """
+    def __init__(self, detector, cfg, live = True, timeout = None, n = 10):
+        self.detector = detector
+        self.cfg = cfg
+        #Resume live mode when the queue is done
+        self.live = live
+        #Seconds to wait at most for each dataset, None to wait forever
+        self.timeout = timeout
+        #file_ids reserved at a time
+        self._n = n
+        self._queue = deque()
+        self.done = []
+        self._store = getattr(detector, 'store', None)
+
+    def __repr__(self):
+        return f'AcquisitionScheduler(queued: {len(self._queue)}, done: {len(self.done)})'
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, n_images, **kwargs) -> AcquisitionJob:
+        """Queue an AcquisitionJob, or create one from the arguments"""
+        job = n_images if isinstance(n_images, AcquisitionJob) else AcquisitionJob(n_images, **kwargs)
+        self._queue.append(job)
+        return job
+
+    def _idle(self):
+        self.detector.wait_until_idle(quiet = True, timeout = self.timeout)
+
+    def _pedestal(self):
+        self.detector.collect_pedestal(wait = True, timeout = self.timeout)
+
+    @staticmethod
+    def _prepare(session, job):
+        job.file_id = session.next_id()
+        job.path = session.path(job.file_id, job.measurement_tag)
+
+    def _finished(self, session, job):
+        session.finished(job.path)
+        if self._store is not None and job.statistics is not None:
+            self._store.record_run(job.statistics, job.file_id, job.path)
+
+    def _cleanup(self, session, previous):
+        """After a failed job, warn instead of raising so that its error is kept"""
+        if previous is not None:
+            try:
+                self._finished(session, previous)
+            except Exception as e:
+                warnings.warn(f'Could not record {previous.path}: {e!r}')
+        if not self.live:
+            return
+        try:
+            self.detector.cancel()
+            self.detector.wait_until_idle(quiet = True, timeout = _cleanup_timeout)
+        except Exception as e:
+            warnings.warn(f'Could not reach the detector, live mode not resumed: {e!r}')
+            return
+        try:
+            self.detector.live()
+        except Exception as e:
+            warnings.warn(f'Could not resume live mode: {e!r}')
+
+    def run(self) -> list[AcquisitionJob]:
+        """Run all queued jobs and return the ones that finished"""
+        jobs = []
+        if not self._queue:
+            return jobs
+        j = self.detector
+        with self.cfg.session(min(self._n, len(self._queue))) as session:
+            #Done but last_dataset and statistics not recorded yet
+            previous = None
+            job = None
+            try:
+                self._prepare(session, self._queue[0])
+                j.cancel()
+                self._idle()
+                last = j.last_run()
+                session.wait()
+
+                while self._queue:
+                    job = self._queue.popleft()
+                    job.times = {}
+                    job.error = None
+                    if job.pedestal_before:
+                        self._pedestal()
+
+                    job.times['start'] = time.monotonic()
+                    j.start(job.n_images, fname = job.file_prefix, th = job.threshold, **job.settings)
+                    job.times['running'] = time.monotonic()
+
+                    #While the detector measures
+                    if previous is not None:
+                        self._finished(session, previous)
+                        previous = None
+                    if self._queue:
+                        self._prepare(session, self._queue[0])
+
+                    j.wait_until_started(before = last)
+                    self._idle()
+                    job.times['idle'] = time.monotonic()
+                    job.statistics = j.api_instance.statistics_data_collection_get()
+                    last = j.last_run(stats = job.statistics)
+                    jobs.append(job)
+                    self.done.append(job)
+                    previous, job = job, None
+                    if previous.pedestal_after:
+                        self._pedestal()
+            except BaseException as e:
+                if job is not None:
+                    #Run again with a new file_id on the next run()
+                    job.error = e
+                    self._queue.appendleft(job)
+                self._cleanup(session, previous)
+                raise
+
+            if previous is not None:
+                self._finished(session, previous)
+            if self.live:
+                j.live()
+        return jobs
+
+    def dead_times(self, jobs = None) -> list[float]:
+        """
+        Seconds between the end of a dataset and the next one running,
+        including arming the detector
+        """
+        jobs = self.done if jobs is None else jobs
+        return [b.times['running'] - a.times['idle'] for a, b in zip(jobs, jobs[1:])]
@@ -0,0 +1,153 @@
+import json
+from pathlib import Path
+
+from .string_op import sanitize_label
+
+# Keys stored on the server and how they are converted. The properties of
+# ConfigurationClient and AsyncConfigurationClient, snapshots, from_yaml,
+# dump and to_yaml are all generated from this schema
+
+encoding = 'utf-8'
+experiment_classes = ['UniVie', 'External', 'IP']
+default_rotation_speed_idx = 2
+
+# Default of keys that must be set before they are read
+_required = object()
+
+
+def _text(raw):
+    return raw.decode(encoding)
+
+def _path(raw):
+    return Path(raw.decode(encoding))
+
+def _json(raw):
+    return json.loads(raw.decode(encoding))
+
+def _posix(value):
+    return Path(value).as_posix()
+
+def _same(value):
+    return value
+
+def check_rotation_speed_idx(value) -> int:
+    value = int(value)
+    if value not in [0, 1, 2, 3]:
+        raise ValueError('Invalid rotation speed. Possible values are 0, 1, 2, 3')
+    return value
+
+def check_experiment_class(value) -> str:
+    if value not in experiment_classes:
+        raise ValueError(f'Invalid experiment class. Possible values are: {experiment_classes}. Got: {value}')
+    return value
+
+
+class Key:
+    """
+    A value stored on the server
+    decode: raw bytes from the server to the value
+    encode: value to what is written, raises ValueError for invalid values
+    default: returned when the key is not set, nothing is written. If not
+    given reading the key raises ValueError
+    is_list: stored as a list, decode and encode are applied per item
+    """
+    def __init__(self, name, decode, encode = _same, default = _required,
+                 read_only = False, is_list = False, doc = None):
+        self.name = name
+        self.decode = decode
+        self.encode = encode
+        self.default = default
+        self.read_only = read_only
+        self.is_list = is_list
+        self.doc = doc
+
+    def __repr__(self):
+        return f'Key({self.name})'
+
+    def from_raw(self, raw):
+        """Value from the raw reply of GET or LRANGE"""
+        if self.is_list:
+            return [self.decode(item) for item in raw or []]
+        if raw is None:
+            if self.default is _required:
+                raise ValueError(f'{self.name} not set')
+            return self.default
+        return self.decode(raw)
+
+    def to_raw(self, value):
+        """Validated value to write, a list of items for list keys"""
+        if self.is_list:
+            return [self.encode(item) for item in value]
+        return self.encode(value)
+
+
+schema = {key.name: key for key in [
+    Key('PI_name', _text, sanitize_label),
+    Key('project_id', _text, sanitize_label),
+    Key('last_dataset', _path, _posix, default = None,
+        doc = 'Path to the last dataset that was recorded.\nCan be used to trigger processing'),
+    Key('XDS_template', _path, _posix),
+    Key('rotation_speed_idx', int, check_rotation_speed_idx, default = default_rotation_speed_idx,
+        doc = 'Index of the rotation speed, 2 (1deg/s) if not set'),
+    Key('file_id', int, int, default = 0, doc = 'Unique identifier for the current dataset'),
+    Key('nrows', int, int),
+    Key('ncols', int, int),
+    Key('beam_center', _json, json.dumps),
+    Key('threshold', int, int, doc = 'Threshold that is applied after conversion but before summing of images.'),
+    Key('viewer_interval', float, float),
+    Key('viewer_cmin', float, float),
+    Key('viewer_cmax', float, float),
+    Key('base_data_dir', _path, _posix),
+    Key('measurement_tag', _text, sanitize_label,
+        doc = 'Tag to identify the current measurement. will be part of the filename'),
+    Key('experiment_class', _text, check_experiment_class),
+    Key('mag_value_diff', float, float),
+    Key('mag_value_img', float, float),
+    Key('receiver_endpoint', _text),
+    Key('cal_dir', _path, _posix),
+    Key('frames_to_sum', int, int),
+    Key('temserver', _text, doc = 'ZMQ Endpoint for the TEM server\nFor example: tcp://TEM-pc:5555'),
+    Key('jfjoch_host', _text),
+    Key('overlays', _json, json.dumps, is_list = True, doc = 'Overlays to be drawn in the GUI'),
+]}
+
+# Keys stored as plain strings, fetched together with one MGET
+string_keys = [name for name, key in schema.items() if not key.is_list]
+list_keys = [name for name, key in schema.items() if key.is_list]
+
+# Values generated from the stored keys and the current time
+derived_keys = ['data_dir', 'work_dir', 'fname', 'fpath', 'log_fpath', 'today', 'year', 'timestamp']
+
+
+def decode_all(raw : dict, skip_unset = False) -> dict:
+    """
+    Decode {key: raw reply} in one pass. Unset keys get their default.
+    Unset keys without default, or with None, raise ValueError, or are left
+    out if skip_unset is True
+    """
+    res = {}
+    for name, value in raw.items():
+        key = schema.get(name)
+        if key is None:
+            raise ValueError(f'Unknown key: {name}')
+        if skip_unset and value is None and not key.is_list and (key.default is _required or key.default is None):
+            continue
+        res[name] = key.from_raw(value)
+    return res
+
+def encode_all(values : dict) -> dict:
+    """
+    Validate and encode {key: value} before anything is written. Raises
+    ValueError for unknown or read only keys and invalid values, also for
+    values of the wrong type
+    """
+    res = {}
+    for name, value in values.items():
+        key = schema.get(name)
+        if key is None or key.read_only:
+            raise ValueError(f'Unknown or read only key: {name}')
+        try:
+            res[name] = key.to_raw(value)
+        except TypeError as e:
+            raise ValueError(f'{name}: {e}')
+    return res
@@ -0,0 +1,288 @@
+import json
+from datetime import datetime
+
+from .schema import string_keys, list_keys
+from . import paths as _paths
+
+# Server side scripts for all writes of ConfigurationClient. Each write
+# and its entry in the history stream run atomically in one round trip.
+# Every script starts with the same ARGV:
+#   1 hash of a namespaced configuration, '' for plain keys (see epoc.layout)
+#   2 history stream, '' to not record history
+#   3 host name stored with each entry
+#   4 approximate maximum length of the stream
+#   5 write a checkpoint with all values every ARGV[5] writes
+# KEYS declares the written key and the stream, but the scripts also read
+# every key for checkpoints and count writes in <stream>:writes, so they need
+# a single Redis node and do not work on Redis Cluster.
+# Backends without scripting use the Python versions through backend.call()
+
+def _lua_list(names):
+    return '{' + ', '.join(f"'{name}'" for name in names) + '}'
+
+_prelude = f"""
+local hash = ARGV[1] ~= '' and ARGV[1] or nil
+local stream = ARGV[2] ~= '' and ARGV[2] or nil
+local string_keys = {_lua_list(string_keys)}
+local list_keys = {_lua_list(list_keys)}
+
+local function list_name(key)
+    if hash then return hash .. ':' .. key end
+    return key
+end
+local function get(key)
+    if hash then return redis.call('HGET', hash, key) end
+    return redis.call('GET', key)
+end
+local function set(key, value)
+    if hash then return redis.call('HSET', hash, key, value) end
+    return redis.call('SET', key, value)
+end
+local function incrby(key, n)
+    if hash then return redis.call('HINCRBY', hash, key, n) end
+    return redis.call('INCRBY', key, n)
+end
+local function get_list(key)
+    return redis.call('LRANGE', list_name(key), 0, -1)
+end
+-- cjson encodes an empty table as an object
+local function encode_list(items)
+    if #items == 0 then return '[]' end
+    return cjson.encode(items)
+end
+
+local function checkpoint()
+    local state = {{}}
+    for _, key in ipairs(string_keys) do
+        local value = get(key)
+        if value then state[key] = value end
+    end
+    for _, key in ipairs(list_keys) do
+        state[key] = get_list(key)
+    end
+    redis.call('XADD', stream, 'MAXLEN', '~', ARGV[4], '*', 'op', 'checkpoint', 'state', cjson.encode(state), 'host', ARGV[3])
+end
+
+local function record(op, key, old, new)
+    if not stream then return end
+    local entry = {{'op', op, 'key', key, 'new', new, 'host', ARGV[3]}}
+    if old then
+        entry[#entry + 1] = 'old'
+        entry[#entry + 1] = old
+    end
+    redis.call('XADD', stream, 'MAXLEN', '~', ARGV[4], '*', unpack(entry))
+    if redis.call('INCR', stream .. ':writes') % tonumber(ARGV[5]) == 0 then
+        checkpoint()
+    end
+end
+"""
+
+# ARGV[6] operation, ARGV[7] key, ARGV[8...] values
+#   set: store ARGV[8]
+#   list: replace the list with ARGV[8...]
+#   append: append ARGV[8...] to the list
+#   incrby: add ARGV[8], returns the new value
+#   clear: remove all keys of the configuration, the history is kept
+write_lua = _prelude + """
+local op, key = ARGV[6], ARGV[7]
+if op == 'set' then
+    local old = get(key)
+    set(key, ARGV[8])
+    record(op, key, old, ARGV[8])
+elseif op == 'list' or op == 'append' then
+    local old = encode_list(get_list(key))
+    if op == 'list' then
+        redis.call('DEL', list_name(key))
+    end
+    if #ARGV > 7 then
+        redis.call('RPUSH', list_name(key), unpack(ARGV, 8))
+    end
+    record(op, key, old, encode_list(get_list(key)))
+elseif op == 'incrby' then
+    local old = get(key)
+    local new = incrby(key, ARGV[8])
+    record(op, key, old, tostring(new))
+    return new
+elseif op == 'clear' then
+    for _, name in ipairs(list_keys) do
+        redis.call('DEL', list_name(name))
+    end
+    if hash then
+        redis.call('DEL', hash)
+    else
+        redis.call('DEL', unpack(string_keys))
+    end
+    if stream then checkpoint() end
+else
+    return redis.error_reply('Unknown operation: ' .. op)
+end
+return 1
+"""
+
+# Reserve ARGV[6] consecutive file_ids and return the next free id followed
+# by the dataset paths. Paths are built the same way as data_dir / fname.
+# If ARGV[7] is 1 the last path is also stored in last_dataset. If ARGV[11]
+# is 0 only the next free id is returned, no paths are built.
+# Runs atomically on the server so two PCs can never get the same file_id
+reserve_file_ids_lua = _prelude + """
+local n = tonumber(ARGV[6])
+if ARGV[11] == '0' then
+    local old_id = get('file_id')
+    local next_id = incrby('file_id', n)
+    record('reserve', 'file_id', old_id, tostring(next_id))
+    return {next_id}
+end
+
+local names = {'base_data_dir', 'experiment_class', 'PI_name', 'project_id', 'measurement_tag'}
+local values = {}
+for i, name in ipairs(names) do
+    values[i] = get(name)
+    if not values[i] then
+        return redis.error_reply(name .. ' not set')
+    end
+end
+local base = string.gsub(values[1], '/+$', '')
+local dir = table.concat({base, values[2], values[3], ARGV[8], values[4], ARGV[9]}, '/')
+
+local old_id = get('file_id')
+local next_id = incrby('file_id', n)
+record('reserve', 'file_id', old_id, tostring(next_id))
+local res = {next_id}
+for id = next_id - n, next_id - 1 do
+    res[#res + 1] = dir .. '/' .. string.format('""" + _paths.lua_fname + """', id, values[4], values[5], ARGV[10])
+end
+if ARGV[7] == '1' then
+    local old = get('last_dataset')
+    set('last_dataset', res[#res])
+    record('reserve', 'last_dataset', old, res[#res])
+end
+return res
+"""
+
+reserve_file_ids_keys = ['file_id', 'last_dataset', 'base_data_dir', 'experiment_class',
+                         'PI_name', 'project_id', 'measurement_tag']
+
+def reserve_file_ids_args(n, record_last, paths = True):
+    now = datetime.now()
+    return [n, int(record_last), _paths.year(now), _paths.today(now), _paths.timestamp(now), int(paths)]
+
+
+class _Store:
+    """Same as the helpers in _prelude, operating on a MemoryBackend"""
+    def __init__(self, backend, args):
+        self.backend = backend
+        self.hash = args[0] or None
+        self.stream = args[1] or None
+        self.host = args[2]
+        self.maxlen = int(args[3])
+        self.interval = int(args[4])
+
+    def list_name(self, key):
+        return f'{self.hash}:{key}' if self.hash else key
+
+    def get(self, key):
+        if self.hash:
+            return self.backend.hget(self.hash, key)
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        if self.hash:
+            return self.backend.hset(self.hash, key, value)
+        return self.backend.set(key, value)
+
+    def incrby(self, key, n):
+        if self.hash:
+            return self.backend.hincrby(self.hash, key, n)
+        return self.backend.incrby(key, n)
+
+    def get_list(self, key):
+        return self.backend.lrange(self.list_name(key), 0, -1)
+
+    @staticmethod
+    def encode_list(items):
+        return json.dumps([item.decode() for item in items])
+
+    def checkpoint(self):
+        state = {}
+        for key in string_keys:
+            value = self.get(key)
+            if value is not None:
+                state[key] = value.decode()
+        for key in list_keys:
+            state[key] = [item.decode() for item in self.get_list(key)]
+        self.backend.xadd(self.stream, {'op': 'checkpoint', 'state': json.dumps(state), 'host': self.host},
+                          maxlen=self.maxlen)
+
+    def record(self, op, key, old, new):
+        if not self.stream:
+            return
+        entry = {'op': op, 'key': key, 'new': new, 'host': self.host}
+        if old is not None:
+            entry['old'] = old
+        self.backend.xadd(self.stream, entry, maxlen=self.maxlen)
+        if self.backend.incr(f'{self.stream}:writes') % self.interval == 0:
+            self.checkpoint()
+
+
+def write(backend, keys, args):
+    """Same as write_lua, run with backend.call()"""
+    store = _Store(backend, args)
+    op, key, values = args[5], args[6], list(args[7:])
+    if op == 'set':
+        old = store.get(key)
+        store.set(key, values[0])
+        store.record(op, key, old, values[0])
+    elif op in ('list', 'append'):
+        old = store.encode_list(store.get_list(key))
+        if op == 'list':
+            backend.delete(store.list_name(key))
+        if values:
+            backend.rpush(store.list_name(key), *values)
+        store.record(op, key, old, store.encode_list(store.get_list(key)))
+    elif op == 'incrby':
+        old = store.get(key)
+        new = store.incrby(key, values[0])
+        store.record(op, key, old, str(new))
+        return new
+    elif op == 'clear':
+        backend.delete(*[store.list_name(name) for name in list_keys])
+        if store.hash:
+            backend.delete(store.hash)
+        else:
+            backend.delete(*string_keys)
+        if store.stream:
+            store.checkpoint()
+    else:
+        raise ValueError(f'Unknown operation: {op}')
+    return 1
+
+def reserve_file_ids(backend, keys, args):
+    """Same as reserve_file_ids_lua, run with backend.call()"""
+    store = _Store(backend, args)
+    n, record_last, year, today, timestamp, paths = args[5:11]
+    if not paths:
+        old_id = store.get('file_id')
+        next_id = store.incrby('file_id', n)
+        store.record('reserve', 'file_id', old_id, str(next_id))
+        return [next_id]
+
+    values = []
+    for key in reserve_file_ids_keys[2:]:
+        value = store.get(key)
+        if value is None:
+            raise ValueError(f'{key} not set')
+        values.append(value.decode())
+    base, experiment_class, PI_name, project_id, measurement_tag = values
+    directory = _paths.work_dir(base, experiment_class, PI_name, year, project_id) / today
+
+    old_id = store.get('file_id')
+    next_id = store.incrby('file_id', n)
+    store.record('reserve', 'file_id', old_id, str(next_id))
+    res = [next_id]
+    for file_id in range(next_id - n, next_id):
+        res.append(str(directory / _paths.fname(file_id, project_id, measurement_tag, timestamp)).encode())
+    if record_last:
+        old = store.get('last_dataset')
+        store.set('last_dataset', res[-1])
+        store.record('reserve', 'last_dataset', old, res[-1])
+    return res
@@ -0,0 +1,109 @@
+import threading
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+from .string_op import sanitize_label
+from . import paths
+
+
+class AcquisitionSession:
+    """
+    Paths of a series of acquisitions, resolved once when the session is
+    created. data_dir, work_dir and timestamp stay the same for the whole
+    session, also across midnight. file_ids are reserved in blocks of n and
+    next_path() hands them out without touching the server or the disk.
+    The directories are created in a background thread.
+
+    Created by ConfigurationClient.session()
+
+    with cfg.session(10) as session:
+        path = session.next_path()
+        ...
+        session.finished(path)
+    """
+    def __init__(self, client, n = 10):
+        n = int(n)
+        if n < 1:
+            raise ValueError(f'Number of file_ids to reserve must be positive. Got: {n}')
+        self._client = client
+        self._n = n
+
+        now = datetime.now()
+        self.year = paths.year(now)
+        self.today = paths.today(now)
+        self.timestamp = paths.timestamp(now)
+        with client.snapshot():
+            self.project_id = client.project_id
+            self.measurement_tag = client.measurement_tag
+            self.work_dir = paths.work_dir(client.base_data_dir, client.experiment_class, client.PI_name,
+                                           self.year, self.project_id)
+        self.data_dir = self.work_dir / self.today
+
+        self._ids = deque()
+        self._reserve()
+
+        #Set if the directories could not be created
+        self._error = None
+        self._thread = threading.Thread(target=self._make_dirs, daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f'AcquisitionSession({self.data_dir}, file_ids left: {len(self._ids)})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._thread.join()
+
+    def _make_dirs(self):
+        try:
+            self.data_dir.mkdir(parents = True, exist_ok = True)
+        except OSError as e:
+            self._error = e
+
+    def _reserve(self):
+        next_id, _ = self._client._reserve_file_ids(self._n, record_last = False, paths = False)
+        self._ids.extend(range(next_id - self._n, next_id))
+
+    def fname(self, file_id, measurement_tag = None) -> str:
+        """
+        File name of the dataset with file_id, same format as ConfigurationClient.fname.
+        measurement_tag replaces the one of the session
+        """
+        tag = self.measurement_tag if measurement_tag is None else sanitize_label(measurement_tag)
+        return paths.fname(file_id, self.project_id, tag, self.timestamp)
+
+    def path(self, file_id, measurement_tag = None) -> Path:
+        """Path of the dataset with file_id"""
+        return self.data_dir / self.fname(file_id, measurement_tag)
+
+    def next_id(self) -> int:
+        """
+        Next reserved file_id. Only when all reserved file_ids are used
+        a new block is reserved, in one round trip
+        """
+        if self._error is not None:
+            raise self._error
+        if not self._ids:
+            self._reserve()
+        return self._ids.popleft()
+
+    def next_path(self, measurement_tag = None) -> Path:
+        """Path for the next dataset, with the file_id from next_id()"""
+        return self.path(self.next_id(), measurement_tag)
+
+    def wait(self, timeout = None) -> bool:
+        """
+        Wait until the directories exist. Returns False on timeout, raises
+        OSError if they could not be created
+        """
+        self._thread.join(timeout)
+        if self._error is not None:
+            raise self._error
+        return not self._thread.is_alive()
+
+    def finished(self, path : Path):
+        """Record path as last_dataset once the dataset is written"""
+        self._client.last_dataset = path
@@ -0,0 +1,270 @@
+import contextvars
+import inspect
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Methods of the backend that do not talk to the server
+_local_methods = {'get_encoder', 'pubsub'}
+
+# Names of the stored properties being read or written, see stored_property
+_stored_properties = contextvars.ContextVar('stored_properties', default = ())
+
+
+@contextmanager
+def stored_property(name):
+    """
+    Attribute the requests made inside to the property name. For properties
+    generated from a schema, which share one code object
+    """
+    token = _stored_properties.set(_stored_properties.get() + (name,))
+    try:
+        yield
+    finally:
+        _stored_properties.reset(token)
+
+
+def code_names(cls, skip = ()) -> dict:
+    """
+    Map the code objects of the public methods and properties of cls to a
+    name, used to find which property triggered a backend call.
+    skip: names of properties that use stored_property instead
+    """
+    res = {}
+    for name, item in vars(cls).items():
+        if name.startswith('_') and name != '__repr__' or name in skip:
+            continue
+        if isinstance(item, property):
+            if item.fget is not None:
+                res[item.fget.__code__] = name
+            if item.fset is not None:
+                res[item.fset.__code__] = f'{name}='
+        else:
+            #Look through contextmanager and staticmethod wrappers
+            item = inspect.unwrap(getattr(item, '__func__', item))
+            if hasattr(item, '__code__'):
+                res[item.__code__] = f'{name}()'
+    return res
+
+
+class ClientStats:
+    """
+    Counts and times the requests sent to the backend by a ConfigurationClient.
+    Each request is counted once per key it touches and once for every
+    property or method on the call stack, so fpath includes the requests
+    made by data_dir and fname.
+
+    cfg = ConfigurationClient(stats = True)
+    cfg.fpath
+    cfg.stats.properties['fpath'] # [requests, seconds]
+    print(cfg.stats.to_prometheus())
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.round_trips = 0
+            self.seconds = 0.0
+            # name: [requests, seconds]
+            self.commands = defaultdict(lambda: [0, 0.0])
+            self.keys = defaultdict(lambda: [0, 0.0])
+            self.properties = defaultdict(lambda: [0, 0.0])
+
+    def record(self, command, keys, properties, seconds):
+        with self._lock:
+            self.round_trips += 1
+            self.seconds += seconds
+            for table, names in ((self.commands, [command]), (self.keys, keys), (self.properties, properties)):
+                for name in set(names):
+                    item = table[name]
+                    item[0] += 1
+                    item[1] += seconds
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'round_trips': self.round_trips,
+                'seconds': self.seconds,
+                'commands': {name: {'requests': n, 'seconds': t} for name, (n, t) in self.commands.items()},
+                'keys': {name: {'requests': n, 'seconds': t} for name, (n, t) in self.keys.items()},
+                'properties': {name: {'requests': n, 'seconds': t} for name, (n, t) in self.properties.items()},
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    def to_prometheus(self, prefix = 'epoc_config') -> str:
+        """Metrics in the Prometheus text exposition format"""
+        res = self.to_dict()
+        lines = [
+            f'# HELP {prefix}_requests_total Requests sent to the configuration backend',
+            f'# TYPE {prefix}_requests_total counter',
+            f'{prefix}_requests_total {res["round_trips"]}',
+            f'# HELP {prefix}_request_seconds_total Time spent waiting for the configuration backend',
+            f'# TYPE {prefix}_request_seconds_total counter',
+            f'{prefix}_request_seconds_total {res["seconds"]}',
+        ]
+        for label, table in (('command', res['commands']), ('key', res['keys']), ('property', res['properties'])):
+            for metric, field, help in (('requests_total', 'requests', 'Requests'),
+                                        ('request_seconds_total', 'seconds', 'Time spent on requests')):
+                name = f'{prefix}_{label}_{metric}'
+                lines.append(f'# HELP {name} {help} per {label}')
+                lines.append(f'# TYPE {name} counter')
+                for value, item in sorted(table.items()):
+                    value = value.replace('\\', '\\\\').replace('"', '\\"')
+                    lines.append(f'{name}{{{label}="{value}"}} {item[field]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host = ''):
+        """
+        Serve /metrics (Prometheus) and /metrics.json from a background
+        thread. Returns the server, call shutdown() to stop it
+        """
+        stats = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = stats.to_prometheus(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = stats.to_json(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class InstrumentedBackend:
+    """
+    Forwards everything to backend and records each request in stats.
+    Only used when stats are enabled, so there is no cost otherwise.
+    """
+    def __init__(self, backend, stats, codes):
+        self._backend = backend
+        self._stats = stats
+        self._codes = codes
+
+    def _properties(self):
+        names = list(_stored_properties.get())
+        frame = sys._getframe(2)
+        while frame is not None:
+            name = self._codes.get(frame.f_code)
+            if name is not None:
+                names.append(name)
+            frame = frame.f_back
+        return names
+
+    def _record(self, command, keys, t0):
+        self._stats.record(command, keys, self._properties(), time.perf_counter() - t0)
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name == 'pipeline':
+            return lambda *args, **kwargs: InstrumentedPipeline(attr(*args, **kwargs), self)
+        if name == 'register_script':
+            return lambda *args, **kwargs: InstrumentedScript(attr(*args, **kwargs), self)
+        if name in _local_methods or not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._record(name, _keys(name, args), t0)
+        return command
+
+
+class InstrumentedPipeline:
+    """Records the keys of the queued commands and counts execute() as one request"""
+    def __init__(self, pipe, backend):
+        self._pipe = pipe
+        self._backend = backend
+        self._keys = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._pipe, name)
+        if name in ('execute', 'multi', 'watch', 'reset') or not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            self._keys += _keys(name, args)
+            attr(*args, **kwargs)
+            return self
+        return command
+
+    def execute(self):
+        t0 = time.perf_counter()
+        try:
+            return self._pipe.execute()
+        finally:
+            keys, self._keys = self._keys, []
+            self._backend._record('pipeline', keys, t0)
+
+
+class InstrumentedScript:
+    def __init__(self, script, backend):
+        self._script = script
+        self._backend = backend
+
+    def __getattr__(self, name):
+        #sha and script of the registered script
+        return getattr(self._script, name)
+
+    def __call__(self, keys = [], args = [], client = None):
+        if isinstance(client, InstrumentedPipeline):
+            #Queued, counted when the pipeline is executed
+            client._keys += list(keys)
+            return self._script(keys = keys, args = args, client = client._pipe)
+        t0 = time.perf_counter()
+        try:
+            #The script is registered with the backend that is not instrumented
+            return self._script(keys = keys, args = args)
+        finally:
+            self._backend._record('evalsha', list(keys), t0)
+
+
+def _keys(command, args):
+    """Keys touched by a redis command"""
+    if not args:
+        return []
+    if command == 'mget':
+        keys = [args[0]] if isinstance(args[0], (str, bytes)) else list(args[0])
+        return keys + list(args[1:])
+    if command in ('delete', 'exists'):
+        return list(args)
+    if command in ('hget', 'hset', 'hincrby'):
+        #Fields of a hash are reported as hash:field, see epoc.layout
+        return [f'{args[0]}:{args[1]}']
+    if command == 'hmget':
+        fields = [args[1]] if isinstance(args[1], (str, bytes)) else list(args[1])
+        return [f'{args[0]}:{field}' for field in fields]
+    if command == 'transaction':
+        #args are func, *watches
+        return list(args[1:])
+    if command == 'evalsha':
+        #args are sha, number of keys, *keys, *args
+        return list(args[2:2 + args[1]])
+    if command == 'call':
+        #args are func, keys, args, see MemoryBackend.call
+        return list(args[1])
+    if command in ('flushdb', 'script_load'):
+        return []
+    return [args[0]]
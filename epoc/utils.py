@@ -1,29 +1,87 @@
+import types
 from functools import wraps
 def freeze(cls):
     """
-    Decorator to prevent assignments to not existing properties. 
+    Decorator to prevent assignments to not existing properties.
     Protects for example form typos when setting exptime etc.
+    Attributes set in __init__ of the class and its subclasses are allowed,
+    classes with __slots__ get an extra slot for the frozen flag.
     """
-    cls._frozen = False
+    if _needs_frozen_slot(cls):
+        cls = _with_frozen_slot(cls)
+    else:
+        cls._frozen = False
+
+    #Names of the class attributes per class, filled on first use so that
+    #properties added after decoration and subclasses are included
+    allowed = {}
 
     def frozensetattr(self, key, value):
-        if self._frozen and not key in dir(self):
-            raise AttributeError(
-                "Class {} is frozen. Cannot set {} = {}".format(
-                    cls.__name__, key, value
+        if getattr(self, '_frozen', False):
+            names = allowed.get(type(self))
+            if names is None:
+                names = allowed[type(self)] = frozenset(dir(type(self)))
+            #dir(self) builds a sorted list, only used if the fast checks fail
+            if key not in names and key not in getattr(self, '__dict__', ()) and key not in dir(self):
+                raise AttributeError(
+                    "Class {} is frozen. Cannot set {} = {}".format(
+                        cls.__name__, key, value
+                    )
                 )
-            )
-        else:
-            object.__setattr__(self, key, value)
+        object.__setattr__(self, key, value)
 
-    def init_decorator(func):
-        @wraps(func)
-        def wrapper(self, *args, **kwargs):
-            func(self, *args, **kwargs)
-            self._frozen = True
+    parent_init_subclass = cls.__dict__.get('__init_subclass__')
 
-        return wrapper
+    def init_subclass(sub, **kwargs):
+        if parent_init_subclass is not None:
+            parent_init_subclass.__func__(sub, **kwargs)
+        else:
+            super(cls, sub).__init_subclass__(**kwargs)
+        #Subclasses can set their own attributes after super().__init__()
+        if '__init__' in sub.__dict__:
+            sub.__init__ = _init_decorator(sub.__dict__['__init__'])
 
     cls.__setattr__ = frozensetattr
-    cls.__init__ = init_decorator(cls.__init__)
-    return cls
\ No newline at end of file
+    cls.__init__ = _init_decorator(cls.__init__)
+    cls.__init_subclass__ = classmethod(init_subclass)
+    return cls
+
+
+def _init_decorator(func):
+    if getattr(func, '_freezes', False):
+        return func
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        func(self, *args, **kwargs)
+        #Only the __init__ of the class of self freezes, not the ones of base classes
+        if type(self).__init__ is wrapper:
+            object.__setattr__(self, '_frozen', True)
+
+    wrapper._freezes = True
+    return wrapper
+
+def _needs_frozen_slot(cls):
+    """True if instances of cls have neither __dict__ nor a _frozen slot"""
+    if isinstance(getattr(cls, '_frozen', None), types.MemberDescriptorType):
+        return False
+    return all('__slots__' in c.__dict__ and '__dict__' not in c.__slots__ for c in cls.__mro__[:-1])
+
+def _with_frozen_slot(cls):
+    """Same class with _frozen added to __slots__, slots can not be added later"""
+    slots = cls.__dict__['__slots__']
+    slots = (slots,) if isinstance(slots, str) else tuple(slots)
+    namespace = dict(cls.__dict__)
+    for name in slots + ('__dict__', '__weakref__'):
+        namespace.pop(name, None)
+    namespace['__slots__'] = slots + ('_frozen',)
+    namespace['__qualname__'] = cls.__qualname__
+    res = type(cls)(cls.__name__, cls.__bases__, namespace)
+    #Point super() in the methods to the new class
+    for item in namespace.values():
+        item = getattr(item, '__func__', item)
+        for func in (item.fget, item.fset) if isinstance(item, property) else (item,):
+            code = getattr(func, '__code__', None)
+            if code is not None and '__class__' in code.co_freevars:
+                func.__closure__[code.co_freevars.index('__class__')].cell_contents = res
+    return res
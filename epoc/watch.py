@@ -0,0 +1,100 @@
+import queue
+import threading
+import warnings
+
+from .cache import enable_keyspace_events, keyspace_channel, subscribe
+
+_stop = object()
+
+
+class Watcher:
+    """
+    Calls callback(key, value) from a background thread when one of the
+    watched keys changes, with value decoded by the ConfigurationClient
+    property. Without a callback the changes are queued and can be
+    consumed by iterating over the watcher.
+
+    Created by ConfigurationClient.watch()
+    """
+    def __init__(self, reader, keys, callback = None, initial = False):
+        self.keys = list(keys)
+        self._reader = reader
+        self._queue = queue.Queue()
+        self._callback = callback if callback is not None else self._put
+        self._stopped = False
+        self._lock = threading.Lock()
+
+        #Keys of an instrument share one Redis key, see epoc.layout
+        self._channels = {}
+        for key in self.keys:
+            self._channels.setdefault(reader._layout.redis_key(key), []).append(key)
+
+        client = reader.client
+        enable_keyspace_events(client)
+        self._prefix = keyspace_channel(client)
+        #Subscribe before reading the current values so no change is lost
+        self._pubsub = subscribe(client, {self._prefix + name: self._on_notification for name in self._channels})
+        with reader.snapshot():
+            self._last = {key: self._read(key) for key in self.keys}
+        if initial:
+            for key in self.keys:
+                self._deliver(key, self._last[key])
+        self._thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True,
+                                                  exception_handler=self._on_error)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _stop:
+                return
+            yield item
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stop(self):
+        """Stop watching and end iteration"""
+        self._stopped = True
+        self._thread.stop()
+        self._queue.put_nowait(_stop)
+
+    def _put(self, key, value):
+        self._queue.put_nowait((key, value))
+
+    def _read(self, key):
+        try:
+            return getattr(self._reader, key)
+        except ValueError:
+            #Key was deleted
+            return None
+
+    def _deliver(self, key, value):
+        try:
+            self._callback(key, value)
+        except Exception as e:
+            warnings.warn(f'Exception in watch callback for {key}: {e}')
+
+    def _on_notification(self, message):
+        channel = message['channel']
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        keys = self._channels.get(channel[len(self._prefix):], [])
+        with self._reader.snapshot():
+            values = {key: self._read(key) for key in keys}
+        for key, value in values.items():
+            #One write can generate several events, only report real changes
+            with self._lock:
+                if value == self._last.get(key):
+                    continue
+                self._last[key] = value
+            self._deliver(key, value)
+
+    def _on_error(self, exc, pubsub, thread):
+        thread.stop()
+        if self._stopped:
+            return
+        self._queue.put_nowait(_stop)
+        warnings.warn(f'Lost keyspace notifications, stopped watching {self.keys}: {exc}')
@@ -1,24 +1,127 @@
+"""
+Publish synthetic detector frames over zmq to load test viewers and
+receivers. Frames are drawn once into a pool: Poisson background with
+diffraction spots scattered around beam_center. They are then sent without
+copying at the target rate as [frame_nr (int64), frame], same as before.
+
+python scripts/stream_noise.py                          #5 Hz float32, like before
+python scripts/stream_noise.py --rate 2000 --dtype uint16
+python scripts/stream_noise.py --rate 4000 --processes 4 #ports 4545-4548
+
+Frame size and beam center come from the configuration server unless given.
+With several processes each binds its own port, starting at --port, and
+sends every n-th frame at rate / n.
+"""
 import argparse
-import numpy as np
+import multiprocessing
 import time
+
+import numpy as np
 import zmq
 
-from epoc import ConfigurationClient, auth_token, redis_host
 
-c = ConfigurationClient(redis_host(), token=auth_token())
-nrows = c.nrows
-ncols = c.ncols
+def make_pool(nrows, ncols, beam_center, size = 32, dtype = 'float32', spots = 50,
+              background = 0.2, seed = None):
+    """size frames with Poisson background and spots around beam_center (x, y)"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:nrows, 0:ncols]
+    pool = []
+    for _ in range(size):
+        rate = np.full((nrows, ncols), background)
+        #Spots get rarer and weaker further away from the beam
+        sx = rng.normal(beam_center[0], ncols / 6, spots)
+        sy = rng.normal(beam_center[1], nrows / 6, spots)
+        intensity = rng.exponential(200, spots)
+        for cx, cy, i in zip(sx, sy, intensity):
+            x0, x1 = int(max(cx - 4, 0)), int(min(cx + 5, ncols))
+            y0, y1 = int(max(cy - 4, 0)), int(min(cy + 5, nrows))
+            if x0 >= x1 or y0 >= y1:
+                continue
+            r2 = (x[y0:y1, x0:x1] - cx)**2 + (y[y0:y1, x0:x1] - cy)**2
+            rate[y0:y1, x0:x1] += i * np.exp(-r2 / 2)
+        frame = rng.poisson(rate).astype(dtype)
+        frame.flags.writeable = False
+        pool.append(frame)
+    return pool
+
+
+def publish(endpoint, pool, rate = 5.0, frames = 0, first = 0, step = 1, verbose = False):
+    """
+    Send frames first, first + step, ... from the pool at rate Hz, 0 for as
+    fast as possible, frames = 0 to run forever
+    """
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.bind(endpoint)
+
+    interval = 1 / rate if rate > 0 else 0
+    t0 = last = time.perf_counter()
+    sent = reported = 0
+    frame_nr = first
+    try:
+        while frames == 0 or sent < frames:
+            #The pool arrays are sent as they are, zmq keeps a reference until they are out
+            socket.send_multipart([np.array(frame_nr).tobytes(), pool[sent % len(pool)]], copy = False)
+            frame_nr += step
+            sent += 1
+            now = time.perf_counter()
+            if verbose:
+                print(frame_nr)
+            if now - last >= 1:
+                print(f'{endpoint}: {(sent - reported) / (now - last):.0f} frames/s, {sent} sent')
+                last, reported = now, sent
+            if interval:
+                #Paced from the start so that sleep jitter does not add up
+                delay = t0 + sent * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+    finally:
+        #Give slow subscribers a moment for the frames still queued
+        socket.close(linger = 1000)
+        context.term()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=5, help='Frames per second in total, 0 for as fast as possible')
+    parser.add_argument('--frames', type=int, default=0, help='Frames to send per process, 0 to run forever')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'uint16', 'int32'])
+    parser.add_argument('--pool', type=int, default=32, help='Number of different frames')
+    parser.add_argument('--spots', type=int, default=50, help='Spots per frame')
+    parser.add_argument('--port', type=int, default=4545)
+    parser.add_argument('--processes', type=int, default=1, help='Publishers, each on its own port')
+    parser.add_argument('--nrows', type=int)
+    parser.add_argument('--ncols', type=int)
+    parser.add_argument('--beam-center', type=float, nargs=2, metavar=('X', 'Y'))
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every frame number')
+    args = parser.parse_args()
+
+    if None in (args.nrows, args.ncols, args.beam_center):
+        from epoc import ConfigurationClient, auth_token, redis_host
+        c = ConfigurationClient(redis_host(), token=auth_token())
+        with c.snapshot():
+            args.nrows = args.nrows or c.nrows
+            args.ncols = args.ncols or c.ncols
+            args.beam_center = args.beam_center or c.beam_center
+
+    t = time.perf_counter()
+    pool = make_pool(args.nrows, args.ncols, args.beam_center, args.pool, args.dtype, args.spots, seed = args.seed)
+    print(f'{args.pool} frames of {args.nrows}x{args.ncols} {args.dtype} in {time.perf_counter() - t:.1f} s')
 
-port = 4545
-context = zmq.Context()
-socket = context.socket(zmq.PUB)
-socket.bind(f'tcp://*:{port}')
+    n = args.processes
+    if n == 1:
+        publish(f'tcp://*:{args.port}', pool, args.rate, args.frames, verbose = args.verbose)
+        return
+    workers = [multiprocessing.Process(target = publish,
+                                       args = (f'tcp://*:{args.port + i}', pool, args.rate / n, args.frames, i, n,
+                                               args.verbose))
+               for i in range(n)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
 
 
-frame_nr = 0
-while True:
-    data = np.random.rand(nrows, ncols).astype(np.float32)
-    socket.send_multipart([np.array(frame_nr).tobytes(), data.tobytes()])
-    frame_nr += 1
-    time.sleep(0.2)
-    print(frame_nr)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
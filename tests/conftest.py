@@ -1,5 +1,6 @@
 import pytest
 from epoc import ConfigurationClient, auth_token, redis_host
+from epoc.backends import MemoryBackend
 
 def pytest_addoption(parser):
     parser.addoption('--with-redis', action='store_true', dest="with_redis",
@@ -7,8 +8,15 @@ def pytest_addoption(parser):
     
 
 
+@pytest.fixture(scope='session')
+def memory_backend():
+    #Shared by all tests, same as the database on the redis server
+    return MemoryBackend()
+
 @pytest.fixture
-def cfg():
+def cfg(request, memory_backend):
+    if not request.config.getoption('with_redis'):
+        return ConfigurationClient(backend = memory_backend)
     #Avoid using the default database in case someone is using it for manual testing
     test_db = 1
     cfg = ConfigurationClient(redis_host(), token=auth_token(), db = test_db)
@@ -0,0 +1,95 @@
+import asyncio
+import pytest
+from pathlib import Path
+from freezegun import freeze_time
+
+from epoc import AsyncConfigurationClient, auth_token, redis_host
+from epoc.schema import schema
+
+
+@pytest.fixture
+def run(request):
+    """Run coro_func(cfg) against the server with --with-redis, otherwise fakeredis"""
+    if request.config.getoption('with_redis'):
+        def client():
+            return AsyncConfigurationClient(redis_host(), token=auth_token(), db = 1)
+    else:
+        fakeredis = pytest.importorskip('fakeredis')
+        server = fakeredis.FakeServer()
+        def client():
+            return AsyncConfigurationClient(backend = fakeredis.FakeAsyncRedis(server = server))
+
+    def run(coro_func):
+        async def main():
+            async with client() as cfg:
+                return await coro_func(cfg)
+        return asyncio.run(main())
+    return run
+
+def test_all_keys_have_a_property():
+    for key in schema:
+        assert isinstance(getattr(AsyncConfigurationClient, key), property)
+
+
+def test_set_and_get(run):
+    async def f(cfg):
+        await cfg.set('PI_name', 'Some Name')
+        await cfg.set('rotation_speed_idx', 1)
+        assert await cfg.PI_name == 'SomeName'
+        assert await cfg.rotation_speed_idx == 1
+    run(f)
+
+def test_validation(run):
+    async def f(cfg):
+        with pytest.raises(ValueError):
+            await cfg.set('rotation_speed_idx', 7)
+        with pytest.raises(ValueError):
+            await cfg.set('experiment_class', 'SomeRandomName')
+        with pytest.raises(ValueError):
+            await cfg.set('not_a_key', 1)
+    run(f)
+
+def test_concurrent_reads(run):
+    async def f(cfg):
+        await cfg.update({'nrows': 514, 'ncols': 1030, 'beam_center': [173, 170]})
+        res = await asyncio.gather(cfg.nrows, cfg.ncols, cfg.beam_center, *[cfg.nrows for _ in range(10)])
+        assert res[:3] == [514, 1030, [173, 170]]
+    run(f)
+
+def test_paths_and_after_write(run):
+    async def f(cfg):
+        await cfg.update({'PI_name': 'PIName', 'project_id': 'ProjectID', 'experiment_class': 'UniVie',
+                          'base_data_dir': '/data/base/path/', 'measurement_tag': 'Lysozyme', 'file_id': 7})
+        #Ticking, the client times out on a clock that stands still
+        with freeze_time('2024-08-13', tick = True):
+            d = Path('/data/base/path/UniVie/PIName/2024/ProjectID/2024-08-13')
+            fpath = d / '007_ProjectID_Lysozyme_2024-08-13_0000_master.h5'
+            assert await cfg.data_dir == d
+            assert await cfg.fpath == fpath
+            assert await cfg.after_write() == fpath
+        assert await cfg.last_dataset == fpath
+        assert await cfg.file_id == 8
+    run(f)
+
+def test_from_yaml_and_dump(run, tmp_path):
+    async def f(cfg):
+        await cfg.from_yaml('tests/test_epoc_config.yaml', flush_db = True)
+        res = await cfg.dump()
+        assert res['PI_name'] == 'Erik'
+        assert res['viewer_interval'] == 200
+        assert len(res['overlays']) == 3
+        await cfg.to_yaml(tmp_path / 'saved.yaml')
+    run(f)
+    assert (tmp_path / 'saved.yaml').exists()
+
+def test_from_yaml_is_not_applied_on_invalid_value(run, tmp_path):
+    path = tmp_path / 'wrong_type.yaml'
+    path.write_text('nrows: [514]\n')
+    async def f(cfg):
+        await cfg.set('PI_name', 'Erik')
+        with pytest.raises(ValueError):
+            await cfg.from_yaml('tests/test_epoc_config_invalid.yaml')
+        with pytest.raises(ValueError, match = 'wrong_type.yaml: nrows'):
+            await cfg.from_yaml(path)
+        assert await cfg.PI_name == 'Erik'
+    run(f)
@@ -0,0 +1,107 @@
+import pytest
+import redis
+
+from epoc import ConfigurationClient
+from epoc.backends import MemoryBackend, FileBackend
+
+
+def test_values_are_stored_as_bytes():
+    b = MemoryBackend()
+    b.set('a', 5)
+    b.set('b', 2.5)
+    b.set('c', 'text')
+    assert b.get('a') == b'5'
+    assert b.mget(['a', 'b', 'c', 'd']) == [b'5', b'2.5', b'text', None]
+
+def test_incr():
+    b = MemoryBackend()
+    assert b.incr('file_id') == 1
+    assert b.incrby('file_id', 3) == 4
+    assert b.get('file_id') == b'4'
+
+def test_lists():
+    b = MemoryBackend()
+    b.rpush('overlays', 'a', 'b')
+    b.rpush('overlays', 'c')
+    assert b.lrange('overlays', 0, -1) == [b'a', b'b', b'c']
+    assert b.lrange('overlays', 1, 1) == [b'b']
+    with pytest.raises(redis.exceptions.ResponseError):
+        b.get('overlays')
+
+def test_pipeline_is_applied_on_execute():
+    b = MemoryBackend()
+    pipe = b.pipeline()
+    pipe.set('a', 1)
+    pipe.incr('a')
+    assert b.get('a') is None
+    assert pipe.execute() == [True, 2]
+    assert b.get('a') == b'2'
+
+def test_pipeline_is_rolled_back_on_error():
+    b = MemoryBackend()
+    b.rpush('overlays', 'a')
+    pipe = b.pipeline()
+    pipe.set('a', 1)
+    pipe.incr('overlays')
+    with pytest.raises(redis.exceptions.ResponseError):
+        pipe.execute()
+    assert b.get('a') is None
+
+def test_file_backend_persists(tmp_path):
+    path = tmp_path / 'config.json'
+    cfg = ConfigurationClient(backend = FileBackend(path))
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+    cfg.after_write()
+
+    cfg = ConfigurationClient(backend = FileBackend(path))
+    assert cfg.PI_name == 'Erik'
+    assert cfg.file_id == 4
+    assert cfg.beam_center == [173, 170]
+    assert len(cfg.overlays) == 3
+
+def test_cache_and_watch_need_redis():
+    with pytest.raises(ValueError):
+        ConfigurationClient(backend = MemoryBackend(), cache = True)
+    with pytest.raises(ValueError):
+        ConfigurationClient(backend = MemoryBackend()).watch('PI_name')
+
+def test_hashes():
+    b = MemoryBackend()
+    b.hset('epoc:a', 'PI_name', 'Erik')
+    b.hset('epoc:a', mapping={'nrows': 514})
+    assert b.hincrby('epoc:a', 'file_id', 2) == 2
+    assert b.hget('epoc:a', 'nrows') == b'514'
+    assert b.hmget('epoc:a', ['PI_name', 'other']) == [b'Erik', None]
+    assert b.hgetall('epoc:a') == {b'PI_name': b'Erik', b'nrows': b'514', b'file_id': b'2'}
+    assert b.mget(['epoc:a']) == [None]
+    with pytest.raises(redis.exceptions.ResponseError):
+        b.get('epoc:a')
+
+def test_file_backend_persists_instruments(tmp_path):
+    path = tmp_path / 'config.json'
+    cfg = ConfigurationClient(backend = FileBackend(path), instrument = 'jem2100plus')
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+
+    cfg = ConfigurationClient(backend = FileBackend(path), instrument = 'jem2100plus')
+    assert cfg.PI_name == 'Erik'
+    assert cfg.beam_center == [173, 170]
+
+def test_streams(tmp_path):
+    b = FileBackend(tmp_path / 'config.json')
+    ids = [b.xadd('history', {'key': 'PI_name', 'new': i}, maxlen = 3) for i in range(4)]
+    assert [fields[b'new'] for _, fields in b.xrange('history')] == [b'1', b'2', b'3']
+    assert [entry_id for entry_id, _ in b.xrevrange('history', count = 2)] == ids[:1:-1]
+    assert b.xrange('history', min = '(' + ids[2].decode()) == b.xrange('history', min = ids[3])
+
+    b = FileBackend(tmp_path / 'config.json')
+    assert b.xrevrange('history', count = 1)[0][0] == ids[3]
+    assert b.xadd('history', {'key': 'PI_name'}) not in ids
+
+def test_call_rolls_back_on_error():
+    b = MemoryBackend()
+    def func(backend, keys, args):
+        backend.set('PI_name', args[0])
+        raise ValueError('failed')
+    with pytest.raises(ValueError):
+        b.call(func, ['PI_name'], ['Erik'])
+    assert b.get('PI_name') is None
@@ -1,26 +1,30 @@
 import pytest
+import json
+import sys
 from epoc import ConfigurationClient, auth_token, redis_host
+from epoc.ConfigurationClient import redis_port
+from epoc.backends import MemoryBackend
+from epoc.offline import LocalSnapshot
 from datetime import datetime
 from pathlib import Path
 
 
+import time
+import redis
 from freezegun import freeze_time
 with_redis = pytest.mark.skipif("not config.getoption('with_redis')")
 
 
-@with_redis
 def test_set_PI_name(cfg):
     cfg.PI_name = 'Erik'
     assert cfg.PI_name == 'Erik'
 
-@with_redis
 def test_PI_name_removes_space(cfg):
     cfg.PI_name = 'Some Name'
     assert cfg.PI_name == 'SomeName'
 
 
 
-@with_redis
 def test_construction_of_fname(cfg):
     cfg.measurement_tag = 'Lysozyme'
     cfg.project_id = 'ProjectID'
@@ -34,7 +38,6 @@ def test_construction_of_fname(cfg):
     with freeze_time('2020-01-01 23:12:11'):
         assert cfg.fname == f'037_ProjectID_Lysozyme_2020-01-01_2312_master.h5'
 
-@with_redis
 def test_construction_of_data_dir(cfg):
     cfg.PI_name = 'PIName'
     cfg.project_id = 'ProjectID'
@@ -44,7 +47,6 @@ def test_construction_of_data_dir(cfg):
     with freeze_time('1984-07-22'):
         assert cfg.data_dir == Path('/data/base/path/UniVie/PIName/1984/ProjectID/1984-07-22')
 
-@with_redis
 def test_construction_of_work_dir(cfg):
     cfg.PI_name = 'PIName'
     cfg.project_id = 'ProjectID'
@@ -55,12 +57,10 @@ def test_construction_of_work_dir(cfg):
         # Test the work_dir with the year included
         assert cfg.work_dir == Path('/data/base/path/UniVie/PIName/1984/ProjectID')
 
-@with_redis
 def test_fpath(cfg):
     with freeze_time('2024-08-13'):
         assert cfg.fpath == Path(f'/data/base/path/UniVie/PIName/2024/ProjectID/2024-08-13/037_ProjectID_Lysozyme_2024-08-13_0000_master.h5')
 
-@with_redis
 def test_loading_from_yaml(cfg):
     cfg.from_yaml('tests/test_epoc_config.yaml', flush_db=True)
     assert cfg.PI_name == 'Erik'
@@ -71,7 +71,6 @@ def test_loading_from_yaml(cfg):
     assert cfg.file_id == 3
     assert cfg.viewer_interval == 200
 
-@with_redis
 def test_update_from_yaml(cfg):
     cfg.from_yaml('tests/test_epoc_config_partial.yaml')
     #These fields have changed:
@@ -87,32 +86,49 @@ def test_update_from_yaml(cfg):
 
 
 
-@with_redis
 def test_set_project_id(cfg):
     cfg.project_id = 'epoc'
     assert cfg.project_id == 'epoc'
 
-@with_redis
 def test_project_id_removes_slash(cfg):
     cfg.project_id = 'epoc/33'
     assert cfg.project_id == 'epoc33'
 
-@with_redis
 def test_rotation_speed_idx(cfg):
     cfg.rotation_speed_idx = 1
     assert cfg.rotation_speed_idx == 1
 
-@with_redis
 def test_rotation_speed_idx_must_throws_on_other_value(cfg):
     with pytest.raises(ValueError):
         cfg.rotation_speed_idx = 7
 
-@with_redis
 def test_not_set_gives_default(cfg):
     cfg.client.delete('rotation_speed_idx')
     assert cfg.rotation_speed_idx == 2
 
-@with_redis
+def test_defaults_are_not_written(cfg):
+    cfg.client.delete('rotation_speed_idx', 'file_id')
+    assert cfg.rotation_speed_idx == 2
+    assert cfg.file_id == 0
+    assert cfg.client.get('rotation_speed_idx') is None
+    assert cfg.client.get('file_id') is None
+
+def test_get_many(cfg):
+    cfg.PI_name = 'PIName'
+    cfg.nrows = 514
+    cfg.beam_center = [173, 170]
+    res = cfg.get_many(['PI_name', 'nrows', 'beam_center', 'work_dir'])
+    assert res['PI_name'] == 'PIName'
+    assert res['nrows'] == 514
+    assert res['beam_center'] == [173, 170]
+    assert res['work_dir'] == cfg.work_dir
+    with pytest.raises(ValueError):
+        cfg.get_many(['not_a_key'])
+
+def test_numbers_are_validated(cfg):
+    with pytest.raises(ValueError):
+        cfg.nrows = 'many'
+
 def test_last_dataset(cfg):
     cfg.PI_name = 'PIName'
     cfg.project_id = 'ProjectID'
@@ -126,18 +142,15 @@ def test_last_dataset(cfg):
         cfg.after_write()
         assert cfg.last_dataset == last
 
-@with_redis
 def test_file_id_increments_with_after_write(cfg):
     cfg.file_id = 17
     cfg.after_write()
     assert cfg.file_id == 18
 
-@with_redis
 def test_set_XDS_template(cfg):
     cfg.XDS_template = '/path/to/template.INP'
     assert cfg.XDS_template == Path('/path/to/template.INP')
 
-@with_redis
 def test_set_rows_and_cols(cfg):
     cfg.nrows = 100
     cfg.ncols = 200
@@ -145,7 +158,6 @@ def test_set_rows_and_cols(cfg):
     assert cfg.ncols == 200
 
 
-@with_redis
 def test_experiment_class(cfg):
     cfg.experiment_class = 'UniVie'
     assert cfg.experiment_class == 'UniVie'
@@ -156,35 +168,613 @@ def test_experiment_class(cfg):
     cfg.experiment_class = 'IP'
     assert cfg.experiment_class == 'IP'
 
-@with_redis
 def test_experiment_class_throws_on_not_allowed_value(cfg):
     with pytest.raises(ValueError):
         cfg.experiment_class = 'SomeRandomName'
     
 
 
-@with_redis
 def test_set_receiver_endpoint(cfg):
     cfg.receiver_endpoint = 'tcp://localhost:5555'
     assert cfg.receiver_endpoint == 'tcp://localhost:5555'  
 
-@with_redis
 def test_frames_to_sum(cfg):
     cfg.frames_to_sum = 10
     assert cfg.frames_to_sum == 10
 
-@with_redis
 def test_caldir(cfg):
     cfg.cal_dir = '/path/to/caldir'
     assert cfg.cal_dir == Path('/path/to/caldir')
 
 
-@with_redis
 def test_temserver(cfg):
     cfg.temserver = 'tcp://localhost:5555'
     assert cfg.temserver == 'tcp://localhost:5555'
 
-@with_redis
 def test_set_jfjoch_host(cfg):
     cfg.jfjoch_host = 'http://localhost:5232'
-    assert cfg.jfjoch_host == 'http://localhost:5232'
\ No newline at end of file
+    assert cfg.jfjoch_host == 'http://localhost:5232'
+
+def test_snapshot_reads_are_consistent(cfg):
+    cfg.PI_name = 'PIName'
+    cfg.project_id = 'ProjectID'
+    with cfg.snapshot():
+        #Change the value behind the back of the snapshot
+        cfg.client.set('PI_name', 'Other')
+        assert cfg.PI_name == 'PIName'
+        assert cfg.project_id == 'ProjectID'
+    assert cfg.PI_name == 'Other'
+
+def test_snapshot_does_not_hit_the_server(cfg, monkeypatch):
+    cfg.PI_name = 'PIName'
+    cfg.project_id = 'ProjectID'
+    cfg.experiment_class = 'UniVie'
+    cfg.base_data_dir = '/data/base/path/'
+    cfg.measurement_tag = 'Lysozyme'
+    cfg.file_id = 7
+    with cfg.snapshot():
+        def fail(*args, **kwargs):
+            raise AssertionError('Unexpected call to the server')
+        monkeypatch.setattr(cfg.client, 'get', fail)
+        monkeypatch.setattr(cfg.client, 'lrange', fail)
+        with freeze_time('2024-08-13'):
+            assert cfg.fpath == Path('/data/base/path/UniVie/PIName/2024/ProjectID/2024-08-13/007_ProjectID_Lysozyme_2024-08-13_0000_master.h5')
+        cfg.overlays
+
+def test_set_inside_snapshot_updates_snapshot(cfg):
+    cfg.file_id = 3
+    with cfg.snapshot():
+        cfg.project_id = 'NewProject'
+        cfg.viewer_cmax = 5e3
+        cfg.overlays = [{'type': 'circle'}]
+        cfg._incr_file_id()
+        assert cfg.project_id == 'NewProject'
+        assert cfg.viewer_cmax == 5e3
+        assert cfg.overlays == [{'type': 'circle'}]
+        assert cfg.file_id == 4
+    assert cfg.project_id == 'NewProject'
+    assert cfg.file_id == 4
+
+
+@pytest.fixture
+def cached_cfg():
+    cfg = ConfigurationClient(redis_host(), token=auth_token(), db = 1, cache = True)
+    yield cfg
+    cfg.close()
+
+def wait_for(condition, timeout = 1.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return False
+
+@with_redis
+def test_cache_counts_hits_and_misses(cached_cfg):
+    cached_cfg.viewer_cmin = 3
+    assert cached_cfg.viewer_cmin == 3
+    assert cached_cfg.viewer_cmin == 3
+    assert cached_cfg.cache.misses == 1
+    assert cached_cfg.cache.hits == 1
+
+@with_redis
+def test_cache_sees_remote_changes(cached_cfg):
+    cached_cfg.viewer_cmax = 100
+    cached_cfg.overlays = [{'type': 'circle'}]
+    assert cached_cfg.viewer_cmax == 100
+    assert cached_cfg.overlays == [{'type': 'circle'}]
+
+    other = redis.Redis(host=redis_host(), port=redis_port(), password=auth_token(), db=1)
+    other.set('viewer_cmax', 200)
+    other.rpush('overlays', '{"type": "rectangle"}')
+    assert wait_for(lambda: cached_cfg.viewer_cmax == 200)
+    assert wait_for(lambda: len(cached_cfg.overlays) == 2)
+
+@with_redis
+def test_cache_is_bounded(cfg):
+    cfg.viewer_cmin = 0
+    cfg.viewer_cmax = 1
+    cfg.viewer_interval = 2
+    cached = ConfigurationClient(redis_host(), token=auth_token(), db = 1, cache = True, cache_size = 2)
+    cached.viewer_cmin, cached.viewer_cmax, cached.viewer_interval
+    assert len(cached.cache) == 2
+    cached.close()
+
+def test_reserve_file_ids(cfg):
+    cfg.PI_name = 'PIName'
+    cfg.project_id = 'ProjectID'
+    cfg.experiment_class = 'UniVie'
+    cfg.base_data_dir = '/data/base/path/'
+    cfg.measurement_tag = 'Lysozyme'
+    cfg.file_id = 7
+    cfg.last_dataset = '/some/dataset'
+
+    with freeze_time('2024-08-13 12:01'):
+        paths = cfg.reserve_file_ids(3)
+    d = Path('/data/base/path/UniVie/PIName/2024/ProjectID/2024-08-13')
+    assert paths == [d / f'{i:03d}_ProjectID_Lysozyme_2024-08-13_1201_master.h5' for i in (7, 8, 9)]
+    assert cfg.file_id == 10
+    assert cfg.last_dataset == Path('/some/dataset')
+
+def test_reserve_file_ids_without_paths(cfg):
+    #Only the file_id is needed, naming keys may be unset
+    cfg.file_id = 7
+    assert cfg._reserve_file_ids(3, record_last = False, paths = False) == (10, [])
+    assert cfg.file_id == 10
+
+def test_after_write_returns_recorded_path(cfg):
+    cfg.file_id = 4
+    with freeze_time('2024-08-13'):
+        path = cfg.after_write()
+        assert path == cfg.last_dataset
+        assert path.name == '004_ProjectID_Lysozyme_2024-08-13_0000_master.h5'
+    assert cfg.file_id == 5
+
+def test_after_write_throws_on_missing_key(cfg):
+    cfg.file_id = 4
+    cfg.client.delete('measurement_tag')
+    with pytest.raises(ValueError):
+        cfg.after_write()
+    assert cfg.file_id == 4
+
+def test_from_yaml_is_not_applied_on_invalid_value(cfg):
+    cfg.PI_name = 'Erik'
+    with pytest.raises(ValueError):
+        cfg.from_yaml('tests/test_epoc_config_invalid.yaml')
+    assert cfg.PI_name == 'Erik'
+
+def test_from_yaml_reports_path_on_wrong_type(cfg, tmp_path):
+    path = tmp_path / 'wrong_type.yaml'
+    path.write_text('nrows: [514]\n')
+    with pytest.raises(ValueError, match = 'wrong_type.yaml: nrows'):
+        cfg.from_yaml(path)
+
+class CountingConnection(redis.Connection):
+    """Counts the requests sent to the server, a pipeline is sent as one"""
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        super().send_packed_command(command, check_health)
+
+@with_redis
+def test_from_yaml_and_transaction_in_one_round_trip():
+    pool = redis.ConnectionPool(host=redis_host(), port=redis_port(), password=auth_token(), db=1,
+                                connection_class=CountingConnection)
+    cfg = ConfigurationClient(backend = redis.Redis(connection_pool=pool))
+    #Loads the scripts
+    cfg.from_yaml('tests/test_epoc_config.yaml', flush_db = True)
+
+    start = CountingConnection.round_trips
+    cfg.from_yaml('tests/test_epoc_config.yaml', flush_db = True)
+    assert CountingConnection.round_trips - start == 1
+    start = CountingConnection.round_trips
+    with cfg.transaction():
+        cfg.PI_name = 'Other'
+        cfg.nrows = 1
+    assert CountingConnection.round_trips - start == 1
+
+    #After a restart of the server the scripts are loaded again
+    cfg.client.script_flush()
+    with cfg.transaction():
+        cfg.PI_name = 'Magdalena'
+        cfg.add_overlay({'type': 'circle'})
+    assert cfg.PI_name == 'Magdalena'
+    assert len(cfg.overlays) == 4
+
+def test_transaction_writes_on_exit(cfg):
+    cfg.PI_name = 'Erik'
+    with cfg.transaction():
+        cfg.PI_name = 'Other'
+        cfg.project_id = 'epoc'
+        assert cfg.PI_name == 'Erik'
+    assert cfg.PI_name == 'Other'
+    assert cfg.project_id == 'epoc'
+
+def test_set_many_overlays(cfg):
+    overlays = [{'type': 'circle', 'xy': [i, i], 'radius': 5} for i in range(500)]
+    cfg.overlays = overlays
+    assert cfg.overlays == overlays
+    cfg.overlays = []
+    assert cfg.overlays == []
+
+def test_add_overlay(cfg):
+    cfg.overlays = [{'type': 'circle'}]
+    cfg.add_overlay({'type': 'rectangle'})
+    assert cfg.overlays == [{'type': 'circle'}, {'type': 'rectangle'}]
+
+def test_dump(cfg, monkeypatch):
+    cfg.from_yaml('tests/test_epoc_config.yaml', flush_db=True)
+    def fail(*args, **kwargs):
+        raise AssertionError('Unexpected call to the server')
+    monkeypatch.setattr(cfg.client, 'get', fail)
+    with freeze_time('2024-08-13'):
+        res = cfg.dump()
+    assert res['PI_name'] == 'Erik'
+    assert res['beam_center'] == [173, 170]
+    assert res['base_data_dir'] == '/some/random/path'
+    assert res['fpath'] == '/some/random/path/External/Erik/2024/epoc/2024-08-13/003_epoc_MySample_2024-08-13_0000_master.h5'
+    assert len(res['overlays']) == 3
+    assert 'last_dataset' not in res
+    #Unset but with a default
+    assert res['rotation_speed_idx'] == 2
+
+def test_dump_without_derived_values(cfg):
+    cfg.from_yaml('tests/test_epoc_config.yaml', flush_db=True)
+    res = cfg.dump(derived = False)
+    assert 'fpath' not in res
+    assert 'data_dir' not in res
+    assert res['nrows'] == 514
+
+def test_to_yaml_round_trip(cfg, tmp_path):
+    cfg.from_yaml('tests/test_epoc_config.yaml', flush_db=True)
+    cfg.to_yaml(tmp_path / 'saved.yaml')
+    expected = cfg.dump(derived = False)
+    cfg.from_yaml(tmp_path / 'saved.yaml', flush_db=True)
+    assert cfg.dump(derived = False) == expected
+
+def test_clients_share_connection_pool(monkeypatch):
+    monkeypatch.setenv('EPOC_REDIS_HOST', 'some-host')
+    monkeypatch.setenv('EPOC_REDIS_DB', '3')
+    a = ConfigurationClient(ping = False)
+    b = ConfigurationClient(ping = False)
+    assert a.client.connection_pool is b.client.connection_pool
+    assert a.client.connection_pool.connection_kwargs['db'] == 3
+
+    c = ConfigurationClient(db = 4, ping = False)
+    assert c.client.connection_pool is not a.client.connection_pool
+
+def test_environment_is_read_at_construction(monkeypatch):
+    monkeypatch.setenv('EPOC_REDIS_HOST', 'some-host')
+    monkeypatch.setenv('EPOC_REDIS_PORT', '1234')
+    c = ConfigurationClient(ping = False)
+    kwargs = c.client.connection_pool.connection_kwargs
+    assert kwargs['host'] == 'some-host'
+    assert kwargs['port'] == 1234
+
+@with_redis
+def test_watch_with_callback(cfg):
+    cfg.beam_center = [1, 2]
+    changes = []
+    w = cfg.watch(['beam_center', 'overlays'], lambda key, value: changes.append((key, value)))
+    cfg.beam_center = [3, 4]
+    cfg.overlays = [{'type': 'circle'}]
+    assert wait_for(lambda: len(changes) == 2)
+    w.stop()
+    assert ('beam_center', [3, 4]) in changes
+    assert ('overlays', [{'type': 'circle'}]) in changes
+
+@with_redis
+def test_watch_as_iterator(cfg):
+    cfg.PI_name = 'PIName'
+    cfg.project_id = 'ProjectID'
+    cfg.experiment_class = 'UniVie'
+    cfg.base_data_dir = '/data/base/path/'
+    cfg.measurement_tag = 'Lysozyme'
+    cfg.file_id = 7
+    with cfg.watch('last_dataset', initial = True) as w:
+        it = iter(w)
+        assert next(it)[0] == 'last_dataset'
+        path = cfg.after_write()
+        assert next(it) == ('last_dataset', path)
+
+@with_redis
+def test_watch_throws_on_unknown_key(cfg):
+    with pytest.raises(ValueError):
+        cfg.watch('data_dir')
+
+
+@pytest.fixture
+def stats_cfg(cfg):
+    cfg.from_yaml(Path(__file__).parent / 'test_epoc_config.yaml')
+    cfg.file_id = 7
+    return ConfigurationClient(backend = cfg.client, stats = True)
+
+def test_stats_are_off_by_default(cfg):
+    assert cfg.stats is None
+
+def test_stats_count_requests_per_property(stats_cfg):
+    stats_cfg.fpath
+    assert stats_cfg.stats.round_trips == 7
+    assert stats_cfg.stats.properties['fpath'][0] == 7
+    assert stats_cfg.stats.properties['data_dir'][0] == 4
+    assert stats_cfg.stats.properties['PI_name'][0] == 1
+    assert stats_cfg.stats.keys['project_id'][0] == 2
+    assert stats_cfg.stats.commands['get'][0] == 7
+
+def test_stats_tell_stored_properties_apart(stats_cfg):
+    stats_cfg.PI_name = 'Magdalena'
+    stats_cfg.nrows
+    stats_cfg.PI_name
+    assert stats_cfg.stats.properties['PI_name='][0] == 1
+    assert stats_cfg.stats.properties['PI_name'][0] == 1
+    assert stats_cfg.stats.properties['nrows'][0] == 1
+    #Nothing left over for requests outside of a property
+    stats_cfg.stats.reset()
+    stats_cfg.client.get('PI_name')
+    assert not stats_cfg.stats.properties
+
+def test_stats_count_batched_requests_once(stats_cfg):
+    #Regression checks for the hot paths, see also benchmarks/
+    for func in [lambda: repr(stats_cfg), stats_cfg.after_write, stats_cfg.dump,
+                 lambda: stats_cfg.reserve_file_ids(10)]:
+        stats_cfg.stats.reset()
+        func()
+        assert stats_cfg.stats.round_trips == 1
+    assert stats_cfg.stats.keys['file_id'][0] == 1
+
+def test_stats_export(stats_cfg):
+    stats_cfg.PI_name
+    res = json.loads(stats_cfg.stats.to_json())
+    assert res['keys']['PI_name']['requests'] == 1
+    text = stats_cfg.stats.to_prometheus()
+    assert 'epoc_config_requests_total 1\n' in text
+    assert 'epoc_config_property_requests_total{property="PI_name"} 1\n' in text
+
+
+@pytest.fixture
+def instrument_cfg(cfg):
+    cfg.client.delete('epoc:test-a', 'epoc:test-a:overlays', 'epoc:test-b', 'epoc:test-b:overlays')
+    return ConfigurationClient(backend = cfg.client, instrument = 'test-a')
+
+def test_instrument_is_stored_in_a_hash(cfg, instrument_cfg):
+    cfg.PI_name = 'Flat'
+    instrument_cfg.PI_name = 'Hash'
+    instrument_cfg.overlays = [{'type': 'circle'}]
+    assert cfg.PI_name == 'Flat'
+    assert instrument_cfg.PI_name == 'Hash'
+    assert instrument_cfg.overlays == [{'type': 'circle'}]
+    assert cfg.client.hget('epoc:test-a', 'PI_name') == b'Hash'
+    assert instrument_cfg.instrument == 'test-a'
+
+def test_instrument_paths_and_after_write(instrument_cfg):
+    instrument_cfg.from_yaml(Path(__file__).parent / 'test_epoc_config.yaml')
+    instrument_cfg.file_id = 7
+    with freeze_time('2024-08-13'):
+        path = Path('/some/random/path/External/Erik/2024/epoc/2024-08-13/007_epoc_MySample_2024-08-13_0000_master.h5')
+        assert instrument_cfg.fpath == path
+        assert instrument_cfg.after_write() == path
+    assert instrument_cfg.file_id == 8
+    assert instrument_cfg.last_dataset == path
+
+def test_invalid_instrument_name(cfg):
+    with pytest.raises(ValueError):
+        ConfigurationClient(backend = cfg.client, instrument = 'a:b')
+
+def test_migrate_flat_keys(cfg, instrument_cfg):
+    cfg.from_yaml(Path(__file__).parent / 'test_epoc_config.yaml')
+    instrument_cfg.migrate_flat_keys()
+    assert instrument_cfg.compare(None) == {}
+    assert instrument_cfg.beam_center == cfg.beam_center
+    assert instrument_cfg.overlays == cfg.overlays
+
+def test_copy_and_compare_instruments(instrument_cfg):
+    instrument_cfg.from_yaml(Path(__file__).parent / 'test_epoc_config.yaml')
+    instrument_cfg.copy_to('test-b')
+    other = ConfigurationClient(backend = instrument_cfg.client, instrument = 'test-b')
+    assert other.dump() == instrument_cfg.dump()
+    other.PI_name = 'Other'
+    assert instrument_cfg.compare('test-b') == {'PI_name': ('Erik', 'Other')}
+
+@with_redis
+def test_watch_instrument(instrument_cfg):
+    instrument_cfg.beam_center = [1, 2]
+    instrument_cfg.PI_name = 'Erik'
+    changes = []
+    w = instrument_cfg.watch(['beam_center', 'PI_name'], lambda key, value: changes.append((key, value)))
+    instrument_cfg.beam_center = [3, 4]
+    assert wait_for(lambda: len(changes) == 1)
+    w.stop()
+    #Fields of the same hash that did not change are not reported
+    assert changes == [('beam_center', [3, 4])]
+
+@with_redis
+def test_cache_instrument(instrument_cfg):
+    instrument_cfg.viewer_cmax = 100
+    cached = ConfigurationClient(redis_host(), token=auth_token(), db = 1, cache = True, instrument = 'test-a')
+    try:
+        assert cached.viewer_cmax == 100
+        instrument_cfg.viewer_cmax = 200
+        assert wait_for(lambda: cached.viewer_cmax == 200)
+    finally:
+        cached.close()
+
+def test_writes_are_recorded_in_history(cfg):
+    cfg.PI_name = 'Erik'
+    cfg.PI_name = 'Magdalena'
+    cfg.add_overlay({'type': 'circle'})
+    first, second = cfg.history(3)[:2]
+    assert (first['key'], first['new']) == ('PI_name', 'Erik')
+    assert (second['op'], second['old'], second['new']) == ('set', 'Erik', 'Magdalena')
+    assert cfg.history(1)[0]['new'][-1] == {'type': 'circle'}
+
+def test_as_of_time(cfg):
+    cfg.PI_name = 'Erik'
+    time.sleep(0.01)
+    t = datetime.now()
+    time.sleep(0.01)
+    cfg.PI_name = 'Magdalena'
+    assert cfg.as_of(t)['PI_name'] == 'Erik'
+    assert cfg.as_of(datetime.now())['PI_name'] == 'Magdalena'
+
+def test_as_of_file_id(cfg):
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+    cfg.file_id = 4
+    cfg.after_write()
+    cfg.measurement_tag = 'Other'
+    cfg.reserve_file_ids(2)
+    assert cfg.as_of_file_id(4)['measurement_tag'] == 'MySample'
+    assert cfg.as_of_file_id(6)['measurement_tag'] == 'Other'
+    with pytest.raises(ValueError):
+        cfg.as_of_file_id(100)
+
+def test_file_id_set_by_hand_is_not_used():
+    c = ConfigurationClient(backend = MemoryBackend())
+    c.from_yaml('tests/test_epoc_config.yaml')
+    c.file_id = 4
+    c.after_write()
+    assert c.as_of_file_id(4)['measurement_tag'] == 'MySample'
+    for file_id in (2, 5):
+        with pytest.raises(ValueError):
+            c.as_of_file_id(file_id)
+
+@pytest.mark.parametrize('checkpoint, maxlen', [(3, 10000), (10000, 3)])
+def test_as_of_with_checkpoints_or_trimmed_history(cfg, monkeypatch, checkpoint, maxlen):
+    module = sys.modules['epoc.ConfigurationClient']
+    monkeypatch.setattr(module, '_history_checkpoint', checkpoint)
+    monkeypatch.setattr(module, '_history_maxlen', maxlen)
+    times = []
+    for i in range(8):
+        cfg.nrows = i
+        time.sleep(0.01)
+        times.append(datetime.now())
+        time.sleep(0.01)
+    cfg.nrows = 514
+    #Older values are lost when the history is trimmed
+    assert [cfg.as_of(t)['nrows'] for t in times[-2:]] == [6, 7]
+
+def test_history_can_be_disabled(cfg):
+    other = ConfigurationClient(backend = cfg.client, history = False)
+    other.PI_name = 'NotRecorded'
+    assert cfg.history(1)[0]['new'] != 'NotRecorded'
+    with pytest.raises(ValueError):
+        other.history()
+
+def test_local_cache_follows_snapshots_and_writes(cfg, tmp_path):
+    path = tmp_path / 'local.json'
+    cfg.from_yaml('tests/test_epoc_config.yaml', flush_db = True)
+    local = ConfigurationClient(backend = cfg.client, local_cache = path)
+    assert not path.exists()
+    local.dump()
+    local.PI_name = 'Magdalena'
+    local.add_overlay({'type': 'circle'})
+    raw = LocalSnapshot(path).load()
+    assert raw['PI_name'] == b'Magdalena'
+    assert len(raw['overlays']) == 4
+    with pytest.raises(ValueError):
+        LocalSnapshot(path, instrument = 'jem2100plus').load()
+
+def test_local_cache_is_created_by_first_write(cfg, tmp_path):
+    path = tmp_path / 'local.json'
+    cfg.from_yaml('tests/test_epoc_config.yaml', flush_db = True)
+    ConfigurationClient(backend = cfg.client, local_cache = path).PI_name = 'Magdalena'
+    raw = LocalSnapshot(path).load()
+    assert raw['PI_name'] == b'Magdalena'
+    assert raw['project_id'] == b'epoc'
+
+    other = ConfigurationClient(backend = cfg.client, local_cache = tmp_path / 'other.json')
+    with other.transaction():
+        other.PI_name = 'Erik'
+        other.nrows = 1
+    raw = LocalSnapshot(tmp_path / 'other.json').load()
+    assert (raw['PI_name'], raw['nrows']) == (b'Erik', b'1')
+
+def test_start_offline_from_local_cache(cfg, tmp_path):
+    path = tmp_path / 'local.json'
+    cfg.from_yaml('tests/test_epoc_config.yaml', flush_db = True)
+    ConfigurationClient(backend = cfg.client, local_cache = path).dump()
+
+    #Nothing listens on port 1
+    with pytest.raises(ValueError):
+        ConfigurationClient('127.0.0.1', port = 1)
+    offline = ConfigurationClient('127.0.0.1', port = 1, local_cache = path)
+    try:
+        assert offline.offline
+        assert offline.PI_name == 'Erik'
+        assert offline.dump()['beam_center'] == [173, 170]
+        with pytest.raises(ValueError):
+            offline.PI_name = 'Magdalena'
+    finally:
+        offline.close()
+
+def test_start_offline_with_cache(cfg, tmp_path):
+    path = tmp_path / 'local.json'
+    cfg.PI_name = 'Erik'
+    ConfigurationClient(backend = cfg.client, local_cache = path).dump()
+    offline = ConfigurationClient('127.0.0.1', port = 1, local_cache = path, cache = True)
+    try:
+        assert offline.offline
+        assert offline.cache is None
+        assert offline.PI_name == 'Erik'
+    finally:
+        offline.close()
+
+def test_reconnect_retries_on_server_errors(cfg, tmp_path, monkeypatch):
+    monkeypatch.setattr(sys.modules['epoc.ConfigurationClient'], '_reconnect_interval', 0.01)
+    cfg.PI_name = 'Erik'
+    local = ConfigurationClient(backend = cfg.client, local_cache = tmp_path / 'local.json')
+    local.dump()
+    errors = [redis.exceptions.TimeoutError('Timeout reading from socket')]
+    fetch = local._fetch
+    def loading(*args):
+        if errors:
+            raise errors.pop()
+        return fetch(*args)
+    local._fetch = loading
+    local._go_offline()
+    try:
+        assert wait_for(lambda: not local.offline)
+        assert not errors
+    finally:
+        local.close()
+
+@with_redis
+def test_cache_is_started_on_reconnect(cfg, tmp_path, monkeypatch):
+    monkeypatch.setattr(sys.modules['epoc.ConfigurationClient'], '_reconnect_interval', 0.01)
+    cfg.PI_name = 'Erik'
+    ConfigurationClient(backend = cfg.client, local_cache = tmp_path / 'local.json').dump()
+    def refused(self):
+        raise redis.exceptions.ConnectionError('Connection refused')
+    with monkeypatch.context() as m:
+        m.setattr(redis.Redis, 'ping', refused)
+        local = ConfigurationClient(redis_host(), port = redis_port(), token = auth_token(), db = 1,
+                                    local_cache = tmp_path / 'local.json', cache = True)
+    try:
+        assert local.offline and local.cache is None
+        assert wait_for(lambda: not local.offline)
+        assert local.cache is not None
+        assert local.PI_name == 'Erik'
+        cfg.PI_name = 'Magdalena'
+        assert wait_for(lambda: local.PI_name == 'Magdalena')
+    finally:
+        local.close()
+
+@with_redis
+def test_reconnect_after_offline(cfg, tmp_path, monkeypatch):
+    monkeypatch.setattr(sys.modules['epoc.ConfigurationClient'], '_reconnect_interval', 0.01)
+    cfg.PI_name = 'Erik'
+    local = ConfigurationClient(redis_host(), token=auth_token(), db = 1, local_cache = tmp_path / 'local.json')
+    local.dump()
+    local._go_offline()
+    cfg.PI_name = 'Magdalena'
+    assert wait_for(lambda: not local.offline)
+    assert local.PI_name == 'Magdalena'
+    assert LocalSnapshot(tmp_path / 'local.json').load()['PI_name'] == b'Magdalena'
+
+def test_session_paths_are_frozen(cfg, tmp_path):
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+    cfg.base_data_dir = tmp_path
+    cfg.file_id = 7
+    with freeze_time('2024-08-13 23:59') as frozen:
+        with cfg.session(2) as session:
+            frozen.move_to('2024-08-14 00:01')
+            cfg.measurement_tag = 'Changed'
+            paths = [session.next_path() for _ in range(3)]
+            assert session.wait()
+    assert [p.name for p in paths] == [f'{i:03d}_epoc_MySample_2024-08-13_2359_master.h5' for i in (7, 8, 9)]
+    assert paths[0].parent == tmp_path / 'External' / 'Erik' / '2024' / 'epoc' / '2024-08-13'
+    assert paths[0].parent.is_dir()
+    assert cfg.file_id == 11
+
+def test_session_hands_out_paths_without_requests(cfg, tmp_path):
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+    cfg.base_data_dir = tmp_path
+    stats_cfg = ConfigurationClient(backend = cfg.client, stats = True)
+    session = stats_cfg.session(3)
+    stats_cfg.stats.reset()
+    for _ in range(3):
+        path = session.next_path()
+    assert stats_cfg.stats.round_trips == 0
+    session.finished(path)
+    assert cfg.last_dataset == path
@@ -0,0 +1,103 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+#Optional, not needed for the configuration client
+np = pytest.importorskip('numpy')
+from epoc.detector_stats import DetectorStatsStore
+
+
+def run_stats(ratio, cancelled = False):
+    return SimpleNamespace(images_expected = 100, images_collected = 100, compression_ratio = ratio,
+                           cancelled = cancelled, collection_efficiency = None)
+
+def calibration_stats(g0):
+    return [SimpleNamespace(module_number = m, storage_cell_number = 0, pedestal_g0_mean = g0 + m,
+                            pedestal_g1_mean = 14000.0, pedestal_g2_mean = 15000.0, gain_g0_mean = 40.0,
+                            gain_g1_mean = -1.5, gain_g2_mean = -0.1, masked_pixels = 3)
+            for m in range(2)]
+
+
+def test_record_and_read_runs(tmp_path):
+    store = DetectorStatsStore(tmp_path)
+    store.record_run(run_stats(6.0), file_id = 1, fpath = '/data/001_master.h5', when = datetime(2025, 1, 1, 12))
+    store.record_run(run_stats(8.0, True), file_id = 2, fpath = '/data/002_master.h5', when = datetime(2025, 1, 2, 12))
+
+    #Reopened from disk
+    runs = DetectorStatsStore(tmp_path).runs()
+    assert list(runs['file_id']) == [1, 2]
+    assert list(runs['compression_ratio']) == [6.0, 8.0]
+    assert list(runs['cancelled']) == [0, 1]
+    assert list(runs['fpath']) == ['/data/001_master.h5', '/data/002_master.h5']
+    #Not reported
+    assert np.isnan(runs['collection_efficiency']).all()
+    assert list(runs['images_written']) == [-1, -1]
+
+    runs = store.runs(start = datetime(2025, 1, 2), columns = ['file_id'])
+    assert list(runs) == ['time', 'file_id']
+    assert list(runs['file_id']) == [2]
+    assert store.find(2)['fpath'] == '/data/002_master.h5'
+    assert store.find(3) is None
+
+def test_keys_from_configuration(cfg, tmp_path):
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+    cfg.file_id = 17
+    store = DetectorStatsStore(tmp_path, cfg)
+    store.record_run(run_stats(5.0))
+    row = store.find(17)
+    assert row['fpath'].startswith(str(cfg.data_dir))
+
+def test_partly_written_row_is_ignored(tmp_path):
+    store = DetectorStatsStore(tmp_path)
+    store.record_run(run_stats(6.0), file_id = 1, fpath = 'a')
+    with open(tmp_path / 'runs' / 'file_id.bin', 'ab') as f:
+        f.write(np.array([99]).tobytes())
+    with open(tmp_path / 'runs' / 'fpath.txt', 'a') as f:
+        f.write('torn\n')
+    assert len(store.runs()['time']) == 1
+
+    store.record_run(run_stats(8.0), file_id = 3, fpath = 'b')
+    runs = store.runs()
+    assert list(runs['file_id']) == [1, 3]
+    assert list(runs['compression_ratio']) == [6.0, 8.0]
+    assert list(runs['fpath']) == ['a', 'b']
+    assert store.find(3)['fpath'] == 'b'
+
+def test_trend(tmp_path):
+    store = DetectorStatsStore(tmp_path)
+    for day, ratio in [(1, 6.0), (1, 8.0), (2, 10.0)]:
+        store.record_run(run_stats(ratio), file_id = day, fpath = '', when = datetime(2025, 1, day, 12))
+    days, means = store.trend('compression_ratio')
+    assert list(days.astype(str)) == ['2025-01-01', '2025-01-02']
+    assert list(means) == [7.0, 10.0]
+    with pytest.raises(ValueError):
+        store.trend('fpath')
+
+def test_pedestal_drift(tmp_path):
+    store = DetectorStatsStore(tmp_path)
+    store.record_calibration(calibration_stats(3000.0), file_id = 1, when = datetime(2025, 1, 1))
+    store.record_calibration(calibration_stats(3004.0), file_id = 5, when = datetime(2025, 1, 8))
+    drift = store.pedestal_drift('g0')
+    assert sorted(drift) == [0, 1]
+    times, values = drift[1]
+    assert list(values) == [0.0, 4.0]
+    assert len(store.calibration(module = 0)['time']) == 2
+    days, means = store.trend('pedestal_g0_mean', module = 1, every = 'D')
+    assert list(means) == [3001.0, 3005.0]
+
+def test_columns_must_match(tmp_path):
+    DetectorStatsStore(tmp_path)
+    (tmp_path / 'runs' / 'columns.json').write_text('{"time": "f8"}')
+    with pytest.raises(ValueError):
+        DetectorStatsStore(tmp_path)
+
+def test_to_hdf5(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    store = DetectorStatsStore(tmp_path / 'stats')
+    store.record_run(run_stats(6.0), file_id = 1, fpath = '/data/001_master.h5')
+    store.to_hdf5(tmp_path / 'stats.h5')
+    with h5py.File(tmp_path / 'stats.h5') as f:
+        assert list(f['runs/compression_ratio'][:]) == [6.0]
+        assert f['runs/fpath'].asstr()[0] == '/data/001_master.h5'
+        assert len(f['calibration/time']) == 0
@@ -0,0 +1,332 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+jfjoch_client = pytest.importorskip('jfjoch_client')
+from epoc import AsyncJungfraujochWrapper, JungfraujochWrapper, StatusPoller, StatusSubscriber
+from epoc.mock_broker import MockBroker
+from epoc.scheduler import AcquisitionJob, AcquisitionScheduler
+
+
+class SlowApi:
+    """Stands in for jfjoch_client.DefaultApi, every request takes delay seconds"""
+    def __init__(self, states, delay = 0.1):
+        self.states = list(states)
+        self.delay = delay
+        self.posted = []
+
+    def status_get(self):
+        time.sleep(self.delay)
+        state = self.states.pop(0) if len(self.states) > 1 else self.states[0]
+        return SimpleNamespace(state = state, progress = None, message = None)
+
+    def statistics_data_collection_get(self):
+        time.sleep(self.delay)
+        return SimpleNamespace(run_number = None, file_prefix = '', images_expected = 10,
+                               images_collected = 10, cancelled = False)
+
+    def start_post(self, dataset_settings):
+        self.posted.append(dataset_settings)
+
+    def cancel_post(self):
+        self.posted.append('cancel')
+
+
+def run(api, coro_func, max_workers = 4):
+    async def main():
+        async with AsyncJungfraujochWrapper('http://localhost:5232', max_workers = max_workers) as j:
+            j.wrapper.api_instance = api
+            return await coro_func(j)
+    return asyncio.run(main())
+
+
+def test_requests_overlap():
+    async def f(j):
+        t0 = time.monotonic()
+        s, stats = await asyncio.gather(j.status(), j.statistics_data_collection())
+        return time.monotonic() - t0, s, stats
+    elapsed, s, stats = run(SlowApi(['Idle'], delay = 0.2), f)
+    assert elapsed < 0.35
+    assert s.state == 'Idle'
+    assert stats.images_collected == 10
+
+def test_event_loop_is_not_blocked():
+    ticks = []
+    async def tick():
+        for _ in range(5):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+    async def f(j):
+        await asyncio.gather(j.status(), tick())
+    run(SlowApi(['Idle'], delay = 0.2), f)
+    assert ticks[-1] - ticks[0] < 0.15
+
+def test_start_and_wait():
+    api = SlowApi(['Idle', 'Busy', 'Measuring', 'Measuring', 'Idle'], delay = 0.01)
+    async def f(j):
+        await j.start(10, fname = 'test', wait = True)
+        return await j.status()
+    assert run(api, f).state == 'Idle'
+    assert api.posted[0].images_per_trigger == 10
+    assert api.posted[0].file_prefix == 'test'
+
+def test_wait_raises_on_error_state():
+    async def f(j):
+        await j.wait_until_idle(quiet = True)
+    with pytest.raises(RuntimeError):
+        run(SlowApi(['Measuring', 'Error'], delay = 0.01), f)
+
+def test_wait_times_out():
+    async def f(j):
+        await j.wait_until_idle(quiet = True, timeout = 0.1)
+    with pytest.raises(TimeoutError):
+        run(SlowApi(['Measuring'], delay = 0.01), f)
+
+
+class CountingWrapper:
+    """Stands in for JungfraujochWrapper, counts the requests to the broker"""
+    def __init__(self, state = 'Idle'):
+        self.calls = 0
+        self.state = state
+
+    def status(self):
+        self.calls += 1
+        return jfjoch_client.BrokerStatus(state = self.state, progress = 0.5)
+
+
+def test_poller_request_rate_is_fixed():
+    w = CountingWrapper()
+    with StatusPoller(w, interval = 0.05) as poller:
+        for _ in range(200):
+            assert poller.status().state == 'Idle'
+        time.sleep(0.25)
+    assert 4 <= w.calls <= 8
+
+def test_poller_status_max_age():
+    w = CountingWrapper('Measuring')
+    with StatusPoller(w, interval = 0.05) as poller:
+        s = poller.status(max_age = 0.01, timeout = 1)
+        assert s.state == 'Measuring'
+        assert poller.age < 0.1
+    time.sleep(0.05)
+    with pytest.raises(TimeoutError):
+        poller.status(max_age = 0.01, timeout = 0.1)
+
+def test_poller_fan_out():
+    w = CountingWrapper()
+    states = []
+    with StatusPoller(w, interval = 0.02) as poller:
+        q = poller.queue()
+        cb = poller.subscribe(lambda s, t: states.append(s.state))
+        s, t = q.get(timeout = 1)
+        poller.unsubscribe(cb)
+    assert s.state == 'Idle'
+    assert t <= time.time()
+    assert states and set(states) == {'Idle'}
+
+def test_failing_callback_warns():
+    w = CountingWrapper()
+    states = []
+    def fail(s, t):
+        raise RuntimeError('broken subscriber')
+    with pytest.warns(UserWarning, match = 'broken subscriber'):
+        with StatusPoller(w, interval = 0.02) as poller:
+            poller.subscribe(fail)
+            poller.subscribe(lambda s, t: states.append(s.state))
+            poller.status(max_age = 0.01, timeout = 1)
+            time.sleep(0.1)
+    assert states
+
+def test_subscriber_in_other_process():
+    w = CountingWrapper('Measuring')
+    with StatusPoller(w, interval = 0.02, publish = 'tcp://127.0.0.1:5299') as poller, \
+         StatusSubscriber('tcp://127.0.0.1:5299') as sub:
+        s = sub.status(timeout = 2)
+        assert s.state == 'Measuring'
+        assert s.progress == 0.5
+        assert sub.time >= poller.time - 1
+
+
+@pytest.fixture
+def broker():
+    with MockBroker(arm_time = 0.02, cancel_time = 0.01, init_time = 0.02, pedestal_time = 0.05,
+                    time_scale = 0.01) as broker:
+        yield broker
+
+def test_start_and_wait_with_broker(broker):
+    j = JungfraujochWrapper(broker.url)
+    j.start(100, fname = 'test', wait = True)
+    assert broker.state == 'Idle'
+    s = j.api_instance.statistics_data_collection_get()
+    assert s.images_collected == 100
+    assert s.file_prefix == 'test'
+    assert not s.cancelled
+
+def test_cancel_with_broker(broker):
+    j = JungfraujochWrapper(broker.url)
+    j.start(100000)
+    assert j.wait_until_started().state == 'Measuring'
+    j.cancel()
+    assert j.wait_until_idle(quiet = True, timeout = 1).state == 'Idle'
+    s = j.api_instance.statistics_data_collection_get()
+    assert s.cancelled
+    assert s.images_collected < 100000
+
+def test_start_while_measuring_fails(broker):
+    j = JungfraujochWrapper(broker.url)
+    j.start(100000)
+    with pytest.raises(jfjoch_client.ApiException):
+        j.start(10)
+
+def test_wait_returns_at_once_for_short_runs():
+    #Over before the first status request, never seen as started
+    with MockBroker(arm_time = 0, pedestal_time = 0, time_scale = 0) as broker:
+        j = JungfraujochWrapper(broker.url)
+        for _ in range(2):
+            t0 = time.monotonic()
+            j.start(10, wait = True)
+            j.collect_pedestal(wait = True)
+            assert time.monotonic() - t0 < 0.3
+        assert broker.requests['/start'] == 2
+
+        async def main():
+            async with AsyncJungfraujochWrapper(broker.url) as aj:
+                t0 = time.monotonic()
+                await aj.start(10, wait = True)
+                await aj.collect_pedestal(wait = True)
+                return time.monotonic() - t0
+        assert asyncio.run(main()) < 0.3
+
+def test_init_and_pedestal_with_broker():
+    with MockBroker(initialized = False, init_time = 0.02, pedestal_time = 0.05) as broker:
+        j = JungfraujochWrapper(broker.url)
+        with pytest.raises(RuntimeError):
+            j.wait_until_idle(quiet = True)
+        j.init()
+        j.wait_until_idle(quiet = True, timeout = 1)
+        j.collect_pedestal(wait = True)
+        stats = j.api_instance.statistics_calibration_get()
+        assert [s.module_number for s in stats] == [0, 1]
+        assert broker.requests['/pedestal'] == 1
+
+def test_async_wrapper_with_broker(broker):
+    async def main():
+        async with AsyncJungfraujochWrapper(broker.url) as j:
+            await j.start(100000)
+            assert (await j.wait_until_started()).state == 'Measuring'
+            s, stats = await asyncio.gather(j.status(), j.statistics_data_collection())
+            assert s.state == 'Measuring'
+            assert stats.images_expected == 100000
+            await j.cancel()
+            await j.wait_until_idle(quiet = True, timeout = 1)
+    asyncio.run(main())
+
+def test_scheduler_runs_jobs_back_to_back(broker, cfg, tmp_path):
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+    cfg.base_data_dir = tmp_path
+    cfg.file_id = 3
+    j = JungfraujochWrapper(broker.url)
+    j.live()
+    scheduler = AcquisitionScheduler(j, cfg, timeout = 5)
+    scheduler.add(100, threshold = 2, measurement_tag = 'First', pedestal_before = True)
+    scheduler.add(AcquisitionJob(50, measurement_tag = 'Sec ond', beam_x_pxl = 500))
+    jobs = scheduler.run()
+
+    assert [job.path.name[:9] for job in jobs] == ['003_epoc_', '004_epoc_']
+    assert 'First' in jobs[0].path.name and 'Second' in jobs[1].path.name
+    assert jobs[0].path.parent.is_dir()
+    assert cfg.last_dataset == jobs[1].path
+    assert all(job.duration > 0 for job in jobs)
+    assert len(scheduler.dead_times()) == 1
+    assert 0 <= scheduler.dead_times()[0] < 1
+    assert jobs[1].times['running'] - jobs[0].times['idle'] == scheduler.dead_times()[0]
+    assert [job.file_id for job in jobs] == [3, 4]
+    assert broker.requests['/pedestal'] == 1
+    assert broker.requests['/start'] == 4
+    #Back in live mode
+    assert broker.state == 'Measuring'
+    assert len(scheduler) == 0
+
+def test_scheduler_failed_job_is_requeued(broker, cfg, tmp_path):
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+    cfg.base_data_dir = tmp_path
+    j = JungfraujochWrapper(broker.url)
+    scheduler = AcquisitionScheduler(j, cfg, timeout = 0.2)
+    first = scheduler.add(10)
+    second = scheduler.add(100000)
+    with pytest.raises(TimeoutError):
+        scheduler.run()
+
+    assert scheduler.done == [first]
+    assert cfg.last_dataset == first.path
+    assert list(scheduler._queue) == [second]
+    assert isinstance(second.error, TimeoutError)
+    #Cancelled and back in live mode
+    assert broker.requests['/cancel'] == 2
+    assert broker.state == 'Measuring'
+
+def test_scheduler_short_jobs_are_not_waited_for(cfg, tmp_path):
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+    cfg.base_data_dir = tmp_path
+    with MockBroker(arm_time = 0, time_scale = 0) as broker:
+        j = JungfraujochWrapper(broker.url)
+        scheduler = AcquisitionScheduler(j, cfg, live = False, timeout = 5)
+        for _ in range(3):
+            scheduler.add(10)
+        t0 = time.monotonic()
+        jobs = scheduler.run()
+        assert time.monotonic() - t0 < 0.5
+    assert all(job.statistics.images_collected == 10 for job in jobs)
+    assert all(t < 0.2 for t in scheduler.dead_times())
+
+def test_scheduler_keeps_error_if_broker_is_gone(broker, cfg, tmp_path):
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+    cfg.base_data_dir = tmp_path
+    j = JungfraujochWrapper(broker.url)
+    scheduler = AcquisitionScheduler(j, cfg, timeout = 5)
+    job = scheduler.add(100000)
+    def gone():
+        raise ConnectionError('Broker gone')
+    def error(**kwargs):
+        j.cancel = gone
+        raise RuntimeError('Detector in Error state')
+    j.wait_until_started = error
+    with pytest.warns(UserWarning, match = 'live mode not resumed'):
+        with pytest.raises(RuntimeError, match = 'Error state'):
+            scheduler.run()
+    assert isinstance(job.error, RuntimeError)
+    assert list(scheduler._queue) == [job]
+    #Only the job, live mode not started
+    assert broker.requests['/start'] == 1
+
+def test_progress_samples_with_broker(broker):
+    j = JungfraujochWrapper(broker.url)
+    j.start(1000)
+    res = list(j.progress_samples(interval = 0.05))
+    assert res[-1].state == 'Idle'
+    measuring = [s for s in res if s.state == 'Measuring']
+    assert len(measuring) >= 3
+    assert all(s.images_expected == 1000 for s in measuring)
+    #1000 images in 0.5 s
+    assert measuring[-1].rate == pytest.approx(2000, rel = 0.3)
+    assert broker.requests['/statistics/data_collection'] == 1
+
+def test_statistics_are_recorded(broker, cfg, tmp_path):
+    cfg.from_yaml('tests/test_epoc_config.yaml')
+    cfg.base_data_dir = tmp_path
+    pytest.importorskip('numpy')
+    from epoc.detector_stats import DetectorStatsStore
+    store = DetectorStatsStore(tmp_path / 'stats', cfg)
+    j = JungfraujochWrapper(broker.url, store = store)
+    j.collect_pedestal(wait = True)
+    assert list(store.calibration()['module_number']) == [0, 1]
+
+    scheduler = AcquisitionScheduler(j, cfg, live = False)
+    jobs = [scheduler.add(10), scheduler.add(20)]
+    scheduler.run()
+    runs = store.runs()
+    assert list(runs['file_id']) == [job.file_id for job in jobs]
+    assert list(runs['images_collected']) == [10, 20]
+    assert list(runs['fpath']) == [str(job.path) for job in jobs]
@@ -0,0 +1,66 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from epoc import polling
+
+
+def statuses(*states):
+    """poll function returning the states in order, then the last one forever"""
+    items = [SimpleNamespace(state = s, progress = p) for s, p in states]
+    calls = []
+    def poll():
+        calls.append(time.monotonic())
+        return items[min(len(calls), len(items)) - 1]
+    poll.calls = calls
+    return poll
+
+
+def test_backoff_grows_until_max():
+    b = polling.Backoff(0.01, 0.05, factor = 2)
+    assert [b.next() for _ in range(5)] == pytest.approx([0.01, 0.02, 0.04, 0.05, 0.05])
+    b.reset()
+    assert b.next() == pytest.approx(0.01)
+
+def test_backoff_polls_faster_near_the_end():
+    b = polling.Backoff(0.01, 10, factor = 10)
+    b.next(progress = 0.0, now = 0)
+    b.next(progress = 0.5, now = 1)
+    #0.45 s left at this rate, poll within half of it
+    assert b.next(progress = 0.95, now = 1.9) == pytest.approx(0.05 / 0.95 * 1.9 / 2)
+    assert b.next(progress = 1.0, now = 2) == pytest.approx(0.01)
+
+def test_backoff_rejects_invalid_intervals():
+    with pytest.raises(ValueError):
+        polling.Backoff(0.5, 0.1)
+
+def test_wait_returns_first_matching_status():
+    poll = statuses(('Idle', None), ('Busy', None), ('Measuring', 0.5), ('Idle', None))
+    changes = []
+    s = polling.wait(poll, lambda s: s.state == 'Idle' and len(poll.calls) > 1,
+                     on_status = lambda s, changed: changed and changes.append(s.state))
+    assert s.state == 'Idle'
+    assert len(poll.calls) == 4
+    assert changes == ['Idle', 'Busy', 'Measuring', 'Idle']
+
+def test_wait_backs_off_while_state_is_unchanged():
+    poll = statuses(*[('Measuring', None)] * 6, ('Idle', None))
+    polling.wait(poll, lambda s: s.state == 'Idle', backoff = polling.Backoff(0.01, 1, factor = 2))
+    #0.01 + 0.02 + 0.04 + 0.08 + 0.16 + 0.32
+    assert poll.calls[-1] - poll.calls[0] == pytest.approx(0.63, abs = 0.1)
+
+def test_wait_times_out():
+    poll = statuses(('Measuring', 0.1))
+    t0 = time.monotonic()
+    with pytest.raises(TimeoutError):
+        polling.wait(poll, lambda s: s.state == 'Idle', timeout = 0.1)
+    assert time.monotonic() - t0 < 0.3
+
+def test_async_wait():
+    poll = statuses(('Busy', None), ('Measuring', 0.5), ('Idle', None))
+    async def apoll():
+        return poll()
+    s = asyncio.run(polling.async_wait(apoll, lambda s: s.state == 'Idle'))
+    assert s.state == 'Idle'
+    assert len(poll.calls) == 3
@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from epoc.progress import ProgressTracker, samples, async_samples
+
+
+def status(state, progress = None):
+    return SimpleNamespace(state = state, progress = progress)
+
+stats = SimpleNamespace(images_expected = 1000)
+
+
+def test_rate_and_eta():
+    tracker = ProgressTracker(smoothing = 1)
+    s = tracker.update(status('Measuring', 0.0), t = 10, statistics = stats)
+    assert s.images == 0 and s.rate is None and s.eta is None
+    s = tracker.update(status('Measuring', 0.2), t = 11)
+    assert s.images == 200
+    assert s.rate == pytest.approx(200)
+    assert s.eta == pytest.approx(4)
+
+def test_rate_is_smoothed():
+    tracker = ProgressTracker(smoothing = 0.5)
+    tracker.update(status('Measuring', 0.0), t = 0, statistics = stats)
+    tracker.update(status('Measuring', 0.1), t = 1)
+    s = tracker.update(status('Measuring', 0.4), t = 2)
+    assert s.instant_rate == pytest.approx(300)
+    assert s.rate == pytest.approx(200)
+
+def test_stall_is_detected():
+    tracker = ProgressTracker(stall_after = 1)
+    tracker.update(status('Measuring', 0.5), t = 0)
+    assert not tracker.update(status('Measuring', 0.5), t = 0.5).stalled
+    assert tracker.update(status('Measuring', 0.5), t = 1.5).stalled
+    assert not tracker.update(status('Measuring', 0.6), t = 2).stalled
+
+def test_images_need_statistics():
+    tracker = ProgressTracker()
+    assert tracker.needs_statistics(status('Measuring', 0.1))
+    s = tracker.update(status('Measuring', 0.1), t = 0)
+    assert s.progress == 0.1 and s.images is None
+    assert not tracker.needs_statistics(status('Measuring', 0.2))
+
+def test_invalid_smoothing():
+    with pytest.raises(ValueError):
+        ProgressTracker(smoothing = 0)
+
+def test_samples_stop_when_idle():
+    states = iter([status('Busy'), status('Measuring', 0.5), status('Measuring', 0.9), status('Idle')])
+    res = list(samples(lambda: next(states), lambda: stats, interval = 0.01))
+    assert [s.state for s in res] == ['Busy', 'Measuring', 'Measuring', 'Idle']
+    assert res[2].images == 900
+    assert res[2].rate > 0
+
+def test_async_samples():
+    states = iter([status('Measuring', 0.5), status('Error')])
+    async def poll():
+        return next(states)
+    async def main():
+        return [s async for s in async_samples(poll, interval = 0.01)]
+    assert [s.state for s in asyncio.run(main())] == ['Measuring', 'Error']
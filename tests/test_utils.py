@@ -0,0 +1,54 @@
+import pytest
+from epoc.utils import freeze
+
+
+@freeze
+class Detector:
+    def __init__(self):
+        self.exptime = 1
+
+    @property
+    def period(self):
+        return 2 * self.exptime
+
+    @period.setter
+    def period(self, value):
+        self.exptime = value / 2
+
+class Jungfrau(Detector):
+    def __init__(self):
+        super().__init__()
+        self.nrows = 512
+
+@freeze
+class Slotted:
+    __slots__ = ('exptime',)
+    def __init__(self):
+        self.exptime = 1
+
+class SlottedJungfrau(Slotted):
+    __slots__ = ('nrows',)
+    def __init__(self):
+        super().__init__()
+        self.nrows = 512
+
+
+@pytest.mark.parametrize('cls', [Detector, Jungfrau, Slotted, SlottedJungfrau])
+def test_freeze_rejects_typos(cls):
+    d = cls()
+    d.exptime = 5
+    assert d.exptime == 5
+    with pytest.raises(AttributeError):
+        d.exptme = 5
+
+def test_freeze_allows_properties_and_subclass_attributes():
+    d = Jungfrau()
+    d.period = 10
+    d.nrows = 256
+    assert (d.exptime, d.nrows) == (5, 256)
+
+def test_freeze_keeps_slots():
+    d = SlottedJungfrau()
+    d.nrows = 256
+    assert not hasattr(d, '__dict__')
+    assert Slotted.__slots__ == ('exptime', '_frozen')